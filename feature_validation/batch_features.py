@@ -0,0 +1,310 @@
+import csv
+import glob
+import os
+import time
+import traceback
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import h5py
+import numpy as np
+from natsort import natsorted
+
+import feature_profiler
+from chunked_features import extract_chunked
+from feature_cache import FeatureCache, MAX_SIZE
+from feature_extractor import FeatureExtractor, FEATURES, SOURCES, cache_parameters, pack, unpack
+
+
+# peak memory of an extraction relative to the bytes of the datasets it reads
+MEMORY_FACTOR = 6
+
+# features with one value per recording, the others are summarized over strokes
+SCALAR_FEATURES = ['stroke_count', 'duration']
+STATISTICS = ['mean', 'median', 'max', 'std']
+
+
+def find_recordings(inputs):
+    """
+    :param inputs: directories searched recursively for hdf5 files, hdf5 files or glob patterns
+    :return: naturally sorted list of unique recording paths
+    """
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for root, _, names in os.walk(pattern):
+                paths.update(os.path.join(root, n) for n in names if n.endswith('.hdf5'))
+        else:
+            paths.update(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+    return natsorted(paths)
+
+
+def estimate_memory(path, chunk_size=None):
+    """
+    :param chunk_size: rows read at a time with chunked extraction, None reads whole datasets
+    :return: bytes an extraction of the recording is expected to need at peak
+    """
+    nbytes = 0
+    with h5py.File(path, 'r') as f:
+        for locations in SOURCES.values():
+            for grp, dset in locations:
+                if grp in f and dset in f[grp]:
+                    shape = f[grp][dset].shape
+                    rows = shape[0] if chunk_size is None else min(shape[0], chunk_size)
+                    nbytes += rows * int(np.prod(shape[1:])) * f[grp][dset].dtype.itemsize
+                    break
+    return nbytes * MEMORY_FACTOR
+
+
+def available_memory():
+    """
+    :return: bytes of memory available to new processes, from /proc/meminfo where present
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def summarize(name, value):
+    """
+    :return: OrderedDict of table columns for one feature
+    """
+    if name in SCALAR_FEATURES:
+        return OrderedDict([(name, value)])
+
+    values = np.asarray(value, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return OrderedDict((name + '_' + stat, np.nan) for stat in STATISTICS)
+    return OrderedDict([(name + '_mean', np.mean(values)), (name + '_median', np.median(values)),
+                        (name + '_max', np.max(values)), (name + '_std', np.std(values))])
+
+
+def columns(leading=('file', 'seconds')):
+    """
+    :param leading: columns before the features, e.g. the settings of a sweep
+    :return: list of the columns of the feature table
+    """
+    names = list(leading)
+    for name in FEATURES:
+        names.extend(summarize(name, np.array([0.0])).keys())
+    return names + ['errors']
+
+
+def extraction_failed(row):
+    """
+    :return: True if the row of a recording has no feature column, i.e. the whole extraction failed
+    """
+    return not any(name in row for name in columns(leading=())[:-1])
+
+
+def extract_cached(path, cache, chunk_size, k, force_time_scale):
+    """
+    extract_chunked of a recording, taken from the cache if an earlier extraction stored every feature
+    """
+    key = cache.key(path, **cache_parameters(k, force_time_scale))
+    arrays = cache.get(key)
+    if arrays is not None:
+        values, errors = unpack(arrays)
+        if all(name in values or name in errors for name in FEATURES):
+            return OrderedDict((name, values[name] if name in values else errors[name]) for name in FEATURES)
+
+    features = extract_chunked(path, chunk_size, k, force_time_scale)
+    errors = dict((name, value) for name, value in features.items() if isinstance(value, Exception))
+    values = dict((name, value) for name, value in features.items() if name not in errors)
+
+    # keep what in memory extraction stored before, the features are the same
+    stored = dict(arrays or {})
+    stored.update(pack(values, errors))
+    cache.put(key, stored)
+    return features
+
+
+def feature_rows(path, extract, settings=None):
+    """
+    feature table rows of one recording, failures are reported in their errors column instead of raised
+    :param extract: function computing the features of the recording, an OrderedDict of feature name -> value
+                    or the error, with settings a dict of setting -> such features
+    :param settings: OrderedDict of setting -> OrderedDict of the columns naming it, None for a single row
+    :return: list of OrderedDict rows, one per setting, all with the seconds extract took
+    """
+    start = time.time()
+    leading = settings if settings is not None else OrderedDict([(None, OrderedDict())])
+    try:
+        results = extract()
+        if settings is None:
+            results = {None: results}
+    except Exception as e:
+        results = dict.fromkeys(leading, e)
+    seconds = time.time() - start
+
+    rows = []
+    for setting, naming in leading.items():
+        row = OrderedDict(file=path)
+        row.update(naming)
+        errors = []
+        features = results[setting]
+        if isinstance(features, Exception):
+            errors.append(''.join(traceback.format_exception_only(type(features), features)).strip())
+        else:
+            for name, value in features.items():
+                if isinstance(value, Exception):
+                    errors.append('%s: %s: %s' % (name, type(value).__name__, value))
+                    continue
+                row.update(summarize(name, value))
+        row['seconds'] = seconds
+        row['errors'] = '; '.join(errors)
+        rows.append(row)
+    return rows
+
+
+def extract_recording(path, k, force_time_scale, chunk_size=None, cache=None):
+    """
+    worker entry point, computes the feature table row of one recording
+    :param chunk_size: read the recording in chunks of this many rows, see chunked_features.py
+    :param cache: FeatureCache shared by the workers, None to compute everything
+    :return: OrderedDict row, failures are reported in its errors column instead of raised
+    """
+    def extract():
+        with feature_profiler.session(path):
+            if chunk_size is not None and cache is not None:
+                return extract_cached(path, cache, chunk_size, k, force_time_scale)
+            elif chunk_size is not None:
+                return extract_chunked(path, chunk_size, k, force_time_scale)
+            with FeatureExtractor(path, k=k, force_time_scale=force_time_scale, cache=cache) as fx:
+                return fx.features()
+
+    return feature_rows(path, extract)[0]
+
+
+def run_batch(paths, workers, max_memory, k=6, force_time_scale=1.0, chunk_size=None, cache=None):
+    """
+    extract every recording in a process pool, largest first, keeping the estimated memory
+    of the recordings in flight below max_memory. A recording larger than max_memory runs alone.
+    If a worker dies, e.g. killed for memory, the recordings it shared the pool with are retried
+    one at a time, so only the one that takes a worker down fails.
+    Recordings found in the cache are not counted against max_memory.
+    :return: generator of table rows in completion order
+    """
+    pending = []
+    for path in paths:
+        try:
+            if cache is not None and cache.contains(path, **cache_parameters(k, force_time_scale)):
+                pending.append((0, path))
+            else:
+                pending.append((estimate_memory(path, chunk_size), path))
+        except Exception as e:
+            yield OrderedDict(file=path, seconds=0.0, errors='%s: %s' % (type(e).__name__, e))
+    pending.sort(reverse=True)
+    suspects = []
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    in_flight = {}
+    try:
+        while pending or suspects or in_flight:
+            if suspects:
+                if not in_flight:
+                    mem, path = suspects.pop(0)
+                    in_flight[executor.submit(extract_recording, path, k, force_time_scale, chunk_size, cache)] = (mem, path)
+            else:
+                used = sum(mem for mem, _ in in_flight.values())
+                idx = 0
+                while idx < len(pending) and len(in_flight) < workers:
+                    mem, path = pending[idx]
+                    if in_flight and used + mem > max_memory:
+                        idx += 1
+                        continue
+                    in_flight[executor.submit(extract_recording, path, k, force_time_scale, chunk_size, cache)] = (mem, path)
+                    used += mem
+                    pending.pop(idx)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = []
+            for future in done:
+                mem, path = in_flight.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    broken.append((mem, path))
+
+            if broken:
+                broken.extend(in_flight.values())
+                in_flight.clear()
+                if len(broken) == 1:
+                    yield OrderedDict(file=broken[0][1], seconds=0.0, errors='worker process terminated')
+                else:
+                    suspects.extend(broken)
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=workers)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def main():
+    parser = ArgumentParser(description='Extract the features of many recordings into one table')
+    parser.add_argument('inputs', nargs='+', type=str,
+                        help='Directories searched recursively for hdf5 files, hdf5 files or glob patterns')
+    parser.add_argument('--output', type=str, default='features.csv',
+                        help='Feature table, one row per recording')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Worker processes')
+    parser.add_argument('--max_memory', type=float, default=None,
+                        help='MB the recordings in flight may use together, 3/4 of the available memory by default')
+    parser.add_argument('--k', type=int, default=6,
+                        help='k of the k-cosines used to segment strokes')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='Read recordings in chunks of this many rows, for recordings that do not fit in memory')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory caching the features of recordings between runs, shared by the workers')
+    parser.add_argument('--cache_size', type=float, default=MAX_SIZE / 1e6,
+                        help='MB the cache may use, least recently used recordings are removed beyond it')
+    parser.add_argument('--force_time_scale', type=float, default=1.0,
+                        help='Factor bringing force time stamps to the unit of data/time, 1e9 for the validation files')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Trace file of the time every worker spends per stage, see feature_profiler.py')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='Also record the bytes allocated per stage, slows down Python heavy stages')
+    args = parser.parse_args()
+
+    paths = find_recordings(args.inputs)
+    if not paths:
+        print('No recordings found')
+        return
+
+    trace = feature_profiler.start(args.profile, args.profile_memory)
+    cache = FeatureCache(args.cache_dir, args.cache_size * 1e6) if args.cache_dir is not None else None
+    max_memory = args.max_memory * 1e6 if args.max_memory is not None else 0.75 * available_memory()
+    print('Extracting %d recordings with %d workers' % (len(paths), args.workers))
+
+    start = time.time()
+    rows = []
+    for row in run_batch(paths, args.workers, max_memory, args.k, args.force_time_scale, args.chunk_size, cache):
+        rows.append(row)
+        status = 'failed: ' + row['errors'] if extraction_failed(row) else '%.2fs' % row['seconds']
+        print('[%d/%d] %s %s' % (len(rows), len(paths), row['file'], status))
+
+    # table in input order, features a recording could not provide stay empty
+    order = dict((path, idx) for idx, path in enumerate(paths))
+    rows.sort(key=lambda row: order[row['file']])
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns(), restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    failed = sum(1 for row in rows if row['errors'])
+    print('Wrote %s, %d recordings in %.1fs, %d with errors' % (args.output, len(rows), time.time() - start, failed))
+
+    if trace is not None:
+        print('\nProfile written to', trace)
+        feature_profiler.print_summary(trace)
+
+
+if __name__ == "__main__":
+    main()
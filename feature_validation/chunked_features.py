@@ -0,0 +1,474 @@
+"""
+Per stroke features of a recording read in chunks of bounded size.
+
+session_statistics makes a first pass for the session wide values, iter_strokes a
+second one yielding the features of every stroke as soon as it ended. Memory is
+bounded by the poses and time stamps of the stroke still open plus the chunk being
+read, at most max_stroke_samples + chunk_size rows, and by the force and voxel rows
+of the strokes closed at once, in proportion to their rate. A stroke left open for
+more than max_stroke_samples poses, e.g. in a recording with few or no pivots, stops
+the extraction with a ValueError instead of buffering the whole session.
+"""
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+import feature_extraction as ft
+from feature_extractor import FEATURES, SOURCES
+import feature_profiler
+from feature_profiler import profiled
+
+
+# samples read from a dataset at a time
+CHUNK_SIZE = 1 << 18
+
+# poses an open stroke may buffer before chunked extraction gives up, 16 default chunks of about 64 MB
+MAX_STROKE_SAMPLES = 16 * CHUNK_SIZE
+
+# time difference drill_orientation counts as the same time, np.isclose(dt, 0)
+_SAME_TIME = 1e-8
+
+TRAJECTORY_FEATURES = ['velocity', 'acceleration', 'jerk', 'curvature']
+
+
+def find_dataset(file, name):
+    """
+    :return: dataset of a source in SOURCES, None if the recording does not have it
+    """
+    for grp, dset in SOURCES[name]:
+        if grp in file and dset in file[grp]:
+            return file[grp][dset]
+    return None
+
+
+@profiled('hdf5_read')
+def read(dset, start, stop):
+    """
+    :return: rows start to stop of a dataset, every read of chunked extraction goes through here
+    """
+    return dset[start:stop]
+
+
+def chunks(dset, chunk_size, scale=None):
+    """
+    yield consecutive slices of a dataset, each read on its own
+    """
+    for start in range(0, len(dset), chunk_size):
+        values = read(dset, start, start + chunk_size)
+        yield values if scale is None else values * scale
+
+
+def _sort_keys(values):
+    """
+    map float64 to uint64 keys with the same order
+    """
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+    return np.where(bits >> np.uint64(63), ~bits, bits | np.uint64(1 << 63))
+
+
+def _from_key(key):
+    key = np.uint64(key)
+    bits = key ^ np.uint64(1 << 63) if key >> np.uint64(63) else ~key
+    return float(np.array([bits], dtype=np.uint64).view(np.float64)[0])
+
+
+def streaming_median(passes, limit=CHUNK_SIZE):
+    """
+    exact median of values too many to hold at once, identical to np.median
+
+    The values are bucketed by the leading 16 bits of an order preserving key,
+    then the buckets holding the middle values are split 16 bits further per
+    pass until they hold at most limit values, which are then sorted.
+    :param passes: function returning a new iterator over arrays of the values, called once per pass
+    :param limit: values collected in memory at most
+    :return: median, nan without values
+    """
+    counts = np.zeros(1 << 16, dtype=np.int64)
+    n = 0
+    for values in passes():
+        keys = _sort_keys(values)
+        n += len(keys)
+        counts += np.bincount((keys >> np.uint64(48)).astype(np.int64), minlength=1 << 16)
+    if n == 0:
+        return np.nan
+
+    middle = [_select(passes, counts, rank, limit) for rank in sorted({(n - 1) // 2, n // 2})]
+    return middle[0] if len(middle) == 1 else (middle[0] + middle[1]) / 2
+
+
+def _select(passes, counts, rank, limit):
+    """
+    value of the given rank, counts is the histogram of the leading 16 bits
+    """
+    prefix, resolved, below = 0, 0, 0
+    while True:
+        cumulative = np.cumsum(counts)
+        bucket = int(np.searchsorted(cumulative, rank - below, side='right'))
+        below += int(cumulative[bucket - 1]) if bucket else 0
+        prefix = (prefix << 16) | bucket
+        resolved += 16
+        if resolved == 64:
+            return _from_key(prefix)
+
+        shift = np.uint64(64 - resolved)
+        if counts[bucket] <= limit:
+            found = [values[(_sort_keys(values) >> shift) == np.uint64(prefix)] for values in passes()]
+            return float(np.sort(np.concatenate(found))[rank - below])
+
+        counts = np.zeros(1 << 16, dtype=np.int64)
+        for values in passes():
+            keys = _sort_keys(values)
+            keys = keys[(keys >> shift) == np.uint64(prefix)]
+            counts += np.bincount(((keys >> (shift - np.uint64(16))) & np.uint64(0xFFFF)).astype(np.int64),
+                                  minlength=1 << 16)
+
+
+class RunningStats:
+    """
+    mean and standard deviation merged chunk by chunk
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        mean = np.mean(values)
+        m2 = np.sum((values - mean) ** 2)
+        count = self.count + len(values)
+        delta = mean - self.mean
+        self.mean += delta * len(values) / count
+        self._m2 += m2 + delta ** 2 * self.count * len(values) / count
+        self.count = count
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / self.count)
+
+
+class TimeCursor:
+    """
+    Reads a time stamped stream in chunks for windows that move forward in time.
+    """
+    def __init__(self, times, values=None, chunk_size=CHUNK_SIZE, scale=1.0):
+        """
+        :param times: time stamp dataset, ascending
+        :param values: dataset with a row per time stamp, or None
+        :param scale: factor applied to the time stamps
+        """
+        self.times = times
+        self.values = values
+        self.chunk_size = chunk_size
+        self.scale = scale
+        self._read = 0
+        self._last = -np.inf
+        self._t = np.zeros(0)
+        self._v = None if values is None else np.zeros((0,) + values.shape[1:], dtype=values.dtype)
+
+    def take(self, t_start, t_stop):
+        """
+        :return: time stamps and rows with t_start <= time < t_stop, earlier rows are dropped for good
+        """
+        drop = np.searchsorted(self._t, t_start, side='left')
+        self._t = self._t[drop:]
+        if self._v is not None:
+            self._v = self._v[drop:]
+
+        # chunks are joined once, not grown by every chunk read
+        times, values = [self._t], [self._v]
+        while self._read < len(self.times) and (len(times[-1]) == 0 or times[-1][-1] < t_stop):
+            stop = min(self._read + self.chunk_size, len(self.times))
+            t = read(self.times, self._read, stop) * self.scale
+            if np.any(np.diff(t) < 0) or (len(t) and t[0] < self._last):
+                raise ValueError('Chunked extraction needs time stamps in ascending order')
+            self._last = t[-1] if len(t) else self._last
+            keep = np.searchsorted(t, t_start, side='left')
+            times.append(t[keep:])
+            if self._v is not None:
+                values.append(read(self.values, self._read + keep, stop))
+            self._read = stop
+        if len(times) > 1:
+            self._t = np.concatenate(times)
+            if self._v is not None:
+                self._v = np.concatenate(values)
+
+        inside = np.searchsorted(self._t, t_stop, side='left')
+        return self._t[:inside], None if self._v is None else self._v[:inside]
+
+
+def _pose_chunks(pose, time, chunk_size, k):
+    """
+    yield start index, poses, time stamps and pivot angles of consecutive chunks,
+    poses are read with k samples of overlap on each side for the angles
+    """
+    n = len(pose)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        lo = max(start - k, 0)
+        window = read(pose, lo, min(stop + k, n))
+        first = max(start, k)
+        last = min(stop, n - k)
+        angles = ft.pivot_angles(window[first - k - lo:last + k - lo], k) if first < last else np.zeros(0)
+        yield start, window[start - lo:stop - lo], read(time, start, stop), first, angles
+
+
+def session_statistics(file, chunk_size=CHUNK_SIZE, k=6):
+    """
+    first pass over a recording, the session wide values the per stroke features depend on
+    :return: dict of the pivot threshold, first pose time, stationary speed, median force and duration
+    """
+    pose = find_dataset(file, 'pose')
+    time = find_dataset(file, 'time')
+    if pose is None or time is None:
+        raise KeyError('No dataset for ' + ('pose' if pose is None else 'time'))
+    if len(pose) <= 2 * k:
+        raise ValueError('Too few drill poses to segment strokes')
+
+    angles = RunningStats()
+    t_min = np.inf
+    t_last = -np.inf
+    scale = 0.0
+    for start, poses, times, _, x_p in _pose_chunks(pose, time, chunk_size, k):
+        angles.add(x_p)
+        if np.any(np.diff(times) < 0) or times[0] < t_last:
+            raise ValueError('Chunked extraction needs time stamps in ascending order')
+        t_min = min(t_min, np.min(times))
+        t_last = times[-1]
+        scale = max(scale, np.max(np.abs(poses[:, :3])))
+
+    def spacings():
+        previous = None
+        for times in chunks(time, chunk_size):
+            yield np.diff(times) if previous is None else np.diff(np.insert(times, 0, previous))
+            previous = times[-1]
+
+    stats = dict(threshold=angles.mean + angles.std, t_min=t_min,
+                 min_speed=ft.stationary_speed(scale, streaming_median(spacings, chunk_size)))
+
+    force = find_dataset(file, 'force')
+    if force is not None:
+        def force_norms():
+            for values in chunks(force, chunk_size):
+                norms = np.linalg.norm(values, axis=1) if len(values) else np.zeros(0)
+                yield norms[norms > 0]
+        stats['force_median'] = streaming_median(force_norms, chunk_size)
+
+    voxel_time = find_dataset(file, 'voxel_time')
+    if voxel_time is not None and len(voxel_time):
+        extremes = np.array([(np.min(t), np.max(t)) for t in chunks(voxel_time, chunk_size)])
+        stats['duration'] = np.max(extremes[:, 1]) - np.min(extremes[:, 0])
+
+    return stats
+
+
+def iter_strokes(file, stats, chunk_size=CHUNK_SIZE, k=6, force_time_scale=1.0,
+                 max_stroke_samples=MAX_STROKE_SAMPLES):
+    """
+    second pass over a recording, yields the features of every stroke as soon as it ended
+
+    Poses are read chunk by chunk, the chunks of the stroke that is still open are
+    kept and joined once it ends, so memory is bounded by chunk size and
+    max_stroke_samples. Time stamps have to be ascending.
+    :param file: open h5py file of the recording
+    :param stats: result of session_statistics
+    :param max_stroke_samples: poses buffered for an open stroke past which a ValueError is raised
+    :return: generator of OrderedDict per stroke, the stroke after the last stroke end
+        only has the trajectory features, exceptions stand in for features that failed
+    """
+    pose = find_dataset(file, 'pose')
+    time = find_dataset(file, 'time')
+    force = find_dataset(file, 'force')
+    force_time = find_dataset(file, 'force_time')
+    voxel_time = find_dataset(file, 'voxel_time')
+    with_force = force is not None and force_time is not None
+    with_angles = with_force and not np.isnan(stats['force_median'])
+
+    pivots = ft.StreamingPivots(k)
+    force_window = TimeCursor(force_time, force, chunk_size, force_time_scale) if with_force else None
+    force_near = TimeCursor(force_time, force, chunk_size, force_time_scale) if with_angles else None
+    voxels = TimeCursor(voxel_time, None, chunk_size) if voxel_time is not None else None
+
+    state = dict(base=0, start=0, start_time=stats['t_min'], index=0)
+    # chunks of poses and time stamps from state['base'] on, joined when a stroke ends
+    buffer = dict(pose=[pose[:0]], time=[time[:0]])
+
+    def joined():
+        """
+        :return: the buffered poses and time stamps as one array each
+        """
+        for name in ('pose', 'time'):
+            if len(buffer[name]) > 1:
+                buffer[name] = [np.concatenate(buffer[name])]
+        return buffer['pose'][0], buffer['time'][0]
+
+    def trajectory_features(poses, times, offsets):
+        """
+        :return: OrderedDict of trajectory feature -> per stroke values or the error, the trajectories or None
+        """
+        try:
+            trajectories = ft.StrokeTrajectories(poses, times, offsets)
+            return OrderedDict([
+                ('velocity', trajectories.path_rate(0)),
+                ('acceleration', trajectories.path_rate(1)),
+                ('jerk', trajectories.path_rate(2)),
+                ('curvature', ft.extract_curvature(None, None, None, trajectories=trajectories,
+                                                   min_speed=stats['min_speed']))]), trajectories
+        except ValueError as e:
+            return OrderedDict((name, [e] * len(offsets)) for name in TRAJECTORY_FEATURES), None
+
+    def close(ends):
+        """
+        features of the strokes from state['start'] to the stroke ends at the indices ends, all at once
+        """
+        base = state['base']
+        buffered_pose, buffered_time = joined()
+        starts = np.insert(ends[:-1], 0, state['start'])
+        poses = buffered_pose[state['start'] - base:ends[-1] - base]
+        times = buffered_time[state['start'] - base:ends[-1] - base]
+        stroke_times = np.insert(buffered_time[ends - base], 0, state['start_time'])
+        n_strokes = len(ends)
+
+        features = OrderedDict(stroke=state['index'] + np.arange(n_strokes), start_time=stroke_times[:-1])
+        values, trajectories = trajectory_features(poses, times, starts - state['start'])
+        features.update(values)
+        if trajectories is not None:
+            lengths = trajectories.lengths(0)
+        else:
+            lengths = ft.path_length(ft.arc_length(poses[:, :3]), starts - state['start'], ends - state['start'])
+        features['stroke_length'] = lengths
+
+        if with_force:
+            force_times, forces = force_window.take(stroke_times[0], stroke_times[-1])
+            norms = np.linalg.norm(forces, axis=1) if len(forces) else np.zeros(0)
+            features['stroke_force'] = ft.stroke_means(norms, ft.stroke_bins(force_times, stroke_times, n_strokes),
+                                                       n_strokes)
+        if voxels is not None:
+            removed, _ = voxels.take(stroke_times[0], stroke_times[-1])
+            features['removal_rate'] = np.divide(
+                ft.stroke_counts(ft.stroke_bins(removed, stroke_times, n_strokes), n_strokes), lengths)
+        if with_angles:
+            # poses binned by time as stroke_bins does, matched against the force samples close enough to count
+            first = np.searchsorted(buffered_time, stroke_times[0], side='left')
+            last = np.searchsorted(buffered_time, stroke_times[-1], side='left')
+            near_times, near_forces = force_near.take(stroke_times[0] - 2 * _SAME_TIME,
+                                                      stroke_times[-1] + 2 * _SAME_TIME)
+            angles, angle_times = ft.drill_angles(buffered_pose[first:last], buffered_time[first:last],
+                                                  near_forces, near_times, stats['force_median'])
+            features['drill_angle'] = ft.stroke_means(angles, ft.stroke_bins(angle_times, stroke_times, n_strokes),
+                                                      n_strokes)
+        elif with_force:
+            features['drill_angle'] = np.full(n_strokes, np.nan)
+
+        # keep the poses of the next stroke and any earlier ones sharing its start time
+        keep = min(ends[-1] - base, np.searchsorted(buffered_time, stroke_times[-1], side='left'))
+        buffer['pose'] = [buffered_pose[keep:]]
+        buffer['time'] = [buffered_time[keep:]]
+        state['base'] = base + keep
+        state['start'] = ends[-1]
+        state['start_time'] = stroke_times[-1]
+        state['index'] += n_strokes
+
+        for i in range(n_strokes):
+            yield OrderedDict((name, value[i]) for name, value in features.items())
+
+    threshold = stats['threshold']
+    for start, poses, times, first, x_p in _pose_chunks(pose, time, chunk_size, k):
+        flags = np.zeros(len(poses), dtype=bool)
+        flags[first - start:first - start + len(x_p)] = x_p > threshold
+
+        buffer['pose'].append(poses)
+        buffer['time'].append(times)
+        ends = pivots.push(flags)
+        if len(ends):
+            yield from close(ends)
+        elif sum(len(t) for t in buffer['time']) > max_stroke_samples:
+            raise ValueError('Stroke open for more than %d poses, raise max_stroke_samples or extract the '
+                             'recording in memory' % max_stroke_samples)
+
+    ends = pivots.finish()
+    if len(ends):
+        yield from close(ends)
+
+    # after the last stroke end only the trajectory features are defined
+    base = state['base']
+    buffered_pose, buffered_time = joined()
+    features = OrderedDict(stroke=state['index'], start_time=state['start_time'])
+    values, _ = trajectory_features(buffered_pose[state['start'] - base:], buffered_time[state['start'] - base:], [0])
+    features.update((name, value[0]) for name, value in values.items())
+    yield features
+
+
+def extract_chunked(path, chunk_size=CHUNK_SIZE, k=6, force_time_scale=1.0, max_stroke_samples=MAX_STROKE_SAMPLES):
+    """
+    features of a recording with memory bounded by chunk size and max_stroke_samples,
+    the values FeatureExtractor.features() gives
+    :return: OrderedDict of feature name -> value, the error instead for features that could not be computed
+    """
+    with h5py.File(path, 'r') as file:
+        stats = session_statistics(file, chunk_size, k)
+        missing = {}
+        for source, names in [('force', ['stroke_force', 'drill_angle']), ('force_time', ['stroke_force', 'drill_angle']),
+                              ('voxel_time', ['removal_rate'])]:
+            if find_dataset(file, source) is None:
+                missing.update((name, source) for name in names if name not in missing)
+        per_stroke = OrderedDict((name, []) for name in FEATURES)
+        count = 0
+        for features in iter_strokes(file, stats, chunk_size, k, force_time_scale, max_stroke_samples):
+            if 'stroke_length' in features:
+                count += 1
+            for name, value in features.items():
+                per_stroke.setdefault(name, []).append(value)
+
+    result = OrderedDict()
+    for name in FEATURES:
+        if name == 'stroke_count':
+            result[name] = count
+        elif name == 'duration':
+            result[name] = stats['duration'] if 'duration' in stats else KeyError('No dataset for voxel_time')
+        elif name in missing:
+            result[name] = KeyError('No dataset for ' + missing[name])
+        else:
+            errors = [value for value in per_stroke[name] if isinstance(value, Exception)]
+            result[name] = errors[0] if errors else np.array(per_stroke[name], dtype=np.float64)
+
+    # drill_orientation leaves out strokes without angles
+    if isinstance(result['drill_angle'], np.ndarray):
+        result['drill_angle'] = result['drill_angle'][~np.isnan(result['drill_angle'])]
+
+    return result
+
+
+def main():
+    parser = ArgumentParser(description='Per stroke features of a recording, read in chunks of bounded size')
+    parser.add_argument('--file', required=True, type=str)
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE,
+                        help='Samples read from a dataset at a time')
+    parser.add_argument('--k', type=int, default=6,
+                        help='k of the k-cosines used to segment strokes')
+    parser.add_argument('--force_time_scale', type=float, default=1.0,
+                        help='Factor bringing force time stamps to the unit of data/time')
+    parser.add_argument('--max_stroke_samples', type=int, default=MAX_STROKE_SAMPLES,
+                        help='Poses a stroke may span before extraction fails, bounds the memory of an open stroke')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Trace file of the time spent per stage, see feature_profiler.py')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='Also record the bytes allocated per stage, slows down Python heavy stages')
+    args = parser.parse_args()
+
+    trace = feature_profiler.start(args.profile, args.profile_memory)
+    with feature_profiler.session(args.file), h5py.File(args.file, 'r') as file:
+        stats = session_statistics(file, args.chunk_size, args.k)
+        for features in iter_strokes(file, stats, args.chunk_size, args.k, args.force_time_scale,
+                                     args.max_stroke_samples):
+            print(', '.join('%s: %s' % (name, value) for name, value in features.items()))
+
+    if trace is not None:
+        feature_profiler.print_summary(trace)
+
+
+if __name__ == "__main__":
+    main()
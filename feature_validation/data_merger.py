@@ -33,7 +33,7 @@ class DataMerger:
             file = h5py.File(file_name, 'r')
             if verbose: print(idx, 'Opening', file_name)
             for grp in file.keys():
-                if grp == 'metadata':
+                if grp == 'metadata' or grp == 'images':
                     continue
 
                 if grp not in self._data:
@@ -0,0 +1,433 @@
+import inspect
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import numpy as np
+from scipy import integrate
+
+import feature_extraction as ft
+import segmentation_sweep
+from feature_extractor import FeatureExtractor
+
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+# synthetic procedure: the drill tip moves back and forth on an arc of a circle around the origin,
+# each stroke starting and ending at rest, with a piecewise constant force and a fixed drill angle
+RATE = 1000.0           # pose and force samples per second
+STROKE_SAMPLES = 500    # samples per stroke
+RADIUS = 0.05           # m, radius of the circle, the curvature of every stroke is its inverse
+STROKE_LENGTH = 0.02    # m, arc travelled per stroke
+FORCES = [1.0, 2.0, 3.0, 4.0]   # N, force magnitude of consecutive strokes, repeating
+DRILL_ANGLE = 30.0      # deg, drill_angles of every pose
+VOXEL_SPACING = STROKE_LENGTH / 100     # m travelled per removed voxel
+
+# largest session the segmentation sweep is timed on, it computes the stroke features once per segmentation
+SWEEP_MAX_SAMPLES = 10 ** 6
+TREMOR = 1e-4           # m, noise on the positions of the swept sessions so the settings segment differently
+
+
+def synthetic_session(n, stroke_samples=STROKE_SAMPLES):
+    """
+    synthetic recording of n samples with known per stroke features
+
+    The speed of a stroke of duration T follows 2 L / T sin^2(pi t / T), so the
+    drill rests at every stroke end, which is where get_strokes finds pivots.
+    The recording starts and stops halfway into a stroke, so there are no
+    pivots at its edges. Ground truth is given for the whole strokes between the
+    first and the last stroke end, which are all per stroke values but the first.
+    :return: dict of source name -> array as in feature_extractor.SOURCES, OrderedDict of ground truth
+    """
+    duration = stroke_samples / RATE
+    t = (np.arange(n) + stroke_samples / 2) / RATE
+    segment = np.floor(t / duration).astype(np.int64)
+    tau = t / duration - segment
+
+    # fraction of the arc travelled, the integral of the sin^2 speed profile
+    travelled = tau - np.sin(2 * np.pi * tau) / (2 * np.pi)
+    theta = STROKE_LENGTH / RADIUS * np.where(segment % 2 == 0, travelled, 1 - travelled)
+
+    pose = np.zeros((n, 7))
+    pose[:, 0] = RADIUS * np.cos(theta)
+    pose[:, 1] = RADIUS * np.sin(theta)
+
+    # drill axis [-1, 0, 0] rotated about y by DRILL_ANGLE, against a force along z
+    half = np.radians(DRILL_ANGLE) / 2
+    pose[:, 4] = np.sin(half)
+    pose[:, 6] = np.cos(half)
+
+    forces = np.asarray(FORCES)
+    force = np.zeros((n, 3))
+    force[:, 2] = forces[segment % len(forces)]
+
+    # a voxel every VOXEL_SPACING of the path
+    arc = ft.arc_length(pose[:, :3])
+    voxel_time = np.interp(np.arange(0, arc[-1], VOXEL_SPACING), arc, t)
+
+    session = OrderedDict([('pose', pose), ('time', t), ('force', force), ('force_time', t.copy()),
+                           ('voxel_time', voxel_time)])
+
+    strokes = np.arange(segment[0] + 1, segment[-1])
+    truth = OrderedDict()
+    truth['stroke_count'] = int(segment[-1] - segment[0])
+    truth.update(_stroke_truth(duration))
+    truth['stroke_length'] = STROKE_LENGTH
+    truth['stroke_force'] = forces[strokes % len(forces)]
+    truth['removal_rate'] = 1 / VOXEL_SPACING
+    truth['curvature'] = 1 / RADIUS
+    truth['drill_angle'] = DRILL_ANGLE
+    truth['duration'] = voxel_time[-1] - voxel_time[0] if len(voxel_time) else 0.0
+    return session, truth
+
+
+def _stroke_truth(duration, samples=100001):
+    """
+    distance travelled by position, velocity and acceleration of a stroke over its duration,
+    integrated from the closed forms of the derivatives on a circle
+    """
+    tau = np.linspace(0, 1, samples)
+    peak = 2 * STROKE_LENGTH / duration
+    speed = peak * np.sin(np.pi * tau) ** 2
+    d_speed = peak * np.pi / duration * np.sin(2 * np.pi * tau)
+    dd_speed = peak * 2 * np.pi ** 2 / duration ** 2 * np.cos(2 * np.pi * tau)
+
+    # tangential and normal components of acceleration and jerk
+    acceleration = np.hypot(d_speed, speed ** 2 / RADIUS)
+    jerk = np.hypot(dd_speed - speed ** 3 / RADIUS ** 2, 3 * speed * d_speed / RADIUS)
+
+    return OrderedDict([('velocity', STROKE_LENGTH / duration),
+                        ('acceleration', integrate.simpson(acceleration, x=tau)),
+                        ('jerk', integrate.simpson(jerk, x=tau))])
+
+
+class Case:
+    """
+    one timed call of a public function of feature_extraction
+    """
+    def __init__(self, name, call, max_samples=None):
+        """
+        :param name: name of the function or class in feature_extraction
+        :param call: function of the results so far, a dict of name -> value, returning the result of the case
+        :param max_samples: largest session the case runs on, None for all
+        """
+        self.name = name
+        self.call = call
+        self.max_samples = max_samples
+
+
+def _streaming_pivots(r):
+    pivots = ft.StreamingPivots(r['k'])
+    ends = [pivots.push(flags) for flags in np.array_split(r['pivot_flags'], max(1, len(r['pivot_flags']) // 65536))]
+    return np.concatenate(ends + [np.asarray(pivots.finish(), dtype=np.int64)])
+
+
+# in dependency order, r holds the session sources, the results of earlier cases and the setup values below
+CASES = [
+    Case('pivot_angles', lambda r: ft.pivot_angles(r['pose'], r['k'])),
+    Case('position_norms', lambda r: ft.position_norms(r['pose'])),
+    Case('strokes_from_angles', lambda r: ft.strokes_from_angles(r['time'], r['pivot_angles'], r['k'])),
+    Case('get_strokes', lambda r: ft.get_strokes(r['pose'], r['time'], r['k'])),
+    Case('StreamingPivots', _streaming_pivots),
+    Case('get_stroke_indices', lambda r: ft.get_stroke_indices(r['strokes'])),
+    Case('stroke_bins', lambda r: ft.stroke_bins(r['force_time'], r['stroke_times'], r['n_strokes'])),
+    Case('stroke_counts', lambda r: ft.stroke_counts(r['stroke_bins'], r['n_strokes'])),
+    Case('stroke_means', lambda r: ft.stroke_means(r['force_norms'], r['stroke_bins'], r['n_strokes'])),
+    Case('stroke_force', lambda r: ft.stroke_force(r['strokes'], r['stroke_times'], r['force'], r['force_time'])),
+    Case('arc_length', lambda r: ft.arc_length(r['pose'][:, :3])),
+    Case('path_length', lambda r: ft.path_length(r['arc_length'], r['starts'], r['stops'])),
+    Case('window_length', lambda r: ft.window_length(r['arc_length'], r['time'],
+                                                     r['stroke_times'][:-1], r['stroke_times'][1:])),
+    Case('stroke_length', lambda r: ft.stroke_length(r['strokes'], r['pose'])),
+    Case('bone_removal_rate', lambda r: ft.bone_removal_rate(r['strokes'], r['stroke_times'], r['pose'],
+                                                             r['voxel_time'])),
+    Case('procedure_duration', lambda r: ft.procedure_duration(r['voxel_time'])),
+    Case('drill_angles', lambda r: ft.drill_angles(r['pose'], r['time'], r['force'], r['force_time'],
+                                                   r['median_force'])),
+    Case('procedure_angles', lambda r: ft.procedure_angles(r['pose'], r['time'], r['force'], r['force_time'])),
+    Case('drill_orientation', lambda r: ft.drill_orientation(r['strokes'], r['stroke_times'], r['pose'], r['time'],
+                                                             r['force'], r['force_time'])),
+    Case('StrokeTrajectories', lambda r: ft.StrokeTrajectories(r['pose'], r['time'], r['get_stroke_indices'])),
+    Case('extract_kinematics', lambda r: ft.extract_kinematics(r['pose'], r['time'], r['get_stroke_indices'])),
+    Case('extract_jerk', lambda r: ft.extract_jerk(r['pose'], r['time'], r['get_stroke_indices'])),
+    Case('stationary_speed', lambda r: ft.stationary_speed(r['scale'], 1 / RATE)),
+    Case('extract_curvature', lambda r: ft.extract_curvature(r['pose'], r['time'], r['get_stroke_indices'])),
+    Case('stats_per_stroke', lambda r: ft.stats_per_stroke(r['extract_kinematics'][0])),
+    # builds Python lists of every coordinate, which tracemalloc cannot follow on larger sessions
+    Case('preprocess', lambda r: ft.preprocess(r['pose']), max_samples=10 ** 6),
+]
+
+
+def _setup(name, r):
+    """
+    values derived from a case's result that later cases take as input, computed outside the timing
+    """
+    if name == 'pivot_angles':
+        X_P = r['pivot_angles']
+        mu = np.mean(X_P)
+        padded = np.concatenate([np.full(r['k'], mu), X_P, np.full(r['k'], mu)])
+        r['pivot_flags'] = padded > mu + np.std(X_P)
+    elif name == 'get_strokes':
+        r['strokes'], r['stroke_times'] = r['get_strokes']
+        r['n_strokes'] = int(np.sum(r['strokes']))
+        inds = np.insert(np.flatnonzero(r['strokes'] == 1), 0, 0)
+        r['starts'], r['stops'] = inds[:-1], inds[1:]
+        r['force_norms'] = np.linalg.norm(r['force'], axis=1)
+        r['median_force'] = np.median(r['force_norms'][r['force_norms'] > 0])
+
+
+def uncovered():
+    """
+    :return: public functions and classes of feature_extraction without a case
+    """
+    public = [name for name, value in inspect.getmembers(ft, lambda v: inspect.isfunction(v) or inspect.isclass(v))
+              if not name.startswith('_') and value.__module__ == ft.__name__]
+    names = set(case.name for case in CASES)
+    return [name for name in public if name not in names]
+
+
+def run_case(case, r, repeat):
+    """
+    :return: best wall time of repeat calls in s, peak bytes allocated by one call traced by tracemalloc, result
+    """
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = case.call(r)
+        seconds = min(seconds, time.perf_counter() - start)
+        del result
+
+    tracemalloc.start()
+    try:
+        result = case.call(r)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def errors(r, truth):
+    """
+    error of the features of the benchmark run against ground truth, over the whole strokes,
+    features of strokes that do not match the true strokes are not compared
+    :return: OrderedDict of feature -> OrderedDict of truth and errors
+    """
+    kinematics = r.get('extract_kinematics', (None, None))
+    features = OrderedDict([
+        ('velocity', kinematics[0]),
+        ('acceleration', kinematics[1]),
+        ('jerk', r.get('extract_jerk')),
+        ('curvature', r.get('extract_curvature')),
+        ('stroke_length', r.get('stroke_length')),
+        ('stroke_force', r.get('stroke_force')),
+        ('removal_rate', r.get('bone_removal_rate')),
+        ('drill_angle', r.get('drill_orientation')),
+    ])
+
+    result = OrderedDict()
+    count = r.get('n_strokes')
+    result['stroke_count'] = OrderedDict([('truth', truth['stroke_count']), ('value', count),
+                                          ('error', None if count is None else count - truth['stroke_count'])])
+    for name, values in features.items():
+        if values is None:
+            result[name] = OrderedDict([('truth', _truth(truth[name])), ('error', 'not computed')])
+            continue
+        values = np.asarray(values, dtype=np.float64)
+        if name == 'drill_angle':
+            # drill_orientation leaves out strokes without angles, every angle is the same
+            expected = truth[name]
+        elif count != truth['stroke_count']:
+            result[name] = OrderedDict([('truth', _truth(truth[name])), ('error', 'stroke count differs')])
+            continue
+        else:
+            # the leading stroke is partial, features from stroke indices add the trailing partial stroke
+            values = values[1:count]
+            expected = np.broadcast_to(truth[name], values.shape)
+        relative = np.abs(values - expected) / np.abs(expected)
+        result[name] = OrderedDict([('truth', _truth(truth[name])),
+                                    ('mean_rel_error', float(np.mean(relative)) if len(relative) else None),
+                                    ('max_rel_error', float(np.max(relative)) if len(relative) else None)])
+
+    duration = r.get('procedure_duration')
+    result['duration'] = OrderedDict([('truth', truth['duration']),
+                                      ('error', None if duration is None else float(duration - truth['duration']))])
+    return result
+
+
+def _truth(value):
+    return value if np.isscalar(value) else 'per stroke'
+
+
+def benchmark(sizes, repeat=3, k=6, stroke_samples=STROKE_SAMPLES):
+    """
+    time every case on synthetic sessions of the given sizes
+    :return: OrderedDict ready for json, see main
+    """
+    results = OrderedDict()
+    results['meta'] = metadata()
+    results['meta'].update(repeat=repeat, k=k, stroke_samples=stroke_samples)
+    results['sizes'] = list(sizes)
+    results['functions'] = OrderedDict((case.name, OrderedDict([('seconds', []), ('peak_bytes', [])]))
+                                       for case in CASES)
+    results['accuracy'] = OrderedDict()
+
+    print("%-22s %10s %12s %12s" % ("function", "samples", "ms", "peak MB"))
+    for n in sizes:
+        session, truth = synthetic_session(n, stroke_samples)
+        r = dict(session, k=k, scale=np.max(np.abs(session['pose'][:, :3])))
+        for case in CASES:
+            entry = results['functions'][case.name]
+            if case.max_samples is not None and n > case.max_samples:
+                entry['seconds'].append(None)
+                entry['peak_bytes'].append(None)
+                continue
+            try:
+                seconds, peak, r[case.name] = run_case(case, r, repeat)
+                _setup(case.name, r)
+            except Exception as e:
+                # later cases depending on this one fail as well
+                entry['seconds'].append(None)
+                entry['peak_bytes'].append(None)
+                entry['error'] = '%s: %s' % (type(e).__name__, e)
+                print("%-22s %10d failed: %s" % (case.name, n, entry['error']))
+                continue
+            entry['seconds'].append(seconds)
+            entry['peak_bytes'].append(peak)
+            print("%-22s %10d %12.3f %12.2f" % (case.name, n, seconds * 1e3, peak / 1e6))
+        results['accuracy'][str(n)] = errors(r, truth)
+        del r, session
+
+    for entry in results['functions'].values():
+        entry['exponent'] = exponent(results['sizes'], entry['seconds'])
+    return results
+
+
+def sweep_benchmark(sizes, repeat=3, stroke_samples=STROKE_SAMPLES, max_samples=SWEEP_MAX_SAMPLES):
+    """
+    time segmentation_sweep.sweep over its default grid against a single FeatureExtractor run of the same session
+    :return: OrderedDict ready for json, see main
+    """
+    results = OrderedDict([('sizes', []), ('settings', len(segmentation_sweep.KS) * len(segmentation_sweep.SIGMAS)),
+                           ('segmentations', []), ('seconds', []), ('single_seconds', [])])
+
+    print("\n%-10s %10s %14s %10s %10s %12s" % ("samples", "settings", "segmentations", "sweep s", "single s",
+                                                "single runs"))
+    for n in sizes:
+        if n > max_samples:
+            continue
+        session, _ = synthetic_session(n, stroke_samples)
+        session['pose'][:, :3] += np.random.default_rng(0).normal(0, TREMOR, (n, 3))
+
+        start = time.perf_counter()
+        segmentation_sweep.sweep(session)
+        seconds = time.perf_counter() - start
+        single = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            FeatureExtractor(dict(session)).features()
+            single = min(single, time.perf_counter() - start)
+
+        angles = dict((k, ft.pivot_angles(session['pose'], k)) for k in segmentation_sweep.KS)
+        segmentations = len(set(ft.strokes_from_angles(session['time'], angles[k], k, sigmas)[0].tobytes()
+                                for k in segmentation_sweep.KS for sigmas in segmentation_sweep.SIGMAS))
+
+        for key, value in [('sizes', n), ('segmentations', segmentations), ('seconds', seconds),
+                           ('single_seconds', single)]:
+            results[key].append(value)
+        print("%-10d %10d %14d %10.3f %10.3f %12.1f" % (n, results['settings'], segmentations, seconds, single,
+                                                       seconds / single))
+    return results
+
+
+def exponent(sizes, seconds):
+    """
+    :return: slope of log time over log size, the p of a complexity of O(n^p), None with fewer than 2 sizes
+    """
+    points = [(n, s) for n, s in zip(sizes, seconds) if s is not None and s > 0]
+    if len(points) < 2:
+        return None
+    n, s = np.log(np.array(points)).T
+    return float(np.polyfit(n, s, 1)[0])
+
+
+def metadata():
+    """
+    :return: OrderedDict describing the code and machine of a run
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(ft.__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([('commit', commit), ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                        ('python', platform.python_version()), ('numpy', np.__version__),
+                        ('machine', platform.platform())])
+
+
+def compare(previous, results):
+    """
+    print the time ratio of every function and size measured in both runs, > 1 is slower now
+    """
+    print("\n%-22s %10s %12s %12s %8s" % ("function", "samples", "before ms", "now ms", "ratio"))
+    before_sizes = previous['sizes']
+    for name, entry in results['functions'].items():
+        if name not in previous['functions']:
+            continue
+        before = previous['functions'][name]['seconds']
+        for n, seconds in zip(results['sizes'], entry['seconds']):
+            if n not in before_sizes or seconds is None or before[before_sizes.index(n)] is None:
+                continue
+            old = before[before_sizes.index(n)]
+            print("%-22s %10d %12.3f %12.3f %8.2f" % (name, n, old * 1e3, seconds * 1e3, seconds / max(old, 1e-12)))
+
+
+def main():
+    parser = ArgumentParser(description='Time, memory and accuracy of feature_extraction on synthetic procedures')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Samples of the synthetic sessions')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Calls per function and size, the fastest is recorded')
+    parser.add_argument('--k', type=int, default=6,
+                        help='k of the k-cosines used to segment strokes')
+    parser.add_argument('--stroke_samples', type=int, default=STROKE_SAMPLES,
+                        help='Samples per synthetic stroke')
+    parser.add_argument('--sweep_max_samples', type=int, default=SWEEP_MAX_SAMPLES,
+                        help='Largest session the segmentation sweep is timed on, 0 to skip it')
+    parser.add_argument('--output', type=str, default='feature_benchmark.json',
+                        help='Results, compare runs of different commits with --compare')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Results of an earlier run to compare the times with')
+    args = parser.parse_args()
+
+    missing = uncovered()
+    if missing:
+        print('Not benchmarked:', ', '.join(missing))
+
+    results = benchmark(sorted(args.sizes), args.repeat, args.k, args.stroke_samples)
+
+    print("\n%-22s %10s" % ("function", "exponent"))
+    for name, entry in results['functions'].items():
+        print("%-22s %10s" % (name, '-' if entry['exponent'] is None else '%.2f' % entry['exponent']))
+
+    print("\n%-16s %10s" % ("feature", "max rel error at %d samples" % results['sizes'][-1]))
+    for name, entry in results['accuracy'][str(results['sizes'][-1])].items():
+        print("%-16s %10s" % (name, entry.get('max_rel_error', entry.get('error'))))
+
+    results['sweep'] = sweep_benchmark(sorted(args.sizes), args.repeat, args.stroke_samples, args.sweep_max_samples)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Wrote', args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+import chunked_features
+import feature_extraction
+import feature_extractor
+from chunked_features import CHUNK_SIZE, chunks, find_dataset
+from feature_extractor import SOURCES
+
+
+# default bound of the cache directory, bytes
+MAX_SIZE = 10 << 30
+
+# temporary entries of writers older than this (s) are left over from crashed processes
+_STALE_SECONDS = 3600
+
+
+def code_version():
+    """
+    :return: hash of the modules computing the cached values, entries of other versions are never read
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for module in [feature_extraction, feature_extractor, chunked_features]:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    with open(__file__, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+CODE_VERSION = code_version()
+
+
+def content_hash(path, chunk_size=CHUNK_SIZE):
+    """
+    :return: hash of the dtype, shape and contents of the source datasets of a recording, read in chunks
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with h5py.File(path, 'r') as file:
+        for name in SOURCES:
+            dset = find_dataset(file, name)
+            if dset is None:
+                continue
+            digest.update(('%s %s %s;' % (name, dset.dtype.str, dset.shape)).encode())
+            for values in chunks(dset, chunk_size):
+                digest.update(np.ascontiguousarray(values).data)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    On disk cache of the values FeatureExtractor computes for a recording.
+
+    An entry is keyed by the content hash of the recording's source datasets,
+    the extraction parameters and the code version, so it is found again for a
+    copied or renamed recording and never for a changed one. Every entry is a
+    directory of .npy files, read memory mapped so only the arrays used are
+    read. Writers build an entry in a temporary directory and rename it into
+    place, so processes sharing the cache only ever see complete entries, and
+    an entry removed while in use stays readable through its open maps.
+    Reading an entry marks it used, the least recently used entries are
+    removed once the cache grows beyond max_size.
+    """
+    def __init__(self, directory, max_size=MAX_SIZE):
+        """
+        :param directory: cache directory, created if it does not exist
+        :param max_size: bytes the entries may take together
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._entries = os.path.join(directory, 'entries')
+        self._hashes = os.path.join(directory, 'hashes')
+        os.makedirs(self._entries, exist_ok=True)
+        os.makedirs(self._hashes, exist_ok=True)
+
+    def _memo(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = '%d %d' % (stat.st_size, stat.st_mtime_ns)
+        return path, stamp, os.path.join(self._hashes, hashlib.blake2b(path.encode(), digest_size=16).hexdigest())
+
+    def content_hash(self, path, compute=True):
+        """
+        content_hash of a recording, remembered for its path as long as its size and modification time hold
+        :param compute: False returns None instead of hashing a recording without a remembered hash
+        """
+        path, stamp, memo = self._memo(path)
+        try:
+            with open(memo) as f:
+                memo_stamp, digest = f.read().rsplit(' ', 1)
+            if memo_stamp == stamp:
+                return digest
+        except (OSError, ValueError):
+            pass
+        if not compute:
+            return None
+
+        digest = content_hash(path)
+        fd, tmp = tempfile.mkstemp(dir=self._hashes, prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(stamp + ' ' + digest)
+        os.replace(tmp, memo)
+        return digest
+
+    def key(self, path, compute=True, **parameters):
+        """
+        :param compute: False returns None for a recording whose content hash is not remembered
+        :param parameters: every setting the cached values depend on, e.g. k and force_time_scale
+        :return: key of the entry of a recording
+        """
+        content = self.content_hash(path, compute)
+        if content is None:
+            return None
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(content.encode())
+        digest.update(CODE_VERSION.encode())
+        digest.update(repr(sorted(parameters.items())).encode())
+        return digest.hexdigest()
+
+    def contains(self, path, **parameters):
+        """
+        :return: True if the entry of a recording is cached, without hashing the recording
+        """
+        key = self.key(path, compute=False, **parameters)
+        return key is not None and os.path.isdir(os.path.join(self._entries, key))
+
+    def get(self, key):
+        """
+        :return: dict of name -> read only memory mapped array of an entry, None if it is not cached
+        """
+        entry = os.path.join(self._entries, key)
+        try:
+            names = os.listdir(entry)
+            arrays = dict((name[:-len('.npy')], np.load(os.path.join(entry, name), mmap_mode='r'))
+                          for name in names if name.endswith('.npy'))
+            os.utime(entry)
+        except OSError:
+            # not cached, or evicted while being opened
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        store an entry, replacing the one stored under key before, then evict down to max_size
+        :param arrays: dict of name -> array, names must be valid file names
+        :return: False if the entry could not be written, e.g. the disk is full
+        """
+        entry = os.path.join(self._entries, key)
+        tmp = tempfile.mkdtemp(dir=self._entries, prefix='.')
+        try:
+            for name, value in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(value), allow_pickle=False)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                self._remove(entry)
+                os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self.evict()
+        return True
+
+    def _remove(self, entry):
+        # rename first so readers never find half removed entries
+        trash = tempfile.mkdtemp(dir=self._entries, prefix='.')
+        try:
+            os.rename(entry, os.path.join(trash, 'entry'))
+        except OSError:
+            pass
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def entries(self):
+        """
+        :return: list of (last use, bytes, key) of the complete entries
+        """
+        entries = []
+        for item in os.scandir(self._entries):
+            if item.name.startswith('.'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(item.path))
+                entries.append((item.stat().st_mtime, size, item.name))
+            except OSError:
+                continue
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        remove least recently used entries until the cache holds max_size bytes at most,
+        skipped while another process is evicting
+        """
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+
+            now = time.time()
+            for item in os.scandir(self._entries):
+                try:
+                    if item.name.startswith('.') and now - item.stat().st_mtime > _STALE_SECONDS:
+                        shutil.rmtree(item.path, ignore_errors=True)
+                except OSError:
+                    continue
+
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total <= self.max_size:
+                    break
+                self._remove(os.path.join(self._entries, key))
+                total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self._remove(os.path.join(self._entries, key))
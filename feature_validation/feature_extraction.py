@@ -1,12 +1,17 @@
 import numpy as np
-import math
 
 from scipy.spatial.transform import Rotation as R
 from scipy import signal
 from scipy import fft
-from scipy import integrate
 
+from feature_profiler import profiled
 
+
+# speeds below this fraction of position scale / sample spacing are round off of a stationary drill
+_STATIONARY_TOLERANCE = 1e-9
+
+
+@profiled('stats_per_stroke')
 def stats_per_stroke(stroke_arr: np.ndarray):
     '''
     The mean, median, and max of a list of values.
@@ -31,7 +36,7 @@ def stats_per_stroke(stroke_arr: np.ndarray):
     return mean, med_, max_, sdev_
 
 
-def get_strokes(stream: np.ndarray, timepts: np.ndarray, k=6):
+def get_strokes(stream: np.ndarray, timepts: np.ndarray, k=6, sigmas=1.0):
     '''
     Returns a list of 1's and 0's indicating whether a stroke has
     ended at the timestamp at its index and the timestamps.
@@ -39,6 +44,8 @@ def get_strokes(stream: np.ndarray, timepts: np.ndarray, k=6):
         Parameters:
             stream (np.ndarray): Drill poses over course of procedure
             timepts (np.ndarray): Time stamps of all drill poses
+            k (int): Distance of the samples forming the k-cosine angles
+            sigmas (float): Pivots are angles above their mean plus this many standard deviations
 
         Returns:
             F_c (np.ndarray): List of 1's and 0's indicating whether a
@@ -46,56 +53,262 @@ def get_strokes(stream: np.ndarray, timepts: np.ndarray, k=6):
             st (np.ndarray): Timestamps of stroke ends
     '''
 
-    stream = stream[:, :3]
-    X_P = []
+    return strokes_from_angles(timepts, pivot_angles(stream, k), k, sigmas)
 
-    # Compute k-cosines for each pivot point
-    for j, P in enumerate(stream):
 
-        # Cannot consider edge points as central k's
-        if (j - k < 0) or (j + k >= stream.shape[0]):
-            continue
+@profiled('get_strokes')
+def strokes_from_angles(timepts: np.ndarray, X_P: np.ndarray, k=6, sigmas=1.0):
+    '''
+    get_strokes from pivot angles already computed, so they can be shared between thresholds
 
-        P_a = stream[j - k]
-        P_c = stream[j + k]
+        Parameters:
+            timepts (np.ndarray): Time stamps of all drill poses
+            X_P (np.ndarray): pivot_angles of the drill poses for k
+            k (int): Distance of the samples forming the k-cosine angles
+            sigmas (float): Pivots are angles above their mean plus this many standard deviations
 
-        k_cos = np.dot(P_a, P_c) / (np.linalg.norm(P_a) * np.linalg.norm(P_c))
-        k_cos = max(min(k_cos, 1), -1)
-        X_P.append(180 - (math.acos(k_cos) * (180/np.pi)))
+        Returns:
+            F_c (np.ndarray): List of 1's and 0's indicating whether a
+                              stroke has ended at the timestamp at its index
+            st (np.ndarray): Timestamps of stroke ends
+    '''
 
     # Detect pivot points
     mu = np.mean(X_P)
     sig = np.std(X_P)
 
-    for i in range(k):
+    X_P = np.concatenate([np.full(k, mu), X_P, np.full(k, mu)])
 
-        X_P.insert(0, mu)
-        X_P.append(mu)
+    F_c = _consolidate_pivots(X_P > mu + sigmas * sig, k)
 
-    X_P = np.array(X_P)
+    st = np.insert(timepts[F_c == 1], 0, np.min(timepts))
 
-    F_c = [1 if x_P > mu + sig else 0 for x_P in X_P]
+    return F_c, st
 
-    j = 0
-    for i in range(1, len(F_c)):
 
-        if F_c[i] == 1 and F_c[i-1] == 0:
-            j += 1
-        elif sum(F_c[i:i+k]) == 0 and j != 0:
-            ind = math.floor(j/2)
-            F_c[i-j:i] = [0] * j
-            F_c[i-ind] = 1
-            j = 0
-        elif j != 0:
-            j += 1
+def position_norms(stream: np.ndarray):
+    '''
+    Returns the distance of every drill position from the origin, as pivot_angles computes it
 
-    st = np.insert(timepts[[s == 1 for s in F_c]], 0, min(timepts))
+        Parameters:
+            stream (np.ndarray): Drill poses over course of procedure
 
-    return F_c, st
+        Returns:
+            norms (np.ndarray): Norm of the first 3 coordinates of each pose
+    '''
+
+    stream = stream[:, :3]
+    return np.sqrt(np.matmul(stream[:, None, :], stream[:, :, None])[:, 0, 0])
+
+
+@profiled('pivot_angles')
+def pivot_angles(stream: np.ndarray, k: int, norms: np.ndarray = None):
+    '''
+    Returns the k-cosine angle of every sample that has k samples on both sides.
+
+        Parameters:
+            stream (np.ndarray): Drill poses over course of procedure
+            k (int): Distance of the samples forming the angle
+            norms (np.ndarray): Optional, position_norms of the stream, shared between values of k
+
+        Returns:
+            X_P (np.ndarray): Angle in degrees at samples k to len(stream) - k
+    '''
+
+    stream = stream[:, :3]
+
+    # Compute k-cosines for each pivot point, edge points cannot be central k's
+    P_a = stream[:len(stream) - 2 * k]
+    P_c = stream[2 * k:]
+    # matmul of stacked 1x3 vectors gives the same values as np.dot / np.linalg.norm per pivot
+    dots = np.matmul(P_a[:, None, :], P_c[:, :, None])[:, 0, 0]
+    if norms is None:
+        norm_a = np.sqrt(np.matmul(P_a[:, None, :], P_a[:, :, None])[:, 0, 0])
+        norm_c = np.sqrt(np.matmul(P_c[:, None, :], P_c[:, :, None])[:, 0, 0])
+    else:
+        norm_a = norms[:len(stream) - 2 * k]
+        norm_c = norms[2 * k:]
+    k_cos = np.clip(dots / (norm_a * norm_c), -1, 1)
+
+    return 180 - (np.arccos(k_cos) * (180/np.pi))
+
+
+def _consolidate_pivots(pivots: np.ndarray, k: int):
+    '''
+    Collapses each cluster of pivot samples into a single stroke end.
+    Runs of pivots separated by fewer than k samples form one cluster, which is
+    replaced by a 1 at its end minus half its length.
+
+        Parameters:
+            pivots (np.ndarray): Boolean array of samples above the pivot threshold
+            k (int): Minimum number of quiet samples between two clusters
+
+        Returns:
+            F_c (np.ndarray): 1's at stroke ends, 0's elsewhere
+    '''
+
+    F_c = pivots.astype(int)
+
+    # run-length encode the pivot samples, a run of 1's spans [starts, ends)
+    edges = np.diff(F_c, prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    # the first sample is never checked as the start of a run
+    if len(starts) and starts[0] == 0:
+        starts, ends = starts[1:], ends[1:]
+    if len(starts) == 0:
+        return F_c
+
+    if k > 1:
+        # a cluster ends with the first run followed by at least k 0's
+        last = np.append(starts[1:] - ends[:-1] >= k, True)
+        first = np.insert(last[:-1], 0, True)
+        cluster_starts = starts[first]
+        cluster_ends = ends[last]
+        F_c[starts[0]:] = 0
+        F_c[cluster_ends - (cluster_ends - cluster_starts) // 2] = 1
+        return F_c
+
+    # k = 1, every run is its own cluster, but a stroke end placed right after a run
+    # of length 1 hides a run starting on the next sample, which then stays as it is
+    lengths = ends - starts
+    hides = (lengths == 1) & np.append(starts[1:] == ends[:-1] + 1, False)
+    kept = np.ones(len(starts), dtype=bool)
+    for r in np.flatnonzero(hides):
+        if kept[r]:
+            kept[r + 1] = False
+    for start, end in zip(starts[kept], ends[kept]):
+        F_c[start:end] = 0
+    F_c[ends[kept] - lengths[kept] // 2] = 1
+
+    return F_c
+
+
+class StreamingPivots:
+    '''
+    _consolidate_pivots for pivot flags arriving in chunks. A cluster is consolidated
+    once enough quiet samples follow it that later samples cannot change it, the
+    samples after it are carried over to the next chunk.
+    '''
+
+    def __init__(self, k: int):
+        '''
+            Parameters:
+                k (int): Minimum number of quiet samples between two clusters
+        '''
+        self.k = k
+        # quiet samples after which nothing later affects a cluster, 2 for k = 1 where a run can hide the next
+        self._gap = max(k, 2)
+        self._flags = np.zeros(0, dtype=bool)
+        self._offset = 0
+
+    @profiled('get_strokes')
+    def push(self, pivots: np.ndarray):
+        '''
+        Returns the indices of the stroke ends that are final after this chunk
+
+            Parameters:
+                pivots (np.ndarray): Boolean array of the next samples above the pivot threshold
+
+            Returns:
+                ends (np.ndarray): Indices of stroke ends counted from the first sample pushed
+        '''
+
+        flags = np.concatenate([self._flags, np.asarray(pivots, dtype=bool)])
+        ones = np.flatnonzero(flags)
+        if len(ones) == 0 or len(flags) - 1 - ones[-1] >= self._gap:
+            cut = len(flags)
+        else:
+            quiet = np.flatnonzero(np.diff(ones) - 1 >= self._gap)
+            cut = ones[quiet[-1]] + 1 + self._gap if len(quiet) else 0
+
+        return self._consolidate(flags, cut)
+
+    def finish(self):
+        '''
+        Returns the indices of the remaining stroke ends once all samples were pushed
+        '''
+        return self._consolidate(self._flags, len(self._flags))
+
+    def _consolidate(self, flags, cut):
+        if cut <= 1:
+            self._flags = flags
+            return np.zeros(0, dtype=np.int64)
+
+        ends = np.flatnonzero(_consolidate_pivots(flags[:cut], self.k)) + self._offset
+
+        # carry from the last quiet sample, so the next chunk never starts with a pivot
+        self._flags = flags[cut - 1:]
+        self._offset += cut - 1
+
+        return ends
+
+
+@profiled('binning')
+def stroke_bins(times: np.ndarray, stroke_times: np.ndarray, n_strokes: int):
+    '''
+    Assigns every sample to the stroke whose time window contains it,
+    stroke i spans [stroke_times[i], stroke_times[i+1]).
+
+        Parameters:
+            times (np.ndarray): Time stamps of the samples
+            stroke_times (np.ndarray): Time stamps of stroke boundaries, ascending
+            n_strokes (int): Number of strokes, i.e. sum of the stroke indicator
+
+        Returns:
+            bins (np.ndarray): Stroke index of each sample, -1 outside all strokes
+    '''
+
+    bins = np.searchsorted(stroke_times[:n_strokes + 1], times, side='right') - 1
+    bins[bins >= n_strokes] = -1
+
+    return bins
+
+
+@profiled('binning')
+def stroke_counts(bins: np.ndarray, n_strokes: int, weights: np.ndarray = None):
+    '''
+    Number of samples, or sum of their weights, in each stroke.
+
+        Parameters:
+            bins (np.ndarray): Stroke index of each sample from stroke_bins
+            n_strokes (int): Number of strokes
+            weights (np.ndarray): Optional value of each sample
+
+        Returns:
+            counts (np.ndarray): Count or weight sum for each stroke
+    '''
+
+    inside = bins >= 0
+    if weights is not None:
+        weights = weights[inside]
+
+    return np.bincount(bins[inside], weights=weights, minlength=n_strokes)[:n_strokes]
+
+
+@profiled('binning')
+def stroke_means(values: np.ndarray, bins: np.ndarray, n_strokes: int):
+    '''
+    Mean value of the samples in each stroke, nan for strokes without samples.
+
+        Parameters:
+            values (np.ndarray): Value of each sample
+            bins (np.ndarray): Stroke index of each sample from stroke_bins
+            n_strokes (int): Number of strokes
+
+        Returns:
+            means (np.ndarray): Mean for each stroke
+    '''
+
+    counts = stroke_counts(bins, n_strokes)
+    sums = stroke_counts(bins, n_strokes, values.astype(np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
 
 
 def stroke_force(strokes: np.ndarray, stroke_times: np.ndarray,
-                 force_stream: np.ndarray, force_times: np.ndarray):
+                 force_stream: np.ndarray, force_times: np.ndarray, force_norms: np.ndarray = None):
     '''
     Returns a list of stroke forces representing mean force of
     each stroke of the procedure.
@@ -105,52 +318,105 @@ def stroke_force(strokes: np.ndarray, stroke_times: np.ndarray,
             stroke_times (np.ndarray): Time stamps of stroke boundaries
             force_stream (np.ndarray): Force vectors over course of procedure
             force_times (np.ndarray): Time stamps of all force vectors
+            force_norms (np.ndarray): Optional, norms of the force vectors if already computed
 
         Returns:
             forces (np.ndarray): Average stroke forces for each stroke in procedure
     '''
 
-    avg_stroke_force = []
-    for i in range(sum(strokes)):
+    n_strokes = int(np.sum(strokes))
+    n = min(len(force_stream), len(force_times))
+    bins = stroke_bins(force_times[:n], stroke_times, n_strokes)
+    if force_norms is None:
+        force_norms = np.linalg.norm(force_stream[:n], axis=1)
+    else:
+        force_norms = force_norms[:n]
+
+    return stroke_means(force_norms, bins, n_strokes)
+
+
+def arc_length(stream: np.ndarray):
+    '''
+    Returns the cumulative distance travelled along a stream, so the length of any
+    stretch of samples is a difference of two entries, see path_length.
+
+        Parameters:
+            stream (np.ndarray): N x d samples, e.g. drill positions
+
+        Returns:
+            arc (np.ndarray): Distance travelled from the first sample up to each sample, arc[0] is 0
+    '''
+
+    stream = np.asarray(stream, dtype=np.float64)
+    steps = np.diff(stream, axis=0)
+    arc = np.zeros(len(stream))
+    np.cumsum(np.sqrt(np.matmul(steps[:, None, :], steps[:, :, None])[:, 0, 0]), out=arc[1:])
+
+    return arc
+
+
+def path_length(arc: np.ndarray, start, stop):
+    '''
+    Returns the distance travelled over samples start to stop, excluding stop as in a slice.
+
+        Parameters:
+            arc (np.ndarray): Result of arc_length
+            start (int or np.ndarray): Index of first sample of each stretch
+            stop (int or np.ndarray): Index after the last sample of each stretch
+
+        Returns:
+            lens (np.ndarray): Length of each stretch, 0 for stretches of fewer than 2 samples
+    '''
+
+    start = np.asarray(start)
+    last = np.maximum(np.asarray(stop) - 1, start)
+
+    return arc[last] - arc[start]
 
-        stroke_mask = [ft >= stroke_times[i] and ft <
-                       stroke_times[i+1] for ft in force_times]
-        stroke_forces = np.linalg.norm(force_stream[stroke_mask[:len(force_stream)]], axis=1)
-        avg_stroke_force.append(np.mean(stroke_forces))
 
-    return np.array(avg_stroke_force)
+def window_length(arc: np.ndarray, timepts: np.ndarray, t_start, t_stop):
+    '''
+    Returns the distance travelled by the samples with t_start <= time < t_stop.
 
+        Parameters:
+            arc (np.ndarray): Result of arc_length
+            timepts (np.ndarray): Sorted time stamps of the samples
+            t_start (float or np.ndarray): Start of each window
+            t_stop (float or np.ndarray): End of each window
 
-def stroke_length(strokes: np.ndarray, stream: np.ndarray):
+        Returns:
+            lens (np.ndarray): Length travelled within each window
+    '''
+
+    start = np.searchsorted(timepts, t_start, side='left')
+    stop = np.searchsorted(timepts, t_stop, side='left')
+
+    return path_length(arc, np.minimum(start, len(arc) - 1), np.maximum(stop, start))
+
+
+def stroke_length(strokes: np.ndarray, stream: np.ndarray, arc: np.ndarray = None):
     '''
     Returns a list of stroke lengths for each stroke of the procedure.
 
         Parameters:
             strokes (np.ndarray): List of 1's and 0's indicating whether a stroke has ended at the timestamp at its index
             stream (np.ndarray): Drill poses over course of procedure
+            arc (np.ndarray): Optional, arc_length of the drill positions if already computed
 
         Returns:
             lens (np.ndarray): Length for each stroke in procedure in units of drill position
     '''
 
-    stream = stream[:, :3]
-
-    lens = []
-    inds = np.insert(np.where(strokes == 1), 0, 0)
-    for i in range(sum(strokes)):
-        stroke_len = 0
-        curr_stroke = stream[inds[i]:inds[i+1]]
-        for j in range(1, len(curr_stroke)):
+    if arc is None:
+        arc = arc_length(stream[:, :3])
 
-            stroke_len += np.linalg.norm(curr_stroke[j-1] - curr_stroke[j])
+    inds = np.insert(np.flatnonzero(np.asarray(strokes) == 1), 0, 0)
 
-        lens.append(stroke_len)
-
-    return np.array(lens)
+    return path_length(arc, inds[:-1], inds[1:])
 
 
 def bone_removal_rate(strokes: np.ndarray, stroke_times: np.ndarray,
-                      stream: np.ndarray, voxel_times: np.ndarray):
+                      stream: np.ndarray, voxel_times: np.ndarray, lengths: np.ndarray = None):
     '''
     Returns a list of bone removal rates representing mean rate of
     each stroke of the procedure.
@@ -160,20 +426,18 @@ def bone_removal_rate(strokes: np.ndarray, stroke_times: np.ndarray,
             stroke_times (np.ndarray): Time stamps of stroke boundaries
             stream (np.ndarray): Drill poses over course of procedure
             voxel_times (np.ndarray): Time stamps of all removed voxels
+            lengths (np.ndarray): Optional, stroke_length of the procedure if already computed
 
         Returns:
             rate (np.ndarray): Average bone removal rate for each stroke in procedure
     '''
 
-    vox_rm = []
-    for i in range(sum(strokes)):
-
-        stroke_voxels = [vt >= stroke_times[i] and vt <
-                         stroke_times[i+1] for vt in voxel_times]
-        vox_rm.append(sum(stroke_voxels))
+    n_strokes = int(np.sum(strokes))
+    vox_rm = stroke_counts(stroke_bins(voxel_times, stroke_times, n_strokes), n_strokes)
 
-    rate = np.divide(np.array(vox_rm), stroke_length(
-        np.array(strokes), stream))
+    if lengths is None:
+        lengths = stroke_length(np.array(strokes), stream)
+    rate = np.divide(vox_rm, lengths)
 
     return rate
 
@@ -195,7 +459,7 @@ def procedure_duration(timepts: np.ndarray):
 
 def drill_orientation(strokes: np.ndarray, stroke_times: np.ndarray,
                       stream: np.ndarray, timepts: np.ndarray,
-                      force_stream: np.ndarray, force_times: np.ndarray):
+                      force_stream: np.ndarray, force_times: np.ndarray, angles=None):
     '''
     Returns a list of drill angles representing mean angle of
     each stroke of the procedure.
@@ -207,57 +471,100 @@ def drill_orientation(strokes: np.ndarray, stroke_times: np.ndarray,
             timepts (np.ndarray): Time stamps of all drill poses
             force_stream (np.ndarray): Force vectors over course of procedure
             force_times (np.ndarray): Time stamps of all force vectors
+            angles (tuple): Optional, procedure_angles of the procedure if already computed
 
         Returns:
             angles (np.ndarray): Average drill angles for each stroke in procedure
     '''
 
-    angles = []
-    angle_times = []
-    normals = []
-    drill_vecs = []
+    if angles is None:
+        angles = procedure_angles(stream, timepts, force_stream, force_times)
+    if angles is None:
+        return np.array([])
+    angles, angle_times = angles
 
-    forces = force_stream[np.linalg.norm(force_stream, axis=1) > 0]
+    n_strokes = int(np.sum(strokes))
+    A = stroke_means(angles, stroke_bins(angle_times, stroke_times, n_strokes), n_strokes)
+    avg_stroke_angle = A[~np.isnan(A)]
+    return avg_stroke_angle
+
+
+def procedure_angles(stream: np.ndarray, timepts: np.ndarray,
+                     force_stream: np.ndarray, force_times: np.ndarray):
+    '''
+    Returns the drill_angles of a procedure above its median non zero force, independent of its strokes
+
+        Parameters:
+            stream (np.ndarray): Drill poses over course of procedure
+            timepts (np.ndarray): Time stamps of all drill poses
+            force_stream (np.ndarray): Force vectors over course of procedure
+            force_times (np.ndarray): Time stamps of all force vectors
+
+        Returns:
+            angles (tuple): Angles and their time stamps as drill_angles returns them, None without force
+    '''
+
+    timepts = np.asarray(timepts)
+    force_times = np.asarray(force_times)
+    force_norms = np.linalg.norm(force_stream, axis=1) if len(force_stream) else np.array([])
+    forces = force_norms[force_norms > 0]
     if len(forces) <= 0:
-        return np.array([])
-    med = np.median(np.linalg.norm(forces, axis=1))
+        return None
+    med = np.median(forces)
 
-    for i, t in enumerate(timepts):
-        ind = np.argmin(np.abs(force_times - t))
-        if np.isclose(np.abs(force_times[ind] - t), 0) and np.linalg.norm(force_stream[ind]) > med:
+    return drill_angles(stream, timepts, force_stream, force_times, med)
 
-            angle_times.append(t)
 
-            normal = force_stream[ind]
-            normal = np.divide(normal, np.linalg.norm(normal))
-            normals.append(normal)
+def drill_angles(stream: np.ndarray, timepts: np.ndarray,
+                 force_stream: np.ndarray, force_times: np.ndarray, med: float):
+    '''
+    Returns the angle between drill and force of every pose with a force sample at
+    the same time that is above the median force.
 
-            v = R.from_quat(stream[i, 3:]).apply([-1, 0, 0])
-            v = np.divide(v, np.linalg.norm(v))
-            drill_vecs.append(v)
+        Parameters:
+            stream (np.ndarray): Drill poses
+            timepts (np.ndarray): Time stamps of the drill poses
+            force_stream (np.ndarray): Force vectors
+            force_times (np.ndarray): Time stamps of the force vectors
+            med (float): Median norm of the non zero force vectors of the procedure
 
-    for i, v in enumerate(drill_vecs):
+        Returns:
+            angles (np.ndarray): Angle of each selected pose in degrees
+            angle_times (np.ndarray): Time stamps of the selected poses
+    '''
 
-        n = normals[i]
+    timepts = np.asarray(timepts)
+    force_times = np.asarray(force_times)
+    if len(force_times) == 0:
+        return np.array([]), timepts[:0]
+    force_norms = np.linalg.norm(force_stream, axis=1)
 
-        angle = (np.arccos(np.clip(np.dot(n, v), -1.0, 1.0)) * (180/np.pi))
-        if angle > 90:
-            angle = 180 - angle
+    # Nearest force sample of every pose, the first recorded one on ties as np.argmin picks it: the stable
+    # sort keeps repeated time stamps in recording order, so the first of each run is the earliest
+    order = np.argsort(force_times, kind='stable')
+    sorted_times = force_times[order]
+    right = np.clip(np.searchsorted(sorted_times, timepts, side='left'), 0, len(order) - 1)
+    right = np.searchsorted(sorted_times, sorted_times[right], side='left')
+    left = np.searchsorted(sorted_times, sorted_times[np.maximum(right - 1, 0)], side='left')
+    d_left = np.abs(sorted_times[left] - timepts)
+    d_right = np.abs(sorted_times[right] - timepts)
+    take_left = (d_left < d_right) | ((d_left == d_right) & (order[left] < order[right]))
+    ind = np.where(take_left, order[left], order[right])
 
-        angles.append(90 - angle)
+    # Only poses with a force sample at the same time and above median force
+    selected = np.isclose(np.abs(force_times[ind] - timepts), 0) & (force_norms[ind] > med)
+    angle_times = timepts[selected]
 
-    avg_stroke_angle = []
-    for i in range(sum(strokes)):
+    normals = force_stream[ind[selected]] / force_norms[ind[selected], None]
 
-        stroke_mask = [at >= stroke_times[i] and at <
-                       stroke_times[i+1] for at in angle_times]
-        stroke_angles = np.array(angles)[stroke_mask]
-        avg_stroke_angle.append(np.mean(stroke_angles)
-                                if sum(stroke_mask) > 0 else np.nan)
+    drill_vecs = R.from_quat(stream[selected, 3:]).apply([-1, 0, 0]) if selected.any() else np.empty((0, 3))
+    drill_vecs = drill_vecs / np.linalg.norm(drill_vecs, axis=1)[:, None]
 
-    A = np.array(avg_stroke_angle)
-    avg_stroke_angle = A[~np.isnan(A)]
-    return avg_stroke_angle
+    angles = np.arccos(np.clip(np.matmul(normals[:, None, :], drill_vecs[:, :, None])[:, 0, 0], -1.0, 1.0)) * (180/np.pi)
+    angles = np.where(angles > 90, 180 - angles, angles)
+    angles = 90 - angles
+
+    return angles, angle_times
 
 
 def get_stroke_indices(stroke_cutoffs):
@@ -272,17 +579,164 @@ def get_stroke_indices(stroke_cutoffs):
     '''
 
     # Find  all indices of stroke_cutoff where the value is a 1
-    indices = []
-    indices.append(0)
-    for i in range(len(stroke_cutoffs)):
-        if stroke_cutoffs[i] == 1:
-            indices.append(i)
-
     # 0 index is always the start of a stroke
-    return indices
+    return [0] + np.flatnonzero(np.asarray(stroke_cutoffs) == 1).tolist()
+
 
+class StrokeTrajectories:
+    '''
+    Drill positions of a procedure split into strokes, stored CSR style: one
+    contiguous positions array, the time stamps and the offsets at which each
+    stroke starts. Velocity, acceleration and jerk are computed per stroke on
+    first use and cached, so every feature reading them shares one pass.
+    '''
 
-def extract_kinematics(drill_pose, timestamps, stroke_indices):
+    def __init__(self, drill_pose, timestamps, stroke_indices, arc=None):
+        '''
+            Parameters:
+                drill_pose (np.ndarray): Drill poses over course of procedure
+                timestamps (np.ndarray): Time stamps of all drill poses
+                stroke_indices (list): Indices of timestamps at which a new stroke is initiated
+                arc (np.ndarray): Optional, arc_length of the drill positions if already computed
+        '''
+        self.positions = np.ascontiguousarray(np.asarray(drill_pose, dtype=np.float64)[:, :3])
+        self.times = np.asarray(timestamps, dtype=np.float64)
+        self.offsets = np.append(np.asarray(stroke_indices, dtype=np.int64), len(self.times))
+        self._derivatives = [self.positions]
+        self._arcs = {} if arc is None else {0: np.asarray(arc)}
+
+        if np.any(np.diff(self.offsets) < 2):
+            raise ValueError("Every stroke needs at least 2 samples to calculate a numerical gradient")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def state(self):
+        '''
+        Returns the arrays of the trajectories, including every derivative and arc length computed so far,
+        as a dict of name -> np.ndarray that from_state turns back into equal trajectories
+        '''
+        state = {'times': self.times, 'offsets': self.offsets}
+        for order, values in enumerate(self._derivatives):
+            state['derivative_%d' % order] = values
+        for order, arc in self._arcs.items():
+            state['arc_%d' % order] = arc
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        '''
+        Returns the trajectories stored by state without recomputing what it holds
+
+            Parameters:
+                state (dict): name -> np.ndarray as returned by state
+        '''
+        trajectories = cls.__new__(cls)
+        trajectories.times = np.asarray(state['times'])
+        trajectories.offsets = np.asarray(state['offsets'])
+        trajectories._derivatives = []
+        while 'derivative_%d' % len(trajectories._derivatives) in state:
+            trajectories._derivatives.append(np.asarray(state['derivative_%d' % len(trajectories._derivatives)]))
+        trajectories.positions = trajectories._derivatives[0]
+        trajectories._arcs = dict((int(name[len('arc_'):]), np.asarray(value))
+                                  for name, value in state.items() if name.startswith('arc_'))
+        return trajectories
+
+    def stroke(self, i):
+        '''
+        Returns the slice of stroke i into positions, times and the derivative arrays
+        '''
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def derivative(self, order):
+        '''
+        Returns the order-th time derivative of the positions, N x 3, taken within each stroke
+        '''
+        while len(self._derivatives) <= order:
+            self._derivatives.append(_stroke_gradient(self._derivatives[-1], self.times, self.offsets))
+        return self._derivatives[order]
+
+    def velocity(self):
+        return self.derivative(1)
+
+    def acceleration(self):
+        return self.derivative(2)
+
+    def jerk(self):
+        return self.derivative(3)
+
+    def durations(self):
+        '''
+        Returns the time spanned by each stroke
+        '''
+        return np.maximum.reduceat(self.times, self.offsets[:-1]) - np.minimum.reduceat(self.times, self.offsets[:-1])
+
+    def arc_length(self, order=0):
+        '''
+        Returns the arc_length of the order-th derivative over the whole procedure
+        '''
+        if order not in self._arcs:
+            self._arcs[order] = arc_length(self.derivative(order))
+        return self._arcs[order]
+
+    def lengths(self, order=0):
+        '''
+        Returns the distance travelled by the order-th derivative within each stroke
+        '''
+        arc = self.arc_length(order)
+        if np.isfinite(arc[-1]):
+            # steps from the last sample of a stroke to the first of the next do not count
+            return path_length(arc, self.offsets[:-1], self.offsets[1:])
+
+        # derivatives are not finite where time stamps repeat, sum the steps of each stroke
+        # on its own so the running sum does not carry that into the following strokes
+        steps = np.linalg.norm(np.diff(self.derivative(order), axis=0), axis=1)
+        steps[self.offsets[1:-1] - 1] = 0
+        return np.add.reduceat(steps, self.offsets[:-1])
+
+    def path_rate(self, order):
+        '''
+        Returns the distance travelled by the order-th derivative within each stroke divided by the stroke duration
+        '''
+        return self.lengths(order) / self.durations()
+
+
+@profiled('derivatives')
+def _stroke_gradient(values, times, offsets):
+    '''
+    np.gradient of values over times applied to every stroke on its own, in one pass
+
+        Parameters:
+            values (np.ndarray): N x 3 samples
+            times (np.ndarray): Time stamps of the samples
+            offsets (np.ndarray): Start index of each stroke followed by N
+
+        Returns:
+            gradient (np.ndarray): N x 3 derivative, one-sided at the ends of each stroke
+    '''
+
+    dx = np.diff(times)
+    out = np.empty_like(values)
+
+    # second order central differences on non-uniform spacing, as np.gradient
+    dx1 = dx[:-1]
+    dx2 = dx[1:]
+    a = (-(dx2)/(dx1 * (dx1 + dx2)))[:, None]
+    b = ((dx2 - dx1) / (dx1 * dx2))[:, None]
+    c = (dx1 / (dx2 * (dx1 + dx2)))[:, None]
+    out[1:-1] = a * values[:-2] + b * values[1:-1] + c * values[2:]
+
+    # first order differences at both ends of every stroke
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1
+    out[starts] = (values[starts + 1] - values[starts]) / dx[starts][:, None]
+    out[ends] = (values[ends] - values[ends - 1]) / dx[ends - 1][:, None]
+
+    return out
+
+
+@profiled('derivatives')
+def extract_kinematics(drill_pose, timestamps, stroke_indices, trajectories=None):
     '''
     Returns mean, median, and max velocity values across all strokes from drill pose data
 
@@ -290,61 +744,18 @@ def extract_kinematics(drill_pose, timestamps, stroke_indices):
         drill_pose (list): Drill pose data directly extracted from hdf5 file
         timestamps (list): Timestamp data directly extracted from hdf5 file
         stroke_indices (list): List of integer indices naming indices of timestamps at which a new stroke is initiated
+        trajectories (StrokeTrajectories): Optional, shared with the other per-stroke features of the procedure
 
     Returns:
         velocities (list): List containing mean, median, and max velocity
         accelerations (list): List containing mean, median, and max acceleration
     '''
 
-    # Extract x, y, and z data from drill pose data
-    x = [i[0] for i in drill_pose]
-    y = [i[1] for i in drill_pose]
-    z = [i[2] for i in drill_pose]
-
-    stroke_vx = []
-    stroke_vy = []
-    stroke_vz = []
-    stroke_t = []
-    stroke_velocities = []
-
-    # Store velocity information for acceleration and calculate average velocity
-    for i in range(len(stroke_indices)):
-        stroke_start = stroke_indices[i]
-        next_stroke = len(timestamps)
-        if i != len(stroke_indices) - 1:
-            next_stroke = stroke_indices[i + 1]
-        # Split up positional data for each stroke
-        stroke_x = x[stroke_start:next_stroke]
-        stroke_y = y[stroke_start:next_stroke]
-        stroke_z = z[stroke_start:next_stroke]
-        t = timestamps[stroke_start:next_stroke]
-
-        stroke_vx.append(np.gradient(stroke_x, t))
-        stroke_vy.append(np.gradient(stroke_y, t))
-        stroke_vz.append(np.gradient(stroke_z, t))
-        stroke_t.append(t)
-
-        # Calculate distance traveled during stroke and use to calculate velocity
-        curr_stroke = [[stroke_x[k], stroke_y[k], stroke_z[k]]
-                       for k in range(len(stroke_x))]
-        dist = 0
-        for l in range(1, len(curr_stroke)):
-            dist += np.linalg.norm(np.subtract(
-                curr_stroke[l], curr_stroke[l - 1]))
-        stroke_velocities.append(dist / np.ptp(t))
-
-    # Calculate average acceleration using velocity information
-    stroke_accelerations = []
-    for i in range(len(stroke_vx)):
-        curr_stroke = [[stroke_vx[i][j], stroke_vy[i][j], stroke_vz[i][j]]
-                       for j in range(len(stroke_vx[i]))]
-        vel = 0
-        for k in range(1, len(curr_stroke)):
-            vel += np.linalg.norm(np.subtract(
-                curr_stroke[k], curr_stroke[k - 1]))
-        stroke_accelerations.append(vel / np.ptp(stroke_t[i]))
-
-    return np.array(stroke_velocities), np.array(stroke_accelerations)
+    if trajectories is None:
+        trajectories = StrokeTrajectories(drill_pose, timestamps, stroke_indices)
+
+    # Distance travelled by the position and by the velocity during each stroke over its duration
+    return trajectories.path_rate(0), trajectories.path_rate(1)
 
 
 def preprocess(drill_pose):
@@ -378,7 +789,8 @@ def preprocess(drill_pose):
     return x, y, z
 
 
-def extract_jerk(drill_pose, timestamps, stroke_indices):
+@profiled('derivatives')
+def extract_jerk(drill_pose, timestamps, stroke_indices, trajectories=None):
     '''
     Returns mean, median, and max jerk across all strokes from drill pose data
 
@@ -386,64 +798,37 @@ def extract_jerk(drill_pose, timestamps, stroke_indices):
         drill_pose (list): Drill pose data directly extracted from hdf5 file
         timestamps (list): Timestamp data directly extracted from hdf5 file
         stroke_indices (list): List of integer indices naming indices of timestamps at which a new stroke is initiated
+        trajectories (StrokeTrajectories): Optional, shared with the other per-stroke features of the procedure
 
     Returns:
         jerks (list): List containing mean, median, and max jerk
     '''
 
-    # Get preprocessed, x, y, and z position data
-    x = [i[0] for i in drill_pose]
-    y = [i[1] for i in drill_pose]
-    z = [i[2] for i in drill_pose]
-
-    stroke_vx = []
-    stroke_vy = []
-    stroke_vz = []
-    stroke_t = []
-
-    # Store velocity information for acceleration
-    for i in range(len(stroke_indices)):
-        stroke_start = stroke_indices[i]
-        next_stroke = len(timestamps)
-        if i != len(stroke_indices) - 1:
-            next_stroke = stroke_indices[i + 1]
-        # Split up positional data for each stroke
-        stroke_x = x[stroke_start:next_stroke]
-        stroke_y = y[stroke_start:next_stroke]
-        stroke_z = z[stroke_start:next_stroke]
-        t = timestamps[stroke_start:next_stroke]
-
-        stroke_vx.append(np.gradient(stroke_x, t))
-        stroke_vy.append(np.gradient(stroke_y, t))
-        stroke_vz.append(np.gradient(stroke_z, t))
-
-        stroke_t.append(t)
-
-    stroke_ax = []
-    stroke_ay = []
-    stroke_az = []
-
-    # Store acceleration information for jerk
-    for i in range(len(stroke_vx)):
-        stroke_ax.append(np.gradient(stroke_vx[i], stroke_t[i]))
-        stroke_ay.append(np.gradient(stroke_vy[i], stroke_t[i]))
-        stroke_az.append(np.gradient(stroke_vz[i], stroke_t[i]))
-
-    # Calculate average jerk using acceleration information
-    stroke_jerks = []
-    for i in range(len(stroke_ax)):
-        curr_stroke = [[stroke_ax[i][j], stroke_ay[i][j], stroke_az[i][j]]
-                       for j in range(len(stroke_ax[i]))]
-        acc = 0
-        for k in range(1, len(curr_stroke)):
-            acc += np.linalg.norm(np.subtract(
-                curr_stroke[k], curr_stroke[k - 1]))
-        stroke_jerks.append(acc / np.ptp(stroke_t[i]))
-
-    return np.array(stroke_jerks)
-
-
-def extract_curvature(drill_pose, timestamps, stroke_indices):
+    if trajectories is None:
+        trajectories = StrokeTrajectories(drill_pose, timestamps, stroke_indices)
+
+    # Distance travelled by the acceleration during each stroke over its duration
+    return trajectories.path_rate(2)
+
+
+def stationary_speed(scale: float, spacing: float):
+    '''
+    Returns the speed below which a drill counts as not moving, the round off
+    np.gradient leaves on constant positions.
+
+        Parameters:
+            scale (float): Largest absolute drill coordinate of the procedure
+            spacing (float): Median time between drill poses
+
+        Returns:
+            speed (float): Stationary speed threshold
+    '''
+
+    return _STATIONARY_TOLERANCE * scale / spacing
+
+
+@profiled('derivatives')
+def extract_curvature(drill_pose, timestamps, stroke_indices, trajectories=None, min_speed=None):
     '''
     Returns mean, median, and max spaciotemporal curvatures across all strokes from drill pose data
 
@@ -451,55 +836,95 @@ def extract_curvature(drill_pose, timestamps, stroke_indices):
         drill_pose (list): Drill pose data directly extracted from hdf5 file
         timestamps (list): Timestamp data directly extracted from hdf5 file
         stroke_indices (list): List of integer indices naming indices of timestamps at which a new stroke is initiated
+        trajectories (StrokeTrajectories): Optional, shared with the other per-stroke features of the procedure
+        min_speed (float): Samples with a speed at or below this are stationary and left out, curvature is
+            undefined there. Defaults to the round off np.gradient leaves on a drill that is not moving
 
     Returns:
-        curvatures (list): List containing mean, median, and max spaciotemporal curvature
-    '''
-
-    # Get preprocessed, x, y, and z position data
-    x = [i[0] for i in drill_pose]
-    y = [i[1] for i in drill_pose]
-    z = [i[2] for i in drill_pose]
-
-    curvatures = []
-    stroke_curvatures = []
-    for i in range(len(stroke_indices)):
-        stroke_start = stroke_indices[i]
-        next_stroke = len(timestamps)
-        if i != len(stroke_indices) - 1:
-            next_stroke = stroke_indices[i + 1]
-
-        # Split up positional data for each stroke
-        stroke_x = x[stroke_start:next_stroke]
-        stroke_y = y[stroke_start:next_stroke]
-        stroke_z = z[stroke_start:next_stroke]
-        stroke_t = timestamps[stroke_start:next_stroke]
-
-        # Calculate velocity and acceleration for each stroke
-        stroke_vx = np.gradient(stroke_x, stroke_t)
-        stroke_vy = np.gradient(stroke_y, stroke_t)
-        stroke_vz = np.gradient(stroke_z, stroke_t)
-        stroke_ax = np.gradient(stroke_vx, stroke_t)
-        stroke_ay = np.gradient(stroke_vy, stroke_t)
-        stroke_az = np.gradient(stroke_vz, stroke_t)
-        curvature = []
-        stroke_t_copy = [t for t in stroke_t]
-
-        for j in range(len(stroke_vx)):
-            # Calculate r' and r'' at specific time point
-            r_prime = [stroke_vx[j], stroke_vy[j], stroke_vz[j]]
-            r_dprime = [stroke_ax[j], stroke_ay[j], stroke_az[j]]
-
-            # Potentially remove
-            if np.linalg.norm(r_prime) == 0:
-                stroke_t_copy.pop(j)
-                continue
-            k = np.linalg.norm(np.cross(r_prime, r_dprime)) / \
-                ((np.linalg.norm(r_prime)) ** 3)
-            curvature.append(k)
-
-        # Average value of function over an interval is integral of function divided by length of interval
-        stroke_curvatures.append(integrate.simpson(
-            curvature, stroke_t_copy) / np.ptp(stroke_t_copy))
-
-    return np.array(stroke_curvatures)
+        curvatures (list): List containing mean, median, and max spaciotemporal curvature, nan for strokes with
+            fewer than 2 moving samples
+    '''
+
+    if trajectories is None:
+        trajectories = StrokeTrajectories(drill_pose, timestamps, stroke_indices)
+
+    if len(trajectories) == 0:
+        return np.array([])
+
+    velocity = trajectories.velocity()
+    acceleration = trajectories.acceleration()
+
+    # k = |r' x r''| / |r'|^3 for every sample at once
+    cross = np.cross(velocity, acceleration)
+    cross_norm = np.sqrt(np.matmul(cross[:, None, :], cross[:, :, None])[:, 0, 0])
+    speed = np.sqrt(np.matmul(velocity[:, None, :], velocity[:, :, None])[:, 0, 0])
+    if min_speed is None:
+        min_speed = stationary_speed(np.max(np.abs(trajectories.positions)), np.median(np.diff(trajectories.times)))
+    moving = speed > min_speed
+    curvature = np.zeros_like(speed)
+    np.divide(cross_norm, speed ** 3, out=curvature, where=moving)
+
+    # Average value of function over an interval is integral of function divided by length of interval
+    selected = np.flatnonzero(moving)
+    strokes = np.searchsorted(trajectories.offsets, selected, side='right') - 1
+    times = trajectories.times[selected]
+    integrals = _stroke_simpson(curvature[selected], times, strokes, len(trajectories))
+
+    counts = np.bincount(strokes, minlength=len(trajectories))
+    spans = np.full(len(trajectories), np.nan)
+    starts = np.cumsum(counts) - counts
+    occupied = counts > 0
+    spans[occupied] = np.maximum.reduceat(times, starts[occupied]) - np.minimum.reduceat(times, starts[occupied])
+
+    return integrals / spans
+
+
+def _stroke_simpson(values, times, strokes, n_strokes):
+    '''
+    integrate.simpson of the samples of every stroke on its own, in one pass
+
+        Parameters:
+            values (np.ndarray): Samples of all strokes, grouped by stroke
+            times (np.ndarray): Time stamps of the samples
+            strokes (np.ndarray): Stroke index of each sample, ascending
+            n_strokes (int): Number of strokes
+
+        Returns:
+            integrals (np.ndarray): Integral of each stroke, nan for strokes with fewer than 2 samples
+    '''
+
+    counts = np.bincount(strokes, minlength=n_strokes)
+    starts = np.cumsum(counts) - counts
+    position = np.arange(len(values)) - starts[strokes]
+    size = counts[strokes]
+
+    # Simpson's rule on irregular spacing over pairs of intervals, as integrate.simpson, which leaves
+    # the last interval of an even number of samples to the correction below
+    first = np.flatnonzero((position % 2 == 0) & (position + 2 <= size - 1 - (size % 2 == 0)))
+    h0 = times[first + 1] - times[first]
+    h1 = times[first + 2] - times[first + 1]
+    hsum = h0 + h1
+    hprod = h0 * h1
+    h0divh1 = np.true_divide(h0, h1, out=np.zeros_like(h0), where=h1 != 0)
+    pairs = hsum / 6.0 * (values[first] * (2.0 - np.true_divide(1.0, h0divh1, out=np.zeros_like(h0divh1),
+                                                                  where=h0divh1 != 0)) +
+                          values[first + 1] * (hsum * np.true_divide(hsum, hprod, out=np.zeros_like(hsum),
+                                                                     where=hprod != 0)) +
+                          values[first + 2] * (2.0 - h0divh1))
+    integrals = np.bincount(strokes[first], weights=pairs, minlength=n_strokes).astype(np.float64)
+
+    # Cartwright's correction for the last interval of strokes with an even number of samples
+    last = (starts + counts - 1)[(counts % 2 == 0) & (counts > 2)]
+    h0 = times[last - 1] - times[last - 2]
+    h1 = times[last] - times[last - 1]
+    alpha = np.true_divide(2 * h1 ** 2 + 3 * h0 * h1, 6 * (h1 + h0), out=np.zeros_like(h0), where=h1 + h0 != 0)
+    beta = np.true_divide(h1 ** 2 + 3.0 * h0 * h1, 6 * h0, out=np.zeros_like(h0), where=h0 != 0)
+    eta = np.true_divide(h1 ** 3, 6 * h0 * (h0 + h1), out=np.zeros_like(h0), where=h0 * (h0 + h1) != 0)
+    integrals[strokes[last]] += alpha * values[last] + beta * values[last - 1] - eta * values[last - 2]
+
+    # the trapezoid of strokes with 2 samples
+    last = (starts + counts - 1)[counts == 2]
+    integrals[strokes[last]] += 0.5 * (times[last] - times[last - 1]) * (values[last] + values[last - 1])
+
+    integrals[counts < 2] = np.nan
+    return integrals
@@ -0,0 +1,358 @@
+import builtins
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+import feature_extraction as ft
+from feature_profiler import profiled
+
+
+# Datasets every feature is computed from, name -> (group, dataset), the first group found is used
+SOURCES = OrderedDict([
+    ('pose', [('data', 'pose_mastoidectomy_drill')]),
+    ('time', [('data', 'time')]),
+    ('force', [('drill_force_feedback', 'wrench'), ('force', 'wrench')]),
+    ('force_time', [('drill_force_feedback', 'time_stamp'), ('force', 'time_stamp')]),
+    ('voxel_time', [('voxels_removed', 'voxel_time_stamp')]),
+    ('voxel_color', [('voxels_removed', 'voxel_color')]),
+])
+
+# Per stroke features of a recording, in the order features() returns them
+FEATURES = ['stroke_count', 'velocity', 'acceleration', 'jerk', 'stroke_force', 'removal_rate',
+            'stroke_length', 'curvature', 'duration', 'drill_angle']
+
+# nodes not stored in a FeatureCache, the datasets themselves, values as cheap to compute as to read
+# and intermediates only the feature built on them needs
+_UNCACHED = set(SOURCES) | {'force_times', 'force_norms', 'pose_angles'}
+
+_nodes = OrderedDict()
+
+
+def node(*dependencies):
+    """
+    register a function computing one node of the graph from the values of its dependencies
+    """
+    def register(fn):
+        _nodes[fn.__name__] = (dependencies, fn)
+        return fn
+    return register
+
+
+def dependents(names):
+    """
+    :return: set of the nodes computed from any of names, names included
+    """
+    found = set(names)
+    for name, (dependencies, _) in _nodes.items():
+        # _nodes is in registration order, which lists dependencies before their dependents
+        if found.intersection(dependencies):
+            found.add(name)
+    return found
+
+
+def requirements(names):
+    """
+    :return: set of the nodes and sources names are computed from, names included
+    """
+    found = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in found:
+            found.add(name)
+            pending.extend(_nodes[name][0] if name in _nodes else [])
+    return found
+
+
+def cache_parameters(k=6, force_time_scale=1.0, sigmas=1.0):
+    """
+    :return: dict of every setting the values of a recording depend on, for FeatureCache.key
+    """
+    return dict(k=k, force_time_scale=force_time_scale, sigmas=sigmas)
+
+
+def pack(values, errors=None):
+    """
+    arrays a FeatureCache stores for node values and errors, tuples of values are left out as their parts are nodes too.
+    Errors from the environment rather than the recording, e.g. MemoryError and OSError, are not stored.
+    :return: dict of name -> array
+    """
+    arrays = {}
+    for name, value in values.items():
+        if name in _UNCACHED or isinstance(value, tuple):
+            continue
+        if isinstance(value, ft.StrokeTrajectories):
+            arrays.update(('%s.%s' % (name, part), array) for part, array in value.state().items())
+        else:
+            arrays[name] = np.asarray(value)
+    for name, error in (errors or {}).items():
+        if name not in _UNCACHED and not isinstance(error, (MemoryError, OSError)):
+            message = error.args[0] if len(error.args) == 1 and isinstance(error.args[0], str) else str(error)
+            arrays['error.' + name] = np.array([type(error).__name__, message])
+    return arrays
+
+
+def unpack(arrays):
+    """
+    values and errors of nodes from arrays stored by pack, errors of types other than builtin ones come back as RuntimeError
+    :return: (dict of name -> value, dict of name -> error)
+    """
+    values = {}
+    errors = {}
+    parts = {}
+    for name, array in arrays.items():
+        if name.startswith('error.'):
+            error = getattr(builtins, str(array[0]), None)
+            if not (isinstance(error, type) and issubclass(error, Exception)):
+                error = RuntimeError
+            errors[name[len('error.'):]] = error(str(array[1]))
+        elif '.' in name:
+            node_name, part = name.split('.', 1)
+            parts.setdefault(node_name, {})[part] = array
+        else:
+            values[name] = array.item() if array.ndim == 0 else array
+    for name, state in parts.items():
+        values[name] = ft.StrokeTrajectories.from_state(state)
+    return values, errors
+
+
+class FeatureExtractor:
+    """
+    Features of one recording computed from a small dependency graph.
+
+    Every node, from the datasets read from the file over the strokes, stroke
+    indices and shared stroke trajectories up to the per stroke features, is
+    computed the first time something asks for it and kept for the session.
+    Asking for all features reads each dataset once and segments the strokes
+    once. A node that failed raises the same error again for everything
+    depending on it instead of being recomputed.
+
+    With a FeatureCache the nodes of an earlier session of the same recording
+    and parameters are loaded instead of computed, and close() stores what the
+    session computed on top of them.
+    """
+    def __init__(self, source, k=6, force_time_scale=1.0, cache=None, sigmas=1.0):
+        """
+        :param source: recorded hdf5 file name, or dict of source name -> array, see SOURCES
+        :param k: k of the k-cosines in get_strokes
+        :param force_time_scale: factor bringing force time stamps to the unit of data/time
+        :param cache: FeatureCache, only used for file sources
+        :param sigmas: standard deviations above the mean k-cosine angle that make a pivot in get_strokes
+        """
+        self.k = k
+        self.sigmas = sigmas
+        self.force_time_scale = force_time_scale
+        self._values = {}
+        self._errors = {}
+        self.file = None
+        self._cache = None
+        self._cached = set()
+        if isinstance(source, dict):
+            self._values.update(source)
+        else:
+            self.file = h5py.File(source, 'r')
+            if cache is not None:
+                self._cache = cache
+                self._cache_key = cache.key(source, **cache_parameters(k, force_time_scale, sigmas))
+                arrays = cache.get(self._cache_key)
+                if arrays is not None:
+                    self._values, self._errors = unpack(arrays)
+                    self._cached = set(arrays)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self._cache is not None:
+            arrays = pack(self._values, self._errors)
+            if not set(arrays) <= self._cached:
+                self._cache.put(self._cache_key, arrays)
+            self._cache = None
+
+    @profiled('hdf5_read')
+    def _read(self, name):
+        for grp, dset in SOURCES[name]:
+            if self.file is not None and grp in self.file and dset in self.file[grp]:
+                return self.file[grp][dset][()]
+        raise KeyError('No dataset for ' + name)
+
+    def get(self, name):
+        """
+        :return: value of a node, computed with its dependencies on first use
+        """
+        if name in self._values:
+            return self._values[name]
+        if name in self._errors:
+            raise self._errors[name]
+
+        try:
+            if name in SOURCES:
+                value = self._read(name)
+            else:
+                dependencies, fn = _nodes[name]
+                value = fn(self, *[self.get(dep) for dep in dependencies])
+        except Exception as e:
+            self._errors[name] = e
+            raise
+
+        self._values[name] = value
+        return value
+
+    def derive(self, values=None, k=None, sigmas=None):
+        """
+        Extractor of the same recording with some nodes replaced, e.g. the strokes of another segmentation.
+        It shares every value and error of this extractor that does not depend on the replaced nodes, so
+        e.g. the datasets and arc lengths are neither read nor computed again. The sources are read
+        here, the derived extractor needs no file and nothing of it is cached.
+        :param values: dict of node name -> value replacing the node
+        :param k: k of the derived extractor, defaults to this one's, another one segments the strokes again
+        :param sigmas: sigmas of the derived extractor, defaults to this one's, another one segments the strokes again
+        :return: FeatureExtractor
+        """
+        for name in SOURCES:
+            try:
+                self.get(name)
+            except Exception:
+                pass
+
+        k = self.k if k is None else k
+        sigmas = self.sigmas if sigmas is None else sigmas
+        values = values or {}
+        replaced = set(values)
+        if (k, sigmas) != (self.k, self.sigmas):
+            replaced.add('strokes')
+        replaced = dependents(replaced)
+
+        derived = FeatureExtractor(dict((name, value) for name, value in self._values.items() if name not in replaced),
+                                   k=k, force_time_scale=self.force_time_scale, sigmas=sigmas)
+        derived._errors.update((name, error) for name, error in self._errors.items() if name not in replaced)
+        derived._values.update(values)
+        return derived
+
+    def features(self, names=FEATURES):
+        """
+        :return: OrderedDict of feature name -> value, the error instead for features that could not be computed
+        """
+        features = OrderedDict()
+        for name in names:
+            try:
+                features[name] = self.get(name)
+            except Exception as e:
+                features[name] = e
+        return features
+
+
+@node('pose', 'time')
+def strokes(fx, pose, time):
+    return ft.get_strokes(pose, time, fx.k, fx.sigmas)
+
+
+@node('strokes')
+def stroke_flags(fx, strokes):
+    return np.asarray(strokes[0])
+
+
+@node('strokes')
+def stroke_times(fx, strokes):
+    return strokes[1]
+
+
+@node('stroke_flags')
+def stroke_count(fx, stroke_flags):
+    return int(np.sum(stroke_flags))
+
+
+@node('stroke_flags')
+def stroke_indices(fx, stroke_flags):
+    return ft.get_stroke_indices(stroke_flags)
+
+
+@node('pose')
+def arc(fx, pose):
+    return ft.arc_length(pose[:, :3])
+
+
+@node('pose', 'time', 'stroke_indices', 'arc')
+def trajectories(fx, pose, time, stroke_indices, arc):
+    return ft.StrokeTrajectories(pose, time, stroke_indices, arc=arc)
+
+
+@node('trajectories')
+def kinematics(fx, trajectories):
+    return ft.extract_kinematics(None, None, None, trajectories=trajectories)
+
+
+@node('kinematics')
+def velocity(fx, kinematics):
+    return kinematics[0]
+
+
+@node('kinematics')
+def acceleration(fx, kinematics):
+    return kinematics[1]
+
+
+@node('trajectories')
+def jerk(fx, trajectories):
+    return ft.extract_jerk(None, None, None, trajectories=trajectories)
+
+
+@node('pose', 'time')
+def min_speed(fx, pose, time):
+    # the default of extract_curvature, independent of the strokes so every segmentation shares it
+    return ft.stationary_speed(np.max(np.abs(np.asarray(pose[:, :3], dtype=np.float64))),
+                               np.median(np.diff(np.asarray(time, dtype=np.float64))))
+
+
+@node('trajectories', 'min_speed')
+def curvature(fx, trajectories, min_speed):
+    return ft.extract_curvature(None, None, None, trajectories=trajectories, min_speed=min_speed)
+
+
+@node('force_time')
+def force_times(fx, force_time):
+    return force_time * fx.force_time_scale
+
+
+@node('force')
+def force_norms(fx, force):
+    return np.linalg.norm(force, axis=1)
+
+
+@node('stroke_flags', 'stroke_times', 'force', 'force_times', 'force_norms')
+def stroke_force(fx, stroke_flags, stroke_times, force, force_times, force_norms):
+    return ft.stroke_force(stroke_flags, stroke_times, force, force_times, force_norms=force_norms)
+
+
+@node('stroke_flags', 'pose', 'arc')
+def stroke_length(fx, stroke_flags, pose, arc):
+    return ft.stroke_length(stroke_flags, pose, arc=arc)
+
+
+@node('stroke_flags', 'stroke_times', 'pose', 'voxel_time', 'stroke_length')
+def removal_rate(fx, stroke_flags, stroke_times, pose, voxel_time, stroke_length):
+    return ft.bone_removal_rate(stroke_flags, stroke_times, pose, voxel_time, lengths=stroke_length)
+
+
+@node('voxel_time')
+def duration(fx, voxel_time):
+    return ft.procedure_duration(voxel_time)
+
+
+@node('pose', 'time', 'force', 'force_times')
+def pose_angles(fx, pose, time, force, force_times):
+    return ft.procedure_angles(pose, time, force, force_times)
+
+
+@node('stroke_flags', 'stroke_times', 'pose', 'time', 'force', 'force_times', 'pose_angles')
+def drill_angle(fx, stroke_flags, stroke_times, pose, time, force, force_times, pose_angles):
+    if pose_angles is None:
+        return np.array([])
+    return ft.drill_orientation(stroke_flags, stroke_times, pose, time, force, force_times, angles=pose_angles)
@@ -0,0 +1,295 @@
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# trace file of the stages, setting it profiles every process that imports the pipeline, e.g. pool workers
+ENVIRONMENT = 'FEATURE_PROFILE'
+# set to 1 to also trace allocations, which slows down Python heavy stages several times
+MEMORY_ENVIRONMENT = 'FEATURE_PROFILE_MEMORY'
+
+# stages in pipeline order, as the summary lists them
+STAGES = ['hdf5_read', 'pivot_angles', 'get_strokes', 'binning', 'derivatives', 'stats_per_stroke']
+
+_registry = []
+_enabled = False
+_memory = False
+_path = None
+_events = []
+_session = None
+_lock = threading.Lock()
+
+
+class _Frames(threading.local):
+    """
+    stack of the stages running on a thread, each thread nests its own calls
+    """
+    def __init__(self):
+        self.stack = []
+
+
+_frames = _Frames()
+
+# wall clock of perf_counter 0, trace time stamps are in wall clock microseconds
+_EPOCH = time.time() - time.perf_counter()
+
+
+def profiled(stage):
+    """
+    decorator marking a function or method as part of a stage of the pipeline
+
+    While profiling is off the function itself is returned, so the hooks cost
+    nothing. enable() replaces the marked functions by timed wrappers where
+    they are defined, which every caller going through the module or class sees.
+    """
+    def register(fn):
+        _registry.append((fn, stage))
+        return _wrap(fn, stage) if _enabled else fn
+    return register
+
+
+def _owner(fn):
+    owner = sys.modules[fn.__module__]
+    for name in fn.__qualname__.split('.')[:-1]:
+        owner = getattr(owner, name)
+    return owner
+
+
+def enable(path, memory=False):
+    """
+    profile from now on, appending the calls of every marked function to a trace file
+    :param path: trace file in the trace event format of chrome://tracing and Perfetto
+    :param memory: record the bytes allocated by each call with tracemalloc
+    """
+    global _enabled, _memory, _path
+    if _enabled:
+        return
+    _enabled = True
+    _memory = memory
+    _path = path
+    os.environ[ENVIRONMENT] = path
+    if memory:
+        os.environ[MEMORY_ENVIRONMENT] = '1'
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    for fn, stage in _registry:
+        owner = _owner(fn)
+        if owner.__dict__.get(fn.__name__) is fn:
+            setattr(owner, fn.__name__, _wrap(fn, stage))
+    atexit.register(flush)
+
+
+def start(path=None, memory=False):
+    """
+    begin the profile of a run, called by the command line tools for their --profile flag
+    :param path: trace file, replaced if it exists, defaults to the FEATURE_PROFILE environment variable
+    :param memory: record allocated bytes, also enabled by the FEATURE_PROFILE_MEMORY environment variable
+    :return: trace file, None if profiling stays off
+    """
+    path = path or os.environ.get(ENVIRONMENT)
+    if not path:
+        return None
+    if os.path.exists(path):
+        os.remove(path)
+    enable(path, memory or _memory_from_environment())
+    return path
+
+
+def _memory_from_environment():
+    return os.environ.get(MEMORY_ENVIRONMENT, '') not in ('', '0')
+
+
+@contextmanager
+def session(name):
+    """
+    attribute the calls within to a recording, the trace is written at the end of each session
+    """
+    global _session
+    if not _enabled:
+        yield
+        return
+    previous, _session = _session, name
+    try:
+        yield
+    finally:
+        _session = previous
+        flush()
+
+
+def _elements(value):
+    if isinstance(value, np.ndarray):
+        return value.size
+    if hasattr(value, 'times') and hasattr(value, 'offsets'):
+        # StrokeTrajectories, counted by their samples
+        return len(value.times)
+    if isinstance(value, tuple):
+        return sum(_elements(v) for v in value)
+    if isinstance(value, list):
+        return len(value)
+    return 0
+
+
+def _wrap(fn, stage):
+    name = fn.__qualname__
+
+    @functools.wraps(fn)
+    def timed(*args, **kwargs):
+        # frame: start, seconds of nested stages, peak traced bytes, traced bytes at start
+        stack = _frames.stack
+        current = 0
+        if _memory:
+            if stack:
+                stack[-1][2] = max(stack[-1][2], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+        frame = [time.perf_counter(), 0.0, current, current]
+        stack.append(frame)
+        result = error = None
+        try:
+            result = fn(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            seconds = time.perf_counter() - frame[0]
+            if _memory:
+                frame[2] = max(frame[2], tracemalloc.get_traced_memory()[1])
+            stack.pop()
+            if stack:
+                stack[-1][1] += seconds
+                stack[-1][2] = max(stack[-1][2], frame[2])
+
+            event_args = OrderedDict([('session', _session),
+                                      ('input_size', sum(_elements(v) for v in args) +
+                                       sum(_elements(v) for v in kwargs.values())),
+                                      ('output_size', _elements(result)),
+                                      ('allocated_bytes', frame[2] - frame[3] if _memory else None),
+                                      ('self_us', round((seconds - frame[1]) * 1e6, 1))])
+            if error is not None:
+                event_args['error'] = error
+            with _lock:
+                _events.append(OrderedDict([('name', name), ('cat', stage), ('ph', 'X'),
+                                            ('ts', round((_EPOCH + frame[0]) * 1e6, 1)),
+                                            ('dur', round(seconds * 1e6, 1)),
+                                            ('pid', os.getpid()), ('tid', threading.get_ident()),
+                                            ('args', event_args)]))
+    return timed
+
+
+def flush():
+    """
+    append the calls recorded so far to the trace file, one write so processes sharing it do not interleave
+    """
+    with _lock:
+        events = _events[:]
+        del _events[:]
+    if not events or _path is None:
+        return
+    try:
+        fd = os.open(_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        os.write(fd, b'[\n')
+        os.close(fd)
+    except FileExistsError:
+        pass
+    data = ''.join(json.dumps(event) + ',\n' for event in events).encode()
+    fd = os.open(_path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def load(path):
+    """
+    :return: list of the events of a trace file
+    """
+    with open(path) as f:
+        text = f.read().strip()
+    if not text:
+        return []
+    # the trace event format allows leaving the array open, as appending writers do
+    return json.loads(text.rstrip(',').rstrip(']').rstrip().rstrip(',') + ']')
+
+
+def summary(events):
+    """
+    :return: OrderedDict of (stage, function) -> OrderedDict of calls, total and self seconds,
+             input and output elements and peak allocated bytes, None if not traced, in pipeline order
+    """
+    rows = {}
+    for event in events:
+        row = rows.setdefault((event['cat'], event['name']), OrderedDict([
+            ('calls', 0), ('seconds', 0.0), ('self_seconds', 0.0), ('input_size', 0), ('output_size', 0),
+            ('allocated_bytes', None)]))
+        row['calls'] += 1
+        row['seconds'] += event['dur'] / 1e6
+        row['self_seconds'] += event['args']['self_us'] / 1e6
+        row['input_size'] += event['args']['input_size']
+        row['output_size'] += event['args']['output_size']
+        if event['args']['allocated_bytes'] is not None:
+            row['allocated_bytes'] = max(row['allocated_bytes'] or 0, event['args']['allocated_bytes'])
+
+    order = dict((stage, idx) for idx, stage in enumerate(STAGES))
+    keys = sorted(rows, key=lambda key: (order.get(key[0], len(STAGES)), -rows[key]['self_seconds']))
+    return OrderedDict((key, rows[key]) for key in keys)
+
+
+def sessions(events):
+    """
+    :return: list of (seconds in profiled stages, session) from slowest to fastest, nested calls counted once
+    """
+    totals = {}
+    for event in events:
+        totals[event['args']['session']] = totals.get(event['args']['session'], 0.0) + event['args']['self_us'] / 1e6
+    return sorted(((seconds, name) for name, seconds in totals.items()), key=lambda item: -item[0])
+
+
+def print_summary(path, slowest=5):
+    """
+    print the summary table of a trace file and its slowest sessions
+    """
+    events = load(path)
+    if not events:
+        print('No profiled calls in', path)
+        return
+
+    print("%-16s %-28s %8s %10s %10s %12s %12s %10s" % (
+        "stage", "function", "calls", "total s", "self s", "in elements", "out elements", "peak MB"))
+    for (stage, name), row in summary(events).items():
+        peak = '-' if row['allocated_bytes'] is None else '%.2f' % (row['allocated_bytes'] / 1e6)
+        print("%-16s %-28s %8d %10.3f %10.3f %12d %12d %10s" % (
+            stage, name, row['calls'], row['seconds'], row['self_seconds'], row['input_size'],
+            row['output_size'], peak))
+
+    print("\n%-10s %s" % ("seconds", "slowest sessions"))
+    for seconds, name in sessions(events)[:slowest]:
+        print("%-10.3f %s" % (seconds, name))
+
+
+def main():
+    parser = ArgumentParser(description='Summary table of a trace file written with --profile or ' + ENVIRONMENT)
+    parser.add_argument('trace', type=str,
+                        help='Trace file')
+    parser.add_argument('--sessions', type=int, default=5,
+                        help='Slowest sessions listed')
+    args = parser.parse_args()
+    print_summary(args.trace, args.sessions)
+
+
+if os.environ.get(ENVIRONMENT):
+    enable(os.environ[ENVIRONMENT], _memory_from_environment())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,48 @@
 import os
 from statistics import median
-import h5py
 import natsort
 import numpy as np
 import feature_extraction as ft
 from rich.progress import track
 from evaluation_metrics import EvaluationMetrics
+import feature_profiler
+from feature_extractor import FeatureExtractor
 
 eval_metrics = EvaluationMetrics()
 
 
-def open_file(file):
-    f = h5py.File(file, 'r')
-
-    data = f['data']
-    v_rm = f['voxels_removed']
-    force = []
-    if 'drill_force_feedback' in f:
-        force = f['drill_force_feedback']
-    elif 'force' in f:
-        force = f['force']
-
-    return data, force, v_rm
-
-
-def validate_stroke_count(f):
-
-    data, _, _ = open_file(f)
+def validate_stroke_count(fx):
 
     try:
-        strokes, stroke_times = ft.get_strokes(
-        data['pose_mastoidectomy_drill'][()], data['time'][()])
-        print('\tstroke count: ', sum(strokes))
-        eval_metrics.strokes.count = eval_metrics.strokes.count + sum(strokes)
+        count = fx.get('stroke_count')
+        print('\tstroke count: ', count)
+        eval_metrics.strokes.count = eval_metrics.strokes.count + count
     except Exception as e:
         print(e)
 
 
-def validate_drill_kinematics(f):
-
-    data, _, _ = open_file(f)
+def validate_drill_kinematics(fx):
 
     try:
-        strokes, stroke_times = ft.get_strokes(
-        data['pose_mastoidectomy_drill'][()], data['time'][()])
-
-        inds = ft.get_stroke_indices(strokes)
-
-        velocities, accelerations = ft.extract_kinematics(
-            data['pose_mastoidectomy_drill'][()], data['time'][()], inds)
-
-        mean, med, maxi, sdev = ft.stats_per_stroke(velocities)
+        mean, med, maxi, sdev = ft.stats_per_stroke(fx.get('velocity'))
         print('\tvelocity: ', med)
         eval_metrics.kinematics.velocity.add_mean(mean)
 
-        mean, med, maxi, sdev = ft.stats_per_stroke(accelerations)
+        mean, med, maxi, sdev = ft.stats_per_stroke(fx.get('acceleration'))
         print('\tacceleration: ', med)
         eval_metrics.kinematics.acceleration.add_mean(mean)
 
-        jerks = ft.extract_jerk(
-            data['pose_mastoidectomy_drill'][()], data['time'][()], inds)
-
-        mean, med, maxi, sdev = ft.stats_per_stroke(jerks)
+        mean, med, maxi, sdev = ft.stats_per_stroke(fx.get('jerk'))
         print('\tjerk: ', med)
         eval_metrics.kinematics.jerk.add_mean(mean)
     except Exception as e:
         print(e)
 
 
-def validate_stroke_force(f):
-
-    data, force, _ = open_file(f)
+def validate_stroke_force(fx):
 
     try:
-        strokes, stroke_times = ft.get_strokes(
-            data['pose_mastoidectomy_drill'][()], data['time'][()])
-
-        mean, med, maxi, sdev = ft.stats_per_stroke(ft.stroke_force(
-            strokes, stroke_times, force['wrench'][()], force['time_stamp'][()]*1e9))
+        mean, med, maxi, sdev = ft.stats_per_stroke(fx.get('stroke_force'))
         eval_metrics.strokes.force.add_mean(mean)
 
         print('\tstroke force: ', maxi)
@@ -85,16 +50,10 @@ def validate_stroke_force(f):
         print(e)
 
 
-def validate_removal_rate(f):
-
-    data, _, v_rm = open_file(f)
+def validate_removal_rate(fx):
 
     try:
-        strokes, stroke_times = ft.get_strokes(
-            data['pose_mastoidectomy_drill'][()], data['time'][()])
-
-        mean, med, _, sdev = ft.stats_per_stroke(ft.bone_removal_rate(
-            strokes, stroke_times, data['pose_mastoidectomy_drill'][()], v_rm['voxel_time_stamp'][()]))
+        mean, med, _, sdev = ft.stats_per_stroke(fx.get('removal_rate'))
         eval_metrics.removal_rate.add_mean(mean)
     except Exception as e:
         print(e)
@@ -103,16 +62,10 @@ def validate_removal_rate(f):
     print('\tbone removal rate: ', med)
 
 
-def validate_stroke_length(f):
-
-    data, _, _ = open_file(f)
+def validate_stroke_length(fx):
 
     try:
-        strokes, stroke_times = ft.get_strokes(
-            data['pose_mastoidectomy_drill'][()], data['time'][()])
-
-        mean, med, maxi, sdev = ft.stats_per_stroke(ft.stroke_length(
-            np.array(strokes), data['pose_mastoidectomy_drill'][()]))
+        mean, med, maxi, sdev = ft.stats_per_stroke(fx.get('stroke_length'))
         eval_metrics.strokes.length.add_mean(mean)
     except Exception as e:
         print(e)
@@ -121,18 +74,15 @@ def validate_stroke_length(f):
     print('\tstroke length: ', med)
 
 
-def validate_curvature(f):
-
-    data, _, _ = open_file(f)
+def validate_curvature(fx):
 
     try:
-        strokes, stroke_times = ft.get_strokes(
-        data['pose_mastoidectomy_drill'][()], data['time'][()])
+        curvatures = fx.get('curvature')
 
-        inds = ft.get_stroke_indices(strokes)
+        # strokes without movement have no curvature
+        curvatures = curvatures[~np.isnan(curvatures)]
 
-        mean, med, maxi, sdev = ft.stats_per_stroke(ft.extract_curvature(
-            data['pose_mastoidectomy_drill'][()], data['time'][()], inds))
+        mean, med, maxi, sdev = ft.stats_per_stroke(curvatures)
         eval_metrics.strokes.curvature.add_mean(mean)
     except Exception as e:
         print(e)
@@ -141,11 +91,10 @@ def validate_curvature(f):
     print('\tcurvature: ', med)
 
 
-def validate_procedure_duration(f):
-    _, _, v_rm = open_file(f)
+def validate_procedure_duration(fx):
 
     try:
-        dur = ft.procedure_duration(v_rm['voxel_time_stamp'][()])
+        dur = fx.get('duration')
         eval_metrics.duration = eval_metrics.duration + dur
     except:
         dur = 0
@@ -153,16 +102,10 @@ def validate_procedure_duration(f):
     print('\tduration: ', dur)
 
 
-def validate_drill_angle(f):
-
-    data, force, _ = open_file(f)
+def validate_drill_angle(fx):
 
     try:
-        strokes, stroke_times = ft.get_strokes(
-        data['pose_mastoidectomy_drill'][()], data['time'][()])
-
-        mean, med, maxi, sdev = ft.stats_per_stroke(ft.drill_orientation(
-            strokes, stroke_times, data['pose_mastoidectomy_drill'][()], data['time'][()], force['wrench'][()], force['time_stamp'][()]*1e9))
+        mean, med, maxi, sdev = ft.stats_per_stroke(fx.get('drill_angle'))
 
         print('\tangles:')
         print('\t\tmean: ', mean)
@@ -173,11 +116,10 @@ def validate_drill_angle(f):
         print(e)
 
 
-def validate_sensitive_voxels_removed(f):
-    _, _, vrm = open_file(f)
+def validate_sensitive_voxels_removed(fx):
 
     try:
-        cnt = eval_metrics.check_voxels_removed(vrm['voxel_color'][()])
+        cnt = eval_metrics.check_voxels_removed(fx.get('voxel_color'))
         print('\t\tsensitive voxels removed: ', cnt)
     except Exception as e:
         print(e)
@@ -217,14 +159,16 @@ def main():
 
         print('\nNow testing: ', files[i])
 
-        validate_stroke_count(files[i])
-        validate_drill_kinematics(files[i])
-        validate_stroke_force(files[i])
-        validate_removal_rate(files[i])
-        validate_stroke_length(files[i])
-        validate_curvature(files[i])
-        validate_procedure_duration(files[i])
-        validate_drill_angle(files[i])
+        # validation recordings store force time stamps in seconds and data/time in nanoseconds
+        with feature_profiler.session(files[i]), FeatureExtractor(files[i], force_time_scale=1e9) as fx:
+            validate_stroke_count(fx)
+            validate_drill_kinematics(fx)
+            validate_stroke_force(fx)
+            validate_removal_rate(fx)
+            validate_stroke_length(fx)
+            validate_curvature(fx)
+            validate_procedure_duration(fx)
+            validate_drill_angle(fx)
 
     print('Validation complete!')
     eval_metrics.print()
@@ -0,0 +1,102 @@
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+import feature_extraction as ft
+
+
+class LiveReader:
+    """
+    Follows a file that data_record.py is still writing with --swmr.
+
+    poll() returns the rows appended since the previous poll. Datasets of a
+    group are appended one after another, so only the rows every dataset of
+    the group already has are returned; the rest follow with the next poll.
+    """
+    def __init__(self, file_name, groups=('data', 'voxels_removed', 'burr_change', 'force')):
+        self.file = h5py.File(file_name, 'r', libver='latest', swmr=True)
+        self.groups = groups
+        self._rows = {}
+
+    def recording(self):
+        """
+        :return: False once the recorder closed the file
+        """
+        metadata = self.file['metadata']
+        if 'recording' not in metadata:
+            return False
+        metadata['recording'].refresh()
+        return bool(metadata['recording'][()])
+
+    def poll(self):
+        """
+        :return: OrderedDict of group -> OrderedDict of dataset -> new rows, groups without new rows are left out
+        """
+        new_data = OrderedDict()
+        for grp in self.groups:
+            if grp not in self.file:
+                continue
+            datasets = list(self.file[grp].values())
+            for dset in datasets:
+                dset.refresh()
+            if not datasets:
+                continue
+
+            start = self._rows.get(grp, 0)
+            stop = min(len(dset) for dset in datasets)
+            if stop <= start:
+                continue
+
+            new_data[grp] = OrderedDict((dset.name.split('/')[-1], dset[start:stop]) for dset in datasets)
+            self._rows[grp] = stop
+
+        return new_data
+
+    def follow(self, interval=0.5):
+        """
+        yield new rows every interval seconds until the recording has ended and everything was read
+        """
+        while True:
+            recording = self.recording()  # checked first, so rows written before closing are not missed
+            new_data = self.poll()
+            if new_data:
+                yield new_data
+            elif not recording:
+                return
+            else:
+                time.sleep(interval)
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    parser = ArgumentParser(description='Follow a recording made with data_record.py --swmr')
+    parser.add_argument('--file', required=True, type=str)
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='Seconds between polls for new rows')
+    args = parser.parse_args()
+
+    reader = LiveReader(args.file)
+    data = OrderedDict()
+    for new_data in reader.follow(args.interval):
+        for grp, datasets in new_data.items():
+            target = data.setdefault(grp, OrderedDict())
+            for dset, values in datasets.items():
+                target.setdefault(dset, []).append(values)
+        rows = dict((grp, sum(len(v) for v in next(iter(d.values())))) for grp, d in data.items())
+        print('Rows read', rows, end='\r')
+    reader.close()
+    print()
+
+    pose = np.concatenate(data['data']['pose_mastoidectomy_drill'])
+    timepts = np.concatenate(data['data']['time'])
+    strokes, stroke_times = ft.get_strokes(pose, timepts)
+    print('Recording finished, stroke count', sum(strokes))
+
+
+if __name__ == "__main__":
+    main()
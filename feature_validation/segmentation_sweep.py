@@ -0,0 +1,131 @@
+import csv
+import os
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import feature_extraction as ft
+from batch_features import columns, feature_rows, find_recordings
+from feature_extractor import FeatureExtractor, FEATURES, dependents, requirements
+
+
+KS = [4, 5, 6, 7, 8, 10, 12, 14, 17, 20]
+SIGMAS = [0.5, 0.75, 1.0, 1.25, 1.5]
+
+
+def sweep(source, ks=KS, sigmas=SIGMAS, names=FEATURES, force_time_scale=1.0):
+    """
+    features of a recording for every stroke segmentation of a grid of k and sigmas, see get_strokes
+
+    The datasets are read once, and every node that does not depend on the strokes,
+    e.g. arc lengths, force norms, drill angles and the stationary speed, is computed once
+    for all settings. The position norms of the k-cosines are shared by every k, the pivot
+    angles of a k by all its sigmas, and settings segmenting the same strokes share their
+    features. The derivatives, curvatures and binning of every distinct segmentation are
+    still computed anew, about half a single extraction each, so on recordings where most
+    settings segment differently the default grid costs some 25 single extractions,
+    see the sweep timing of feature_benchmark.py.
+    :param source: recorded hdf5 file name, or dict of source name -> array, see FeatureExtractor
+    :param names: features computed for every setting
+    :return: OrderedDict of (k, sigmas) -> OrderedDict of feature name -> value, the error instead
+             for features that could not be computed
+    """
+    results = OrderedDict()
+    with FeatureExtractor(source, k=ks[0], force_time_scale=force_time_scale, sigmas=sigmas[0]) as base:
+        for name in sorted(requirements(names) - dependents(['strokes'])):
+            try:
+                base.get(name)
+            except Exception:
+                pass
+
+        try:
+            pose, timepts = base.get('pose'), base.get('time')
+            norms = ft.position_norms(pose)
+        except Exception:
+            pose = None
+
+        segmented = {}
+        for k in ks:
+            angles = None
+            if pose is not None:
+                try:
+                    angles = ft.pivot_angles(pose, k, norms=norms)
+                except Exception:
+                    pass
+            for s in sigmas:
+                strokes = None
+                if angles is not None:
+                    try:
+                        strokes = ft.strokes_from_angles(timepts, angles, k, s)
+                    except Exception:
+                        pass
+                if strokes is None:
+                    # segmented again by the derived extractor, which keeps the error for the features
+                    results[k, s] = base.derive(k=k, sigmas=s).features(names)
+                    continue
+
+                # equal stroke ends give equal stroke times, so the flags identify the segmentation
+                key = np.asarray(strokes[0]).tobytes()
+                if key not in segmented:
+                    segmented[key] = base.derive({'strokes': strokes}, k=k, sigmas=s).features(names)
+                results[k, s] = OrderedDict(segmented[key])
+    return results
+
+
+def sweep_recording(path, ks, sigmas, force_time_scale):
+    """
+    worker entry point, computes the table rows of one recording
+    :return: list of OrderedDict rows, one per setting, failures are reported in the errors column instead of raised
+    """
+    settings = OrderedDict(((k, s), OrderedDict([('k', k), ('sigmas', s)])) for k in ks for s in sigmas)
+    return feature_rows(path, lambda: sweep(path, ks, sigmas, force_time_scale=force_time_scale), settings)
+
+
+def main():
+    parser = ArgumentParser(description='Features of many recordings for every stroke segmentation of a grid '
+                                        'of k-cosine k and pivot thresholds')
+    parser.add_argument('inputs', nargs='+', type=str,
+                        help='Directories searched recursively for hdf5 files, hdf5 files or glob patterns')
+    parser.add_argument('--output', type=str, default='segmentation_sweep.csv',
+                        help='Feature table, one row per recording and setting')
+    parser.add_argument('--k', nargs='+', type=int, default=KS,
+                        help='k of the k-cosines used to segment strokes')
+    parser.add_argument('--sigmas', nargs='+', type=float, default=SIGMAS,
+                        help='Standard deviations above the mean k-cosine angle that make a pivot')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Worker processes, each sweeps one recording at a time')
+    parser.add_argument('--force_time_scale', type=float, default=1.0,
+                        help='Factor bringing force time stamps to the unit of data/time, 1e9 for the validation files')
+    args = parser.parse_args()
+
+    paths = find_recordings(args.inputs)
+    if not paths:
+        print('No recordings found')
+        return
+    print('Sweeping %d settings of %d recordings with %d workers' % (len(args.k) * len(args.sigmas), len(paths),
+                                                                     args.workers))
+
+    start = time.time()
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(sweep_recording, path, args.k, args.sigmas, args.force_time_scale)
+                   for path in paths]
+        for idx, future in enumerate(futures):
+            recording = future.result()
+            rows.extend(recording)
+            print('[%d/%d] %s %.2fs' % (idx + 1, len(paths), paths[idx], recording[0].get('seconds', 0.0)))
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns(['file', 'k', 'sigmas', 'seconds']), restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    failed = sum(1 for row in rows if row['errors'])
+    print('Wrote %s, %d rows in %.1fs, %d with errors' % (args.output, len(rows), time.time() - start, failed))
+
+
+if __name__ == "__main__":
+    main()
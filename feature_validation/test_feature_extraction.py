@@ -0,0 +1,735 @@
+import glob
+import hashlib
+import math
+import os
+import shutil
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+import pytest
+from scipy import integrate
+from scipy.spatial.transform import Rotation as R
+
+import feature_cache
+import feature_extraction as ft
+import feature_profiler
+from batch_features import extraction_failed, feature_rows
+from chunked_features import extract_chunked
+from feature_cache import FeatureCache, content_hash
+from feature_benchmark import synthetic_session
+from feature_extractor import FEATURES, SOURCES, FeatureExtractor, cache_parameters, dependents, pack, unpack
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def read_recording(path):
+    """
+    :return: pose and time of a recording, skips the test for recordings without them
+    """
+    with h5py.File(path, 'r') as f:
+        arrays = []
+        for name in ['pose', 'time']:
+            found = [f[grp][dset][()] for grp, dset in SOURCES[name] if grp in f and dset in f[grp]]
+            if not found or len(found[0]) == 0:
+                pytest.skip('%s has no %s data' % (os.path.basename(path), name))
+            arrays.append(found[0])
+    return arrays
+
+
+def noisy_session(seed, n=20000, stroke_samples=300):
+    """
+    synthetic procedure with hand tremor on the positions, so pivot angles spread like in a recording
+    """
+    rng = np.random.default_rng(seed)
+    session, _ = synthetic_session(n, stroke_samples)
+    session['pose'][:, :3] += rng.normal(0, 1e-4, (n, 3))
+    return session['pose'], session['time']
+
+
+SESSIONS = [pytest.param(lambda path=path: read_recording(path), id=os.path.basename(path))
+            for path in sorted(glob.glob(os.path.join(DATA_DIR, '*.hdf5')))]
+SESSIONS += [pytest.param(lambda seed=seed: noisy_session(seed), id='synthetic_%d' % seed) for seed in range(3)]
+
+
+def reference_strokes(stream, timepts, k=6):
+    """
+    per sample get_strokes the vectorised one replaced
+    """
+    stream = stream[:, :3]
+    X_P = []
+
+    for j, P in enumerate(stream):
+        if (j - k < 0) or (j + k >= stream.shape[0]):
+            continue
+
+        P_a = stream[j - k]
+        P_c = stream[j + k]
+
+        k_cos = np.dot(P_a, P_c) / (np.linalg.norm(P_a) * np.linalg.norm(P_c))
+        k_cos = max(min(k_cos, 1), -1)
+        X_P.append(180 - (math.acos(k_cos) * (180/np.pi)))
+
+    mu = np.mean(X_P)
+    sig = np.std(X_P)
+
+    for i in range(k):
+        X_P.insert(0, mu)
+        X_P.append(mu)
+
+    F_c = [1 if x_P > mu + sig else 0 for x_P in X_P]
+
+    j = 0
+    for i in range(1, len(F_c)):
+        if F_c[i] == 1 and F_c[i-1] == 0:
+            j += 1
+        elif sum(F_c[i:i+k]) == 0 and j != 0:
+            ind = math.floor(j/2)
+            F_c[i-j:i] = [0] * j
+            F_c[i-ind] = 1
+            j = 0
+        elif j != 0:
+            j += 1
+
+    st = np.insert(timepts[[s == 1 for s in F_c]], 0, min(timepts))
+
+    return F_c, st
+
+
+@pytest.mark.parametrize('session', SESSIONS)
+@pytest.mark.parametrize('k', [4, 6, 10])
+def test_get_strokes_matches_reference(session, k):
+    pose, timepts = session()
+
+    flags, stroke_times = ft.get_strokes(pose, timepts, k)
+    expected_flags, expected_times = reference_strokes(pose, timepts, k)
+
+    np.testing.assert_array_equal(flags, expected_flags)
+    np.testing.assert_array_equal(stroke_times, expected_times)
+
+
+def reference_curvature(drill_pose, timestamps, stroke_indices, min_speed):
+    """
+    per sample extract_curvature the vectorised one replaced, with the time stamps of stationary samples
+    left out alongside their curvature and nan for strokes with fewer than 2 moving samples
+    """
+    x = [i[0] for i in drill_pose]
+    y = [i[1] for i in drill_pose]
+    z = [i[2] for i in drill_pose]
+
+    stroke_curvatures = []
+    for i in range(len(stroke_indices)):
+        stroke_start = stroke_indices[i]
+        next_stroke = len(timestamps)
+        if i != len(stroke_indices) - 1:
+            next_stroke = stroke_indices[i + 1]
+
+        stroke_x = x[stroke_start:next_stroke]
+        stroke_y = y[stroke_start:next_stroke]
+        stroke_z = z[stroke_start:next_stroke]
+        stroke_t = timestamps[stroke_start:next_stroke]
+
+        stroke_vx = np.gradient(stroke_x, stroke_t)
+        stroke_vy = np.gradient(stroke_y, stroke_t)
+        stroke_vz = np.gradient(stroke_z, stroke_t)
+        stroke_ax = np.gradient(stroke_vx, stroke_t)
+        stroke_ay = np.gradient(stroke_vy, stroke_t)
+        stroke_az = np.gradient(stroke_vz, stroke_t)
+        curvature = []
+        moving_t = []
+
+        for j in range(len(stroke_vx)):
+            r_prime = [stroke_vx[j], stroke_vy[j], stroke_vz[j]]
+            r_dprime = [stroke_ax[j], stroke_ay[j], stroke_az[j]]
+
+            if np.linalg.norm(r_prime) <= min_speed:
+                continue
+            k = np.linalg.norm(np.cross(r_prime, r_dprime)) / \
+                ((np.linalg.norm(r_prime)) ** 3)
+            curvature.append(k)
+            moving_t.append(stroke_t[j])
+
+        if len(moving_t) < 2:
+            stroke_curvatures.append(np.nan)
+            continue
+        stroke_curvatures.append(integrate.simpson(curvature, x=moving_t) / np.ptp(moving_t))
+
+    return np.array(stroke_curvatures)
+
+
+def resting_session(seed):
+    """
+    synthetic procedure with jittered time stamps, a stroke the drill rests through and a stroke it pauses in
+    :return: pose, time and stroke indices
+    """
+    rng = np.random.default_rng(seed)
+    pose, timepts = noisy_session(seed, n=5000)
+    timepts = timepts + rng.uniform(0, 2e-4, len(timepts))
+    pose[1000:1400] = pose[1000]
+    pose[2100:2200] = pose[2100]
+    return pose, timepts, [0, 700, 1000, 1400, 2000, 2600, 4000]
+
+
+@pytest.mark.parametrize('session', SESSIONS)
+def test_curvature_matches_reference(session):
+    pose, timepts = session()
+    indices = ft.get_stroke_indices(ft.get_strokes(pose, timepts)[0])
+    min_speed = ft.stationary_speed(np.max(np.abs(pose[:, :3])), np.median(np.diff(timepts)))
+
+    curvatures = ft.extract_curvature(pose, timepts, indices)
+
+    np.testing.assert_allclose(curvatures, reference_curvature(pose, timepts, indices, min_speed), rtol=1e-10)
+    assert np.all(np.isfinite(curvatures))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_curvature_of_resting_drill(seed):
+    pose, timepts, indices = resting_session(seed)
+    min_speed = ft.stationary_speed(np.max(np.abs(pose[:, :3])), np.median(np.diff(timepts)))
+
+    curvatures = ft.extract_curvature(pose, timepts, indices)
+
+    np.testing.assert_allclose(curvatures, reference_curvature(pose, timepts, indices, min_speed), rtol=1e-10)
+    # the resting stroke has no curvature, the paused one is averaged over its moving samples only
+    assert np.isnan(curvatures[2])
+    assert np.all(np.isfinite(np.delete(curvatures, 2)))
+
+
+def binning_session(seed):
+    """
+    sample times from before the first stroke to after the last one, with a stroke no sample falls into
+    and one of zero duration
+    :return: times, values and stroke times
+    """
+    rng = np.random.default_rng(seed)
+    times = np.sort(rng.uniform(0, 10, 2000))
+    times = times[(times < 6) | (times >= 6.5)]
+    stroke_times = np.sort(np.concatenate([rng.uniform(1, 9, 12), [6.1, 6.2, 7.0, 7.0]]))
+    return times, rng.normal(size=len(times)), stroke_times
+
+
+def reference_binning(times, values, stroke_times):
+    """
+    per stroke masks the binning helpers replaced
+    :return: stroke of each sample, count and mean of each stroke
+    """
+    bins = np.full(len(times), -1)
+    counts = []
+    means = []
+    for i in range(len(stroke_times) - 1):
+        stroke_mask = np.array([t >= stroke_times[i] and t < stroke_times[i + 1] for t in times])
+        bins[stroke_mask] = i
+        counts.append(sum(stroke_mask))
+        means.append(np.mean(values[stroke_mask]) if sum(stroke_mask) > 0 else np.nan)
+    return bins, np.array(counts), np.array(means)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_binning_matches_reference(seed):
+    times, values, stroke_times = binning_session(seed)
+    n_strokes = len(stroke_times) - 1
+    expected_bins, expected_counts, expected_means = reference_binning(times, values, stroke_times)
+
+    bins = ft.stroke_bins(times, stroke_times, n_strokes)
+
+    np.testing.assert_array_equal(bins, expected_bins)
+    np.testing.assert_array_equal(ft.stroke_counts(bins, n_strokes), expected_counts)
+    np.testing.assert_allclose(ft.stroke_means(values, bins, n_strokes), expected_means, rtol=1e-12)
+    # samples before the first and after the last stroke, an empty and a zero length stroke
+    assert bins[0] == -1 and bins[-1] == -1
+    assert np.count_nonzero(expected_counts == 0) >= 2
+
+
+def short_stroke_session(seed):
+    """
+    synthetic procedure with jittered time stamps and strokes of 2 and 3 samples, the last one included
+    :return: pose, time and stroke indices
+    """
+    rng = np.random.default_rng(seed)
+    pose, timepts = noisy_session(seed, n=3000)
+    timepts = timepts + rng.uniform(0, 2e-4, len(timepts))
+    return pose, timepts, [0, 500, 502, 900, 903, 1700, 2998]
+
+
+def reference_gradients(drill_pose, timestamps, stroke_indices, orders=3):
+    """
+    per stroke np.gradient the stroke container replaced
+    :return: list of the N x 3 derivatives of order 1 to orders
+    """
+    bounds = list(stroke_indices) + [len(timestamps)]
+    derivatives = []
+    values = np.asarray(drill_pose)[:, :3]
+    for _ in range(orders):
+        values = np.concatenate([np.stack([np.gradient(values[start:stop, axis], timestamps[start:stop])
+                                           for axis in range(3)], axis=1)
+                                 for start, stop in zip(bounds[:-1], bounds[1:])])
+        derivatives.append(values)
+    return derivatives
+
+
+def reference_path_rate(values, timestamps, stroke_indices):
+    """
+    per stroke summed distance over duration, as extract_kinematics and extract_jerk computed it
+    """
+    bounds = list(stroke_indices) + [len(timestamps)]
+    rates = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        dist = 0
+        for l in range(start + 1, stop):
+            dist += np.linalg.norm(np.subtract(values[l], values[l - 1]))
+        rates.append(dist / np.ptp(timestamps[start:stop]))
+    return np.array(rates)
+
+
+def with_strokes(pose, timepts):
+    return pose, timepts, ft.get_stroke_indices(ft.get_strokes(pose, timepts)[0])
+
+
+def derivative_sessions():
+    for session in SESSIONS:
+        yield pytest.param(lambda session=session.values[0]: with_strokes(*session()), id=session.id)
+    for seed in range(3):
+        yield pytest.param(lambda seed=seed: short_stroke_session(seed), id='short_strokes_%d' % seed)
+
+
+@pytest.mark.parametrize('session', list(derivative_sessions()))
+def test_stroke_gradient_matches_reference(session):
+    pose, timepts, indices = session()
+
+    trajectories = ft.StrokeTrajectories(pose, timepts, indices)
+
+    for order, expected in enumerate(reference_gradients(pose, timepts, indices), 1):
+        np.testing.assert_allclose(trajectories.derivative(order), expected,
+                                   rtol=1e-9, atol=1e-12 * np.max(np.abs(expected)))
+
+
+@pytest.mark.parametrize('session', list(derivative_sessions()))
+def test_kinematics_and_jerk_match_reference(session):
+    pose, timepts, indices = session()
+    velocity, acceleration, _ = reference_gradients(pose, timepts, indices)
+
+    speeds, accelerations = ft.extract_kinematics(pose, timepts, indices)
+    jerks = ft.extract_jerk(pose, timepts, indices)
+
+    for rates, values in [(speeds, pose[:, :3]), (accelerations, velocity), (jerks, acceleration)]:
+        expected = reference_path_rate(values, timepts, indices)
+        # the acceleration of a 3 sample stroke is constant up to round off
+        np.testing.assert_allclose(rates, expected, rtol=1e-9, atol=1e-12 * np.max(expected))
+
+
+def test_single_sample_stroke_has_no_gradient():
+    pose, timepts, _ = short_stroke_session(0)
+    indices = [0, 500, 501, 2999]
+
+    # np.gradient needs 2 samples per stroke, so does the container
+    with pytest.raises((ValueError, IndexError)):
+        reference_gradients(pose, timepts, indices)
+    with pytest.raises(ValueError):
+        ft.StrokeTrajectories(pose, timepts, indices)
+
+
+def reference_stroke_length(strokes, stream):
+    """
+    per stroke summed step norms the arc length differences replaced
+    """
+    stream = stream[:, :3]
+
+    lens = []
+    inds = np.insert(np.where(strokes == 1), 0, 0)
+    for i in range(sum(strokes)):
+        stroke_len = 0
+        curr_stroke = stream[inds[i]:inds[i+1]]
+        for j in range(1, len(curr_stroke)):
+            stroke_len += np.linalg.norm(curr_stroke[j-1] - curr_stroke[j])
+        lens.append(stroke_len)
+    return np.array(lens)
+
+
+def length_sessions():
+    for session in SESSIONS:
+        yield pytest.param(lambda session=session.values[0]: session()[0], ft.get_strokes, id=session.id)
+    for seed in range(3):
+        # strokes of a single sample, the last stroke ending on the last sample
+        flags = np.zeros(3000, dtype=int)
+        flags[[400, 401, 1200, 1203, 1204, 2999]] = 1
+        yield pytest.param(lambda seed=seed: noisy_session(seed, n=3000)[0], lambda pose, _: (flags, None),
+                           id='short_strokes_%d' % seed)
+
+
+@pytest.mark.parametrize('session, segment', list(length_sessions()))
+def test_stroke_length_matches_reference(session, segment):
+    pose = session()
+    strokes = segment(pose, np.arange(len(pose), dtype=np.float64))[0]
+
+    lengths = ft.stroke_length(strokes, pose)
+
+    np.testing.assert_allclose(lengths, reference_stroke_length(strokes, pose), rtol=1e-9, atol=1e-15)
+    assert len(lengths) == np.sum(strokes)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_path_length_matches_summed_steps(seed):
+    rng = np.random.default_rng(seed)
+    pose, _ = noisy_session(seed, n=3000)
+    starts = np.concatenate([rng.integers(0, 3000, 50), [0, 2999, 1500]])
+    stops = np.minimum(starts + np.concatenate([rng.integers(0, 500, 50), [3000, 1, 1]]), 3000)
+
+    lengths = ft.path_length(ft.arc_length(pose[:, :3]), starts, stops)
+
+    expected = [np.sum(np.linalg.norm(np.diff(pose[start:stop, :3], axis=0), axis=1))
+                for start, stop in zip(starts, stops)]
+    np.testing.assert_allclose(lengths, expected, rtol=1e-9, atol=1e-15)
+
+
+def reference_drill_angles(stream, timepts, force_stream, force_times, med):
+    """
+    per pose np.argmin over the force time stamps drill_angles replaced
+    """
+    angles = []
+    angle_times = []
+    for i, t in enumerate(timepts):
+        ind = np.argmin(np.abs(force_times - t))
+        if np.isclose(np.abs(force_times[ind] - t), 0) and np.linalg.norm(force_stream[ind]) > med:
+            angle_times.append(t)
+            normal = force_stream[ind] / np.linalg.norm(force_stream[ind])
+            v = R.from_quat(stream[i, 3:]).apply([-1, 0, 0])
+            v = v / np.linalg.norm(v)
+            angle = np.arccos(np.clip(np.dot(normal, v), -1.0, 1.0)) * (180/np.pi)
+            if angle > 90:
+                angle = 180 - angle
+            angles.append(90 - angle)
+    return np.array(angles), np.array(angle_times)
+
+
+def force_session(seed, shuffled):
+    """
+    poses and force samples whose time stamps repeat, each repeat with a different force, some of them
+    just before the pose time so the nearest one is the last of a run, poses between two force samples
+    at equal distance and poses after the last, repeated, force sample
+    :return: pose, time, force and force time
+    """
+    rng = np.random.default_rng(seed)
+    timepts = np.arange(500) * 0.01
+    pose = np.concatenate([rng.normal(size=(500, 3)), rng.normal(size=(500, 4))], axis=1)
+    early = np.repeat(timepts[3::5] - 1e-10, 3)
+    force_times = np.sort(np.concatenate([rng.choice(timepts[:490], 600), early, timepts[::7] + 0.005,
+                                          np.repeat(timepts[489], 3)]))
+    if shuffled:
+        force_times = rng.permutation(force_times)
+    force_stream = rng.normal(size=(len(force_times), 3))
+    force_stream[rng.integers(0, len(force_times), 50)] = 0
+    return pose, timepts, force_stream, force_times
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('shuffled', [False, True])
+def test_drill_angles_match_reference(seed, shuffled):
+    pose, timepts, force_stream, force_times = force_session(seed, shuffled)
+    norms = np.linalg.norm(force_stream, axis=1)
+    med = np.median(norms[norms > 0])
+    assert len(np.unique(force_times)) < len(force_times)
+
+    angles, angle_times = ft.drill_angles(pose, timepts, force_stream, force_times, med)
+
+    expected_angles, expected_times = reference_drill_angles(pose, timepts, force_stream, force_times, med)
+    np.testing.assert_array_equal(angle_times, expected_times)
+    np.testing.assert_allclose(angles, expected_angles, rtol=1e-9, atol=1e-12)
+
+
+def extractor_session(seed):
+    """
+    synthetic recording with tremor on the positions and force, as the dict source of a FeatureExtractor
+    """
+    rng = np.random.default_rng(seed)
+    session, _ = synthetic_session(6000, 300)
+    session['pose'][:, :3] += rng.normal(0, 1e-4, (6000, 3))
+    session['force'] += rng.normal(0, 0.05, session['force'].shape)
+    return session
+
+
+def reference_features(session, strokes):
+    """
+    every feature computed on its own from the feature_extraction functions, as before the node graph
+    """
+    pose, timepts = session['pose'], session['time']
+    flags, stroke_times = strokes
+    indices = ft.get_stroke_indices(flags)
+    velocity, acceleration = ft.extract_kinematics(pose, timepts, indices)
+    return dict(stroke_count=int(np.sum(flags)), velocity=velocity, acceleration=acceleration,
+                jerk=ft.extract_jerk(pose, timepts, indices),
+                stroke_force=ft.stroke_force(flags, stroke_times, session['force'], session['force_time']),
+                removal_rate=ft.bone_removal_rate(flags, stroke_times, pose, session['voxel_time']),
+                stroke_length=ft.stroke_length(flags, pose),
+                curvature=ft.extract_curvature(pose, timepts, indices),
+                duration=ft.procedure_duration(session['voxel_time']),
+                drill_angle=ft.drill_orientation(flags, stroke_times, pose, timepts,
+                                                 session['force'], session['force_time']))
+
+
+def assert_features_equal(features, expected):
+    assert list(features) == FEATURES
+    for name in FEATURES:
+        np.testing.assert_allclose(features[name], expected[name], rtol=1e-12, err_msg=name)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_extractor_matches_per_feature_calls(seed):
+    session = extractor_session(seed)
+
+    features = FeatureExtractor(dict(session)).features()
+
+    assert_features_equal(features, reference_features(session, ft.get_strokes(session['pose'], session['time'])))
+
+
+def test_failed_node_raises_for_its_dependents(monkeypatch):
+    session = extractor_session(0)
+    del session['voxel_time']
+    calls = []
+
+    def failing_strokes(*args):
+        calls.append(args)
+        raise ValueError('no pivots')
+
+    monkeypatch.setattr(ft, 'get_strokes', failing_strokes)
+    fx = FeatureExtractor(session)
+    features = fx.features()
+
+    # one error per failed node, raised again for every feature on top of it without recomputing
+    assert len(calls) == 1
+    assert isinstance(features['stroke_count'], ValueError)
+    for name in dependents(['strokes']) & set(FEATURES):
+        assert features[name] is features['stroke_count']
+    assert isinstance(features['duration'], KeyError)
+    assert features['removal_rate'] is features['stroke_count']
+    with pytest.raises(ValueError):
+        fx.get('trajectories')
+    assert len(calls) == 1
+
+
+def test_derive_drops_every_dependent(monkeypatch):
+    session = extractor_session(1)
+    base = FeatureExtractor(dict(session))
+    base.features()
+    strokes = ft.get_strokes(session['pose'], session['time'], k=4)
+
+    derived = base.derive({'strokes': strokes})
+
+    replaced = dependents(['strokes'])
+    assert derived._values['strokes'] is strokes
+    assert not (replaced - {'strokes'}) & set(derived._values)
+    for name in set(base._values) - replaced:
+        assert derived._values[name] is base._values[name]
+    assert_features_equal(derived.features(), reference_features(session, strokes))
+
+    # errors of replaced nodes are dropped as well
+    def failing_strokes(*args):
+        raise ValueError('no pivots')
+
+    monkeypatch.setattr(ft, 'get_strokes', failing_strokes)
+    failed = FeatureExtractor(dict(session))
+    assert isinstance(failed.features()['velocity'], ValueError)
+    assert_features_equal(failed.derive({'strokes': strokes}).features(), reference_features(session, strokes))
+
+
+def test_feature_rows_flag_failed_extraction():
+    session = extractor_session(0)
+    del session['voxel_time']
+
+    def failing_extract():
+        raise OSError('unreadable')
+
+    partial = feature_rows('partial.hdf5', lambda: FeatureExtractor(session).features())[0]
+    failed = feature_rows('failed.hdf5', failing_extract)[0]
+
+    assert partial['errors'] and not extraction_failed(partial)
+    assert failed['errors'] and extraction_failed(failed)
+    assert extraction_failed(OrderedDict(file='crashed.hdf5', seconds=0.0, errors='worker process terminated'))
+
+
+def write_recording(path, session):
+    """
+    store a dict source in the datasets FeatureExtractor and extract_chunked read
+    """
+    with h5py.File(path, 'w') as f:
+        for name, value in session.items():
+            grp, dset = SOURCES[name][-1]
+            f.create_dataset(grp + '/' + dset, data=value)
+    return str(path)
+
+
+@pytest.mark.parametrize('chunk_size', [97, 1000, 4096, 1 << 18])
+def test_chunked_matches_in_memory(tmp_path, chunk_size):
+    path = write_recording(tmp_path / 'session.hdf5', extractor_session(2))
+    with FeatureExtractor(path) as fx:
+        expected = fx.features()
+
+    features = extract_chunked(path, chunk_size)
+
+    assert list(features) == FEATURES
+    for name in FEATURES:
+        np.testing.assert_allclose(features[name], expected[name], rtol=1e-9, err_msg=name)
+
+
+def test_chunked_bounds_a_stroke_without_pivots(tmp_path):
+    session = extractor_session(0)
+    session['pose'][:] = session['pose'][0]
+    path = write_recording(tmp_path / 'resting.hdf5', session)
+
+    # the whole recording is one open stroke
+    with pytest.raises(ValueError):
+        extract_chunked(path, chunk_size=500, max_stroke_samples=2000)
+    assert extract_chunked(path, chunk_size=500, max_stroke_samples=len(session['time']))['stroke_count'] == 0
+
+
+def cached_recording(tmp_path):
+    """
+    recording without removed voxels, so its cache entry holds errors next to the values
+    """
+    session = extractor_session(0)
+    del session['voxel_time']
+    return write_recording(tmp_path / 'session.hdf5', session)
+
+
+def test_cache_key_covers_content_code_and_parameters(tmp_path, monkeypatch):
+    path = cached_recording(tmp_path)
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    parameters = cache_parameters()
+
+    digest = hashlib.blake2b(digest_size=20)
+    for part in [content_hash(path), feature_cache.CODE_VERSION, repr(sorted(parameters.items()))]:
+        digest.update(part.encode())
+    assert cache.key(path, **parameters) == digest.hexdigest()
+
+    # a copy is found again, other settings and other code are not
+    copy = shutil.copy(path, str(tmp_path / 'copy.hdf5'))
+    assert cache.key(copy, **parameters) == cache.key(path, **parameters)
+    assert cache.key(path, **cache_parameters(sigmas=1.5)) != cache.key(path, **parameters)
+    assert cache.key(path, **cache_parameters(k=4)) != cache.key(path, **parameters)
+    key = cache.key(path, **parameters)
+    monkeypatch.setattr(feature_cache, 'CODE_VERSION', 'other')
+    assert cache.key(path, **parameters) != key
+
+
+def test_cache_misses_changed_recordings_and_settings(tmp_path):
+    path = cached_recording(tmp_path)
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    with FeatureExtractor(path, cache=cache) as fx:
+        expected = fx.features()
+
+    with FeatureExtractor(path, cache=cache) as fx:
+        assert fx._cached
+        features = fx.features()
+    for name in FEATURES:
+        if isinstance(expected[name], Exception):
+            # errors come back with their type and message
+            assert type(features[name]) is type(expected[name])
+            assert str(features[name]) == str(expected[name])
+        else:
+            np.testing.assert_array_equal(features[name], expected[name])
+    assert isinstance(features['duration'], KeyError)
+
+    with FeatureExtractor(path, cache=cache, sigmas=1.5) as fx:
+        assert not fx._cached
+
+    # rewritten in place with other content, its remembered hash must not be used
+    session = extractor_session(1)
+    del session['voxel_time']
+    write_recording(path, session)
+    assert not cache.contains(path, **cache_parameters())
+    with FeatureExtractor(path, cache=cache) as fx:
+        assert not fx._cached
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    for idx, key in enumerate(['a', 'b', 'c']):
+        assert cache.put(key, {'values': np.zeros(1000)})
+        os.utime(os.path.join(cache.directory, 'entries', key), (1000 + idx, 1000 + idx))
+    size = cache.size()
+
+    assert cache.get('a') is not None
+    cache.max_size = size
+    cache.put('d', {'values': np.zeros(1000)})
+
+    assert sorted(key for _, _, key in cache.entries()) == ['a', 'c', 'd']
+    assert cache.get('b') is None
+
+
+def test_cache_put_is_atomic(tmp_path, monkeypatch):
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    cache.put('key', {'first': np.arange(3), 'second': np.arange(4)})
+    save = np.save
+
+    def failing_save(file, value, **kwargs):
+        if file.endswith('second.npy'):
+            raise OSError('disk full')
+        save(file, value, **kwargs)
+
+    monkeypatch.setattr(np, 'save', failing_save)
+    assert not cache.put('key', {'first': np.zeros(3), 'second': np.zeros(4)})
+
+    # the earlier entry is untouched and no partial entry is left behind
+    arrays = cache.get('key')
+    np.testing.assert_array_equal(arrays['first'], np.arange(3))
+    np.testing.assert_array_equal(arrays['second'], np.arange(4))
+    assert os.listdir(os.path.join(cache.directory, 'entries')) == ['key']
+
+
+class RecordingError(Exception):
+    pass
+
+
+def test_cached_errors_round_trip(tmp_path):
+    pose, timepts, indices = short_stroke_session(0)
+    trajectories = ft.StrokeTrajectories(pose, timepts, indices)
+    trajectories.velocity()
+    errors = dict(jerk=ValueError('no pivots'), curvature=RecordingError('bad'), duration=KeyError('No dataset'),
+                  velocity=MemoryError(), acceleration=OSError('unreadable'))
+    cache = FeatureCache(str(tmp_path / 'cache'))
+
+    cache.put('key', pack(dict(trajectories=trajectories, stroke_count=6, pose=pose), errors))
+    values, restored = unpack(cache.get('key'))
+
+    assert set(values) == {'trajectories', 'stroke_count'}
+    assert values['stroke_count'] == 6
+    np.testing.assert_array_equal(values['trajectories'].velocity(), trajectories.velocity())
+    np.testing.assert_array_equal(values['trajectories'].offsets, trajectories.offsets)
+    # environment errors are not cached, errors of other than builtin types come back as RuntimeError
+    assert set(restored) == {'jerk', 'curvature', 'duration'}
+    assert type(restored['jerk']) is ValueError and str(restored['jerk']) == 'no pivots'
+    assert type(restored['curvature']) is RuntimeError and str(restored['curvature']) == 'bad'
+    assert type(restored['duration']) is KeyError and restored['duration'].args == ('No dataset',)
+
+
+def test_profiled_stages_do_not_nest(monkeypatch):
+    events = []
+    monkeypatch.setattr(feature_profiler, '_events', events)
+    pose, timepts, indices = short_stroke_session(0)
+    stages = dict((fn.__name__, stage) for fn, stage in feature_profiler._registry)
+
+    # get_strokes itself is not a stage, its two steps are
+    assert 'get_strokes' not in stages
+    assert stages['pivot_angles'] == 'pivot_angles' and stages['strokes_from_angles'] == 'get_strokes'
+
+    trajectories = ft.StrokeTrajectories(pose, timepts, indices)
+    feature_profiler._wrap(ft.extract_kinematics, 'derivatives')(None, None, None, trajectories=trajectories)
+    assert events[-1]['args']['input_size'] == len(timepts)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_stroke_simpson_matches_scipy(seed):
+    rng = np.random.default_rng(seed)
+    counts = np.concatenate([np.arange(8), rng.integers(0, 40, 30)])
+    strokes = np.repeat(np.arange(len(counts)), counts)
+    times = np.cumsum(rng.uniform(0, 1, len(strokes)) * (rng.uniform(size=len(strokes)) > 0.1))
+    values = rng.normal(size=len(strokes))
+
+    integrals = ft._stroke_simpson(values, times, strokes, len(counts))
+
+    # repeated time stamps included, as np.gradient leaves on resting drills
+    assert np.any(np.diff(times) == 0)
+    for i, count in enumerate(counts):
+        stroke = strokes == i
+        expected = integrate.simpson(values[stroke], x=times[stroke]) if count >= 2 else np.nan
+        np.testing.assert_allclose(integrals[i], expected, rtol=1e-12, atol=1e-12)
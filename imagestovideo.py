@@ -1,3 +1,5 @@
+import os
+import shutil
 import h5py
 import numpy as np
 from PIL import Image
@@ -11,12 +13,31 @@ args = parser.parse_args()
 # Read hdf5 file and get left images
 f = h5py.File(args.infile, 'r')
 data = f['data']
-l_img = data['l_img']
-size = l_img[0].shape[:2]
+if 'images' in f and 'l_img' in f['images']:
+    # Recorded with --image_rate, images are kept apart from the pose frames
+    data = f['images']
 
-# Write images to video
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-video = cv2.VideoWriter('vid.mp4', fourcc, 25, (size[1], size[0]))
-for frame in range(len(l_img)):
-    video.write(l_img[frame])
-video.release()
+if 'l_img_video' in f['metadata']:
+    # Recorded with --image_storage mp4, the video already exists next to the hdf5 file
+    video_name = f['metadata']['l_img_video'][()]
+    if isinstance(video_name, bytes):
+        video_name = video_name.decode()
+    shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(args.infile)), video_name), 'vid.mp4')
+else:
+    l_img = data['l_img']
+    encoded = h5py.check_vlen_dtype(l_img.dtype) is not None
+    if encoded:
+        # Recorded with --image_storage png or jpeg, one encoded blob per frame
+        size = cv2.imdecode(l_img[0], cv2.IMREAD_COLOR).shape[:2]
+    else:
+        size = l_img[0].shape[:2]
+
+    # Write images to video
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    video = cv2.VideoWriter('vid.mp4', fourcc, 25, (size[1], size[0]))
+    for frame in range(len(l_img)):
+        if encoded:
+            video.write(cv2.imdecode(l_img[frame], cv2.IMREAD_COLOR))
+        else:
+            video.write(l_img[frame])
+    video.release()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import h5py
+import numpy as np
+
+from hdf5_writer import HDF5Writer
+
+
+def benchmark_stream(values, codec, flush_size):
+    """
+    append a recorded stream to a scratch file the way the recorder does
+    :param values: N x sample shape array read from a recording
+    :param codec: codec spec understood by hdf5_writer.parse_codec
+    :param flush_size: samples appended per batch
+    :return: seconds spent writing, bytes stored on disk
+    """
+    fd, path = tempfile.mkstemp(suffix='.hdf5')
+    os.close(fd)
+    try:
+        file = h5py.File(path, 'w')
+        writer = HDF5Writer(file, default_codec=codec)
+
+        start = time.perf_counter()
+        for idx in range(0, values.shape[0], flush_size):
+            writer.append('data', 'stream', values[idx:idx + flush_size])
+        file.flush()
+        elapsed = time.perf_counter() - start
+
+        stored = file['data/stream'].id.get_storage_size()
+        file.close()
+    finally:
+        os.remove(path)
+
+    return elapsed, stored
+
+
+def main(args):
+    file = h5py.File(args.file, 'r')
+    streams = []
+    file.visititems(lambda name, obj: streams.append(name)
+                    if isinstance(obj, h5py.Dataset) and obj.ndim > 0 and obj.shape[0] > 0
+                    and not name.startswith('metadata') else None)
+
+    if not streams:
+        print("No recorded streams in", args.file)
+        return
+
+    print("%-32s %-16s %12s %10s %8s" % ("stream", "codec", "MB/s", "MB", "ratio"))
+    for name in streams:
+        values = file[name][()]
+        raw = values.nbytes
+        for codec in args.codecs:
+            elapsed, stored = benchmark_stream(values, codec, args.flush_size)
+            print("%-32s %-16s %12.1f %10.2f %8.2f" % (
+                name, codec, raw / 1e6 / max(elapsed, 1e-9), stored / 1e6, raw / max(stored, 1)))
+
+    file.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Write throughput and compression ratio per stream of a recording')
+    parser.add_argument('--file', required=True, type=str,
+                        help='Recorded hdf5 file to replay')
+    parser.add_argument('--codecs', default=['none', 'lzf', 'lzf+shuffle', 'gzip:1', 'gzip:4', 'gzip:4+shuffle'],
+                        type=str, nargs='+', help='Codecs to compare')
+    parser.add_argument('--flush_size', type=int, default=50,
+                        help='Samples appended per batch, as in data_record.py')
+
+    args = parser.parse_args()
+    main(args)
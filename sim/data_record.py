@@ -6,6 +6,7 @@ import sys
 import time
 from argparse import ArgumentParser
 from collections import OrderedDict
+from threading import Lock, Thread
 
 import h5py
 import numpy as np
@@ -16,13 +17,23 @@ if sys.version_info[0] >= 3:
 else:
     from Queue import Empty, Full, Queue
 
-import message_filters
-from msg_synchronizer import TimeSynchronizer
-import ros_numpy
-import rospy
-from ambf_msgs.msg import RigidBodyState, CameraState
-from cv_bridge import CvBridge, CvBridgeError
-from sensor_msgs.msg import Image, PointCloud2
+from hdf5_writer import BackgroundWriter, HDF5Writer, parse_codec
+from image_encoder import IMAGE_KEYS, ImageEncoder, video_path
+from recorder_stats import RecorderStats
+from rate_control import MessageHistory, RateLimiter
+from stream_buffer import DoubleBuffer
+
+try:
+    import message_filters
+    from msg_synchronizer import TimeSynchronizer
+    import ros_numpy
+    import rospy
+    from ambf_msgs.msg import RigidBodyState, CameraState
+    from cv_bridge import CvBridge, CvBridgeError
+    from sensor_msgs.msg import Image, PointCloud2
+except ImportError:
+    # the recording pipeline itself stays importable without ros, see recorder_load_test.py
+    rospy = None
 
 try:
     from vdrilling_msgs.msg import points, UInt8Stamped, VolumeProp
@@ -32,6 +43,19 @@ except ImportError:
           "Please source <volumetric_plugin_path>/vdrilling_msgs/build/devel/setup.bash \n")
 
 
+# recorded groups, in the order they are created in every file
+GROUPS = ["data", "images", "voxels_removed", "burr_change", "force"]
+
+# seconds capture waits for the writer to return a buffer before the recording fails
+SWAP_TIMEOUT = 60.0
+
+log = logging.getLogger('logger')
+
+# camera extrinsics, the transformation that pre-multiplies recorded poses to match opencv convention
+extrinsic = np.array([[0, 1, 0, 0], [0, 0, -1, 0],
+                      [-1, 0, 0, 0], [0, 0, 0, 1]])  # T_cv_ambf
+
+
 def depth_gen(depth_msg):
     """
     generate depth
@@ -39,6 +63,41 @@ def depth_gen(depth_msg):
     :return: HxW, z-values
     """
     xyz_array = ros_numpy.point_cloud2.pointcloud2_to_array(depth_msg)
+    if args.depth_mode == 'full':
+        return full_depth_from_points(xyz_array)
+
+    return depth_from_points(xyz_array)
+
+
+def depth_from_points(xyz_array):
+    """
+    depth from the structured point cloud using only the z row of the extrinsic
+    :param xyz_array: structured array with x, y, z fields
+    :return: HxW, z-values
+    """
+    # z_cv = extrinsic[2, :3] . p_ambf, skip the axes that do not contribute
+    depth = None
+    for axis, coeff in zip('xyz', extrinsic[2, :3] * scale):
+        if coeff == 0:
+            continue
+        term = xyz_array[axis].astype(np.float32, copy=False) * np.float32(coeff)
+        if depth is None:
+            depth = term
+        else:
+            depth += term
+    if depth is None:
+        depth = np.zeros(xyz_array.shape, dtype=np.float32)
+
+    # reverse height direction due to AMBF reshaping, halve precision to save storage
+    return depth.reshape([h, w])[::-1].astype(np.float16)
+
+
+def full_depth_from_points(xyz_array):
+    """
+    reference conversion rotating the full point cloud into cv convention
+    :param xyz_array: structured array with x, y, z fields
+    :return: HxW, z-values
+    """
     xcol = xyz_array['x'][:, None] * scale
     ycol = xyz_array['y'][:, None] * scale
     zcol = xyz_array['z'][:, None] * scale
@@ -79,7 +138,16 @@ def pose_gen(pose_msg):
     return pose_np
 
 
-def init_hdf5(args, stereo):
+def load_metadata(args, stereo):
+    """
+    parse the world and stereo adf and the nrrd header, done once per session and reused
+    by every file the session rolls over into
+    :return: dict of camera intrinsic, image size, conversion factor and stereo baseline
+    """
+    global session_metadata
+    if session_metadata is not None:
+        return session_metadata
+
     world_adf = open(args.world_adf, "r")
     world_params = yaml.safe_load(world_adf)
     world_adf.close()
@@ -104,36 +172,127 @@ def init_hdf5(args, stereo):
     largest_dim = np.argmax(sizes)
     s = np.linalg.norm(directions[largest_dim]) * sizes[largest_dim] / 1000.0
 
-    # Create hdf5 file with date
+    # baseline info from stereo adf
+    baseline = None
+    if stereo:
+        adf = args.stereo_adf
+        stereo_adf = open(adf, "r")
+        stereo_params = yaml.safe_load(stereo_adf)
+        baseline = math.fabs(
+            stereo_params['stereoL']['location']['y'] - stereo_params['stereoR']['location']['y']) * s
+
+    session_metadata = dict(intrinsic=intrinsic, height=img_height, width=img_width, scale=s, baseline=baseline)
+    return session_metadata
+
+
+def output_path(output_dir):
+    """
+    :return: path of a new file named by the current date, files rolled over within the same second
+             get a _1, _2, ... suffix
+    """
+    time_str = time.strftime("%Y%m%d_%H%M%S")
+    path = output_dir + '/' + time_str + ".hdf5"
+    count = 0
+    while os.path.exists(path):
+        count += 1
+        path = output_dir + '/' + time_str + "_%d.hdf5" % count
+    return path
+
+
+def init_hdf5(args, stereo):
+    meta = load_metadata(args, stereo)
+
+    # Create hdf5 file with date, "w-" refuses to overwrite an existing recording
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
-    time_str = time.strftime("%Y%m%d_%H%M%S")
-    file = h5py.File(args.output_dir + '/' + time_str + ".hdf5", "w")
+    path = output_path(args.output_dir)
+    if args.swmr:
+        # swmr needs the latest file format
+        file = h5py.File(path, "w-", libver='latest')
+    else:
+        file = h5py.File(path, "w-")
 
     metadata = file.create_group("metadata")
-    metadata.create_dataset("camera_intrinsic", data=intrinsic)
+    metadata.create_dataset("camera_intrinsic", data=meta['intrinsic'])
     metadata.create_dataset("camera_extrinsic", data=extrinsic)
     metadata.create_dataset("README", data="All position information is in meters unless specified otherwise. \n"
                                            "Quaternion is a list in the order of [qx, qy, qz, qw]. \n"
                                            "Poses are defined to be T_world_obj. \n"
                                            "Depth in CV convention (corrected by extrinsic, T_cv_ambf). \n")
 
-    # baseline info from stereo adf
-    if stereo:
-        adf = args.stereo_adf
-        stereo_adf = open(adf, "r")
-        stereo_params = yaml.safe_load(stereo_adf)
-        baseline = math.fabs(
-            stereo_params['stereoL']['location']['y'] - stereo_params['stereoR']['location']['y']) * s
-        metadata.create_dataset("baseline", data=baseline)
+    if meta['baseline'] is not None:
+        metadata.create_dataset("baseline", data=meta['baseline'])
 
     file.create_group("data")
+    file.create_group("images")
     file.create_group("voxels_removed")
     file.create_group("burr_change")
     #Added
     file.create_group("force")
 
-    return file, img_height, img_width, s
+    return HDF5Writer(file, stream_codecs(args), args.stream_codec), meta['height'], meta['width'], meta['scale']
+
+
+def start_swmr(writer):
+    """
+    create every dataset of the file up front and switch it to single writer / multiple reader mode,
+    the column specs must be known, i.e. after setup_subscriber
+    """
+    groups = [("data", container), ("images", image_container), ("voxels_removed", collisions),
+              ("burr_change", burr_change), ("force", omni_force)]
+    for group, columns in groups:
+        for key, (shape, dtype) in columns.items():
+            if encoder is not None and group in ("data", "images") and key in IMAGE_KEYS:
+                writer.create(group, key + encoder.dataset_suffix, (), encoder.dtype)
+                if encoder.storage == 'mp4':
+                    writer.file['metadata'].create_dataset(
+                        key + '_video', data=os.path.basename(video_path(writer.file.filename, key)))
+            else:
+                writer.create(group, key, shape, dtype)
+
+    if args.session_file:
+        writer.create_segment_index(GROUPS)
+    stats.write(writer, stats.snapshot())
+    hdf5_vox_vol = writer.file['metadata'].create_dataset("voxel_volume", data=float(voxel_volume))
+    hdf5_vox_vol.attrs['units'] = "mm^3, millimeters cubed"
+    # cleared when the file is closed, live readers stop once it is 0 and no rows are left
+    writer.file['metadata'].create_dataset("recording", data=np.uint8(1))
+
+    writer.start_swmr()
+
+
+def rollover_due(writer):
+    """
+    session files only roll over into a new file once they exceed the size or time limit
+    """
+    if not args.session_file:
+        return True
+    if args.max_file_size > 0 and writer.size >= args.max_file_size * 1024 ** 2:
+        return True
+    if args.max_file_duration > 0 and time.time() - writer.opened >= args.max_file_duration:
+        return True
+    return False
+
+
+def stream_codecs(args):
+    """
+    per dataset codecs, images and depth use image_codec unless overridden with --codec key=spec,
+    where key is a dataset name matched in every group or group/name for the dataset of one group
+    """
+    codecs = dict((key, args.image_codec) for key in ['l_img', 'r_img', 'segm', 'depth'])
+    if args.image_storage != 'raw':
+        # encoded frames do not compress any further
+        for key in IMAGE_KEYS:
+            codecs[key] = 'none'
+    for override in args.codec:
+        key, _, spec = override.partition('=')
+        codecs[key] = spec
+
+    # fail at startup rather than on the writer thread
+    for spec in list(codecs.values()) + [args.stream_codec]:
+        parse_codec(spec)
+
+    return codecs
 
 
 def callback(*inputs):
@@ -145,9 +304,12 @@ def callback(*inputs):
     :return:
     """
     log.log(logging.DEBUG, "msg callback")
+    stats.synced()
 
     keys = list(inputs[-1])
     data = dict(time=inputs[0].header.stamp.to_sec())
+    if not frame_limiter.due(data['time']):
+        return
 
     if num_data % 5 == 0:
         print("Recording data: " + '#' * (num_data // 10), end='\r')
@@ -162,66 +324,245 @@ def callback(*inputs):
             # print("pose")
             data[key] = pose_gen(inputs[idx])
 
+    enqueue_frame(data)
+
+
+def convert_image_msg(key, msg):
+    return depth_gen(msg) if key == 'depth' else image_gen(msg)
+
+
+def image_callback(msg, key):
+    """
+    image streams decoupled from the pose synchronizer, the first subscribed one sets the pace at --image_rate
+    and every stream contributes the message nearest to its time stamp, only recorded messages are converted
+    """
+    stats.message(key)
+    stamp = msg.header.stamp.to_sec()
+    image_history[key].add(stamp, msg)
+
+    keys = list(image_history.keys())
+    if key != keys[0] or not all(len(history) for history in image_history.values()):
+        return
+    if not image_limiter.due(stamp):
+        return
+
+    data = dict(time=stamp)
+    for name in keys:
+        data[name] = convert_image_msg(name, msg if name == key else image_history[name].nearest(stamp))
+
+    with buffer_lock:
+        full = buffers["images"].front.append(**data)
+    if full:
+        swap_buffers(["images"])
+
+
+def enqueue_frame(data):
+    """
+    hand a converted, synchronized frame to the consumer, dropped if the queue is full
+    """
     try:
         data_queue.put_nowait(data)
     except Full:
+        stats.dropped()
         log.log(logging.DEBUG, "Queue full")
 
 
-def write_to_hdf5():
-    hdf5_vox_vol = f['metadata'].create_dataset("voxel_volume", data=voxel_volume)
-    hdf5_vox_vol.attrs['units'] = "mm^3, millimeters cubed"
-    containers = [(f["data"], container), (f["voxels_removed"], collisions), (f["burr_change"], burr_change), (f["force"], omni_force)]
-    for group, data in containers:
-        for key, value in data.items():
-            if len(value) > 0:
-                group.create_dataset(
-                    key, data=np.stack(value, axis=0), compression='gzip')  # write to disk
-                log.log(logging.INFO, (key, group[key].shape))
-            data[key] = []  # reset list to empty memory
+def swap_buffers(groups=None, end_chunk=False):
+    """
+    hand the filled buffers to the writer thread and keep capturing into fresh ones
+    :param groups: names of the groups to swap, all groups if None
+    :param end_chunk: the buffers complete a chunk, see write_to_hdf5
+    """
+    background_writer.check()
+    try:
+        with buffer_lock:
+            filled = [(group, buffers[group].swap(SWAP_TIMEOUT)) for group in (groups or buffers.keys())]
+    except RuntimeError as e:
+        recording_failed(e)
+        raise
 
-    f.close()
+    background_writer.submit(filled, end_chunk)
 
-    return
 
+def recording_failed(error):
+    """
+    stop recording once writing failed, runs on the thread that noticed, see stop_recording for the error
+    """
+    log.log(logging.CRITICAL, "CRITICAL! Writing to hdf5 failed, stopping the recording: %s" % error)
+    if rospy is not None and not rospy.is_shutdown():
+        rospy.signal_shutdown("writing to hdf5 failed")
 
-def timer_callback(_):
-    log.log(logging.NOTSET, "timer callback")
+
+def write_to_hdf5(filled, end_chunk=False):
+    """
+    append filled buffers to the open hdf5 file, runs on the writer thread
+    :param filled: list of (group, buffer) pairs handed over by swap_buffers
+    :param end_chunk: after writing, close the current file and start a new one, or with
+                      --session_file record the chunk as a segment and only roll over past the limits
+    """
+    global writer
+    flush_start = time.time()
+    size_before = writer.size
+    pending = []
     try:
-        data_dict = data_queue.get_nowait()
-    except Empty:
-        log.log(logging.NOTSET, "Empty queue")
-        return
+        for group, buffer in filled:
+            for key, value in buffer.columns().items():
+                if len(value) == 0:
+                    continue
+                if encoder is not None and group in ("data", "images") and key in IMAGE_KEYS:
+                    # encoded on the worker pool while the remaining streams are written
+                    pending.append((group, key, encoder.submit(key, value, video_path(writer.file.filename, key))))
+                    continue
+                size = writer.append(group, key, value)  # write to disk
+                log.log(logging.DEBUG, (key, size))
+
+        for group, key, result in pending:
+            size = writer.append(group, key + encoder.dataset_suffix, result(), dtype=encoder.dtype)
+            log.log(logging.DEBUG, (key, size))
+            if encoder.storage == 'mp4' and key + '_video' not in writer.file['metadata']:
+                writer.file['metadata'].create_dataset(
+                    key + '_video', data=os.path.basename(video_path(writer.file.filename, key)))
+    finally:
+        # wait for every encode still reading the buffers, then hand them back to capture even if a write failed
+        for _, _, result in pending:
+            try:
+                result()
+            except Exception:
+                pass
+        for group, buffer in filled:
+            buffers[group].release(buffer)
+
+    if args.swmr:
+        writer.flush()  # make the appended rows visible to live readers
+    stats.flush(time.time() - flush_start, writer.size - size_before)
+    if stats.due():
+        stats.write(writer, stats.snapshot(), stats_path)
+
+    if end_chunk:
+        if args.session_file:
+            writer.end_segment(GROUPS)
+        if rollover_due(writer):
+            close_hdf5()
+            writer, _, _, _ = init_hdf5(args, stereo)
+            if args.swmr:
+                start_swmr(writer)
 
-    global num_data, f
-    for key, data in data_dict.items():
-        container[key].append(data)
+    return
+
+
+def close_hdf5():
+    f = writer.file
+    if encoder is not None:
+        encoder.close_videos()
+    if args.session_file:
+        writer.end_segment(GROUPS)  # the partial chunk left at exit
+    stats.write(writer, stats.snapshot(), stats_path)
+    if args.swmr:
+        # created up front, swmr files can only write into existing datasets
+        f['metadata']['voxel_volume'][()] = voxel_volume
+        f['metadata']['recording'][()] = 0
+    else:
+        hdf5_vox_vol = f['metadata'].create_dataset("voxel_volume", data=voxel_volume)
+        hdf5_vox_vol.attrs['units'] = "mm^3, millimeters cubed"
+    for group in GROUPS:
+        for key in f[group].keys():
+            log.log(logging.INFO, (key, f[group][key].shape))
+
+    f.close()
+
+    return
+
+
+def store_frame(data_dict):
+    global num_data
+    full = buffers["data"].front.append(**data_dict)
 
     num_data = num_data + 1
     if num_data >= chunk:
         log.log(logging.INFO, "\nWrite data to disk")
-        write_to_hdf5()
-        f, _, _, _ = init_hdf5(args, stereo)
+        swap_buffers(end_chunk=True)
         num_data = 0
+    elif full:
+        swap_buffers()
+
+
+def consume_queue():
+    """
+    block until synchronized frames arrive and drain up to batch_size of them at once,
+    runs on its own thread until a None sentinel is received; frames the buffer rejects are
+    counted and skipped, after a failed write the queue is only drained
+    """
+    failed = None
+    num_frames = 0
+    num_batches = 0
+    max_backlog = 0
+    cpu_start = time.process_time()
+    wall_start = time.time()
+
+    running = True
+    while running:
+        batch = [data_queue.get()]  # block instead of polling
+        backlog = data_queue.qsize()
+        max_backlog = max(max_backlog, backlog)
+        stats.queue(backlog)
+        while len(batch) < batch_size:
+            try:
+                batch.append(data_queue.get_nowait())
+            except Empty:
+                break
+
+        log.log(logging.NOTSET, "consumer batch %d, backlog %d" % (len(batch), backlog))
+        for data_dict in batch:
+            if data_dict is None:
+                running = False
+                continue
+            if failed is not None:
+                continue
+            try:
+                store_frame(data_dict)
+            except ValueError as e:
+                stats.rejected()
+                log.log(logging.WARNING, "Rejected frame: %s" % e)
+                continue
+            except RuntimeError as e:
+                # keep draining so stop_recording can still queue the sentinel
+                failed = e
+                continue
+            num_frames = num_frames + 1
+        num_batches = num_batches + 1
+
+    log.log(logging.INFO, "Consumer stored %d frames in %d batches, max backlog %d, cpu %.2fs over %.2fs wall" %
+            (num_frames, num_batches, max_backlog, time.process_time() - cpu_start, time.time() - wall_start))
 
 
 def rm_vox_callback(rm_vox_msg):
-    voxel = [rm_vox_msg.voxel_removed.x, rm_vox_msg.voxel_removed.y, rm_vox_msg.voxel_removed.z]
-    collisions['time_stamp'].append(rm_vox_msg.header.stamp.to_sec())
-    collisions['voxel_removed'].append(voxel)
+    stats.message('voxels_removed')
+    voxel = (rm_vox_msg.voxel_removed.x, rm_vox_msg.voxel_removed.y, rm_vox_msg.voxel_removed.z)
     int_vox_color = [round(elem * 255) for elem in rm_vox_msg.voxel_color]
-    collisions['voxel_color'].append(int_vox_color)
+    with buffer_lock:
+        full = buffers["voxels_removed"].front.append(
+            time_stamp=rm_vox_msg.header.stamp.to_sec(), voxel_removed=voxel, voxel_color=int_vox_color)
+    if full:
+        swap_buffers(["voxels_removed"])
 
 # Added
 def force_callback(force_msg):
-    feedback = [force_msg.wrench.force.x, force_msg.wrench.force.y, force_msg.wrench.force.z]
-    omni_force['time_stamp'].append(force_msg.header.stamp.to_sec())
-    omni_force['wrench'].append(feedback)
+    stats.message('force')
+    if not force_limiter.due(force_msg.header.stamp.to_sec()):
+        return
+    feedback = (force_msg.wrench.force.x, force_msg.wrench.force.y, force_msg.wrench.force.z)
+    with buffer_lock:
+        full = buffers["force"].front.append(time_stamp=force_msg.header.stamp.to_sec(), wrench=feedback)
+    if full:
+        swap_buffers(["force"])
 
 def burr_change_callback(burr_change_msg):
-    global burr_change
-    burr_change['time_stamp'].append(burr_change_msg.header.stamp.to_sec())
-    burr_change['burr_size'].append(burr_change_msg.number.data)
+    stats.message('burr_change')
+    with buffer_lock:
+        full = buffers["burr_change"].front.append(
+            time_stamp=burr_change_msg.header.stamp.to_sec(), burr_size=burr_change_msg.number.data)
+    if full:
+        swap_buffers(["burr_change"])
 
 
 def volume_prop_callback(volume_prop_msg):
@@ -233,6 +574,23 @@ def volume_prop_callback(volume_prop_msg):
 
 
 
+def subscribe_image(key, topic, msg_type, spec, subscribers):
+    """
+    synchronize an image stream with the poses, or with --image_rate record it on its own into the images group
+    :param spec: (sample shape, dtype) of the converted stream
+    """
+    if args.image_rate > 0:
+        rospy.Subscriber(topic, msg_type, image_callback, key, queue_size=1)
+        stats.add_stream(key)
+        image_container[key] = spec
+        image_history[key] = MessageHistory()
+    else:
+        sub = message_filters.Subscriber(topic, msg_type)
+        sub.registerCallback(stats.counter(key))
+        subscribers += [sub]
+        container[key] = spec
+
+
 def setup_subscriber(args):
     active_topics = [n for [n, _] in rospy.get_published_topics()]
     subscribers = []
@@ -244,9 +602,7 @@ def setup_subscriber(args):
 
     if args.stereoL_topic != 'None':
         if args.stereoL_topic in active_topics:
-            stereoL_sub = message_filters.Subscriber(args.stereoL_topic, Image)
-            subscribers += [stereoL_sub]
-            container['l_img'] = []
+            subscribe_image('l_img', args.stereoL_topic, Image, ((h, w, 3), np.uint8), subscribers)
             topics += [args.stereoL_topic]
         else:
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.stereoL_topic)
@@ -254,9 +610,7 @@ def setup_subscriber(args):
 
     if args.depth_topic != 'None':
         if args.depth_topic in active_topics:
-            depth_sub = message_filters.Subscriber(args.depth_topic, PointCloud2)
-            subscribers += [depth_sub]
-            container['depth'] = []
+            subscribe_image('depth', args.depth_topic, PointCloud2, ((h, w), np.float16), subscribers)
             topics += [args.depth_topic]
         else:
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.depth_topic)
@@ -264,9 +618,7 @@ def setup_subscriber(args):
 
     if args.stereoR_topic != 'None':
         if args.stereoR_topic in active_topics:
-            stereoR_sub = message_filters.Subscriber(args.stereoR_topic, Image)
-            subscribers += [stereoR_sub]
-            container['r_img'] = []
+            subscribe_image('r_img', args.stereoR_topic, Image, ((h, w, 3), np.uint8), subscribers)
             topics += [args.stereoR_topic]
         else:
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.stereoR_topic)
@@ -274,9 +626,7 @@ def setup_subscriber(args):
 
     if args.segm_topic != 'None':
         if args.segm_topic in active_topics:
-            segm_sub = message_filters.Subscriber(args.segm_topic, Image)
-            subscribers += [segm_sub]
-            container['segm'] = []
+            subscribe_image('segm', args.segm_topic, Image, ((h, w, 3), np.uint8), subscribers)
             topics += [args.segm_topic]
         else:
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.segm_topic)
@@ -285,9 +635,10 @@ def setup_subscriber(args):
     if args.rm_vox_topic != 'None':
         if args.rm_vox_topic in active_topics:
             rospy.Subscriber(args.rm_vox_topic, points, rm_vox_callback)
-            collisions['time_stamp'] = []
-            collisions['voxel_removed'] = []
-            collisions['voxel_color'] = []
+            stats.add_stream('voxels_removed')
+            collisions['time_stamp'] = ((), np.float64)
+            collisions['voxel_removed'] = ((3,), np.uint16)
+            collisions['voxel_color'] = ((4,), np.uint8)  # rgba
         else:
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.rm_vox_topic)
             exit()
@@ -295,8 +646,9 @@ def setup_subscriber(args):
     if args.burr_change_topic != 'None':
         if args.burr_change_topic in active_topics:
             rospy.Subscriber(args.burr_change_topic, UInt8Stamped, burr_change_callback)
-            burr_change['time_stamp'] = []
-            burr_change['burr_size'] = []
+            stats.add_stream('burr_change')
+            burr_change['time_stamp'] = ((), np.float64)
+            burr_change['burr_size'] = ((), np.uint8)
         else:
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.burr_change_topic)
             exit()
@@ -312,9 +664,10 @@ def setup_subscriber(args):
     if args.force_topic != 'None':
         if args.force_topic in active_topics:
             rospy.Subscriber(args.force_topic, WrenchStamped, force_callback)
+            stats.add_stream('force')
             # Can I just use omni_force here or do I have to use a different variable?
-            omni_force['time_stamp'] = []
-            omni_force['wrench'] =[]
+            omni_force['time_stamp'] = ((), np.float64)
+            omni_force['wrench'] = ((3,), np.float64)
         else:
             log.log(logging.CRITICAL, "CRITICAL! Failed to subscribe to " + args.force_topic)
             exit()
@@ -329,7 +682,8 @@ def setup_subscriber(args):
             pose_sub = message_filters.Subscriber(topic, RigidBodyState)
 
         if topic in active_topics:
-            container['pose_' + name] = []
+            container['pose_' + name] = ((7,), np.float64)
+            pose_sub.registerCallback(stats.counter('pose_' + name))
             subscribers += [pose_sub]
             topics += [topic]
         else:
@@ -341,7 +695,7 @@ def setup_subscriber(args):
 
 
 def main(args):
-    container['time'] = []
+    container['time'] = ((), np.float64)
 
     # setup ros node and subscribers
     rospy.init_node('data_recorder')
@@ -352,17 +706,102 @@ def main(args):
     # Otherwise, the time taken to compute synchronization becomes very long and no more message will be spit out.
     if args.sync is False:
         ats = message_filters.ApproximateTimeSynchronizer(subscribers, queue_size=50, slop=0.01)
-        ats.registerCallback(callback, container.keys())
+        ats.registerCallback(callback, list(container.keys()))
     else:
         ats = TimeSynchronizer(subscribers, queue_size=50)
-        ats.registerCallback(callback, container.keys())
+        ats.registerCallback(callback, list(container.keys()))
 
-    # separate thread for writing to hdf5 to release memory
-    rospy.Timer(rospy.Duration(0, 500000), timer_callback)  # set to 2Khz such that we don't miss pose data
-    print("Writing to HDF5 every chunk of %d data" % args.chunk_size)
+    consumer = start_recording()
+    print("Writing to HDF5 every chunk of %d data, appending every %d data" % (args.chunk_size, args.flush_size))
+    if args.session_file:
+        print("Keeping one file per session, chunks are indexed in metadata/segments")
 
     rospy.spin()
-    write_to_hdf5()  # save when user exits
+    stop_recording(consumer)  # save when user exits
+
+
+def init_recorder(args, metadata=None):
+    """
+    set up the state shared by the callbacks, the consumer and the writer thread and open the first file
+    :param args: parsed recorder arguments
+    :param metadata: parsed session metadata, see load_metadata, read from the adf files if None
+    """
+    global stereo, session_metadata, writer, h, w, scale, chunk, flush, batch_size, data_queue, stats, \
+        stats_path, num_data, buffer_lock, encoder, background_writer, container, buffers, collisions, \
+        omni_force, burr_change, voxel_volume, image_container, image_history, frame_limiter, image_limiter, \
+        force_limiter
+
+    # check topics and see if we need to read stereo adf for baseline
+    if args.stereoL_topic is not None and args.stereoR_topic is not None:
+        stereo = True
+    else:
+        stereo = False
+    session_metadata = metadata  # parsed adf and nrrd header, shared by every file of the session
+    writer, h, w, scale = init_hdf5(args, stereo)
+
+    # initialize queue for multi-threading
+    chunk = args.chunk_size
+    flush = min(args.flush_size, chunk)
+    batch_size = args.batch_size
+    data_queue = Queue(chunk * 2)
+    stats = RecorderStats(data_queue.maxsize, args.stats_interval)
+    stats_path = None if args.stats_file == 'None' else os.path.join(args.output_dir, args.stats_file)
+    num_data = 0
+    buffer_lock = Lock()
+    encoder = None
+    if args.image_storage != 'raw':
+        encoder = ImageEncoder(args.image_storage, args.encoder_workers, fps=args.video_fps)
+    background_writer = BackgroundWriter(write_to_hdf5, on_error=recording_failed)
+    container = OrderedDict()  # column specs of each stream, (sample shape, dtype)
+    image_container = OrderedDict([('time', ((), np.float64))])  # image streams recorded apart from the poses
+    image_history = OrderedDict()
+    frame_limiter = RateLimiter(args.pose_rate)
+    image_limiter = RateLimiter(args.image_rate)
+    force_limiter = RateLimiter(args.force_rate)
+    buffers = OrderedDict()
+    collisions = OrderedDict()
+    # Added, not sure if needed?
+    omni_force = OrderedDict()
+    burr_change = OrderedDict()
+    voxel_volume = 0
+
+
+def start_recording():
+    """
+    allocate the stream buffers once the column specs are known and start the writer and consumer threads
+    :return: the consumer thread, pass it to stop_recording
+    """
+    # preallocated typed buffers, frames with images are flushed every flush size,
+    # the small asynchronous streams on every flush or whenever their chunk sized buffer fills up
+    buffers["data"] = DoubleBuffer(flush, container)
+    buffers["images"] = DoubleBuffer(flush, image_container)
+    for group, columns in [("voxels_removed", collisions), ("burr_change", burr_change), ("force", omni_force)]:
+        buffers[group] = DoubleBuffer(chunk, columns)
+    if args.swmr:
+        start_swmr(writer)
+
+    # filled buffers are written to hdf5 on their own thread so capture never waits on compression
+    background_writer.start()
+    # synchronized frames are drained in batches by a blocking consumer instead of a polling timer
+    consumer = Thread(target=consume_queue, name='queue_consumer')
+    consumer.daemon = True
+    consumer.start()
+
+    return consumer
+
+
+def stop_recording(consumer):
+    """
+    store everything still queued or buffered and close the file
+    """
+    data_queue.put(None)
+    consumer.join()
+    try:
+        swap_buffers()
+    finally:
+        background_writer.stop()
+        close_hdf5()
+    background_writer.check()  # report a failed write to the caller once the file is closed
 
 
 def verify_cv_bridge():
@@ -377,7 +816,7 @@ def verify_cv_bridge():
     return True
 
 
-if __name__ == '__main__':
+def build_parser():
     parser = ArgumentParser()
 
     parser.add_argument(
@@ -411,12 +850,74 @@ if __name__ == '__main__':
     parser.add_argument(
 	'--force_topic', default='/ambf/volumetric_drilling/force', type=str)
 
+    parser.add_argument('--image_codec', default='gzip', type=str,
+                        help="Codec for image and depth datasets: none, lzf or gzip[:level], optionally +shuffle")
+    parser.add_argument('--stream_codec', default='gzip', type=str,
+                        help='Codec for all other datasets, same format as --image_codec')
+    parser.add_argument('--codec', default=[], type=str, nargs='*',
+                        help='Per dataset codec overrides as key=codec, key being a dataset name or group/name '
+                             'to target one group, e.g. wrench=lzf+shuffle force/time_stamp=none')
+    parser.add_argument('--image_storage', default='raw', choices=['raw', 'png', 'jpeg', 'mp4'],
+                        help='Store l_img, r_img and segm as raw frames, encoded blobs or one mp4 per stream '
+                             'next to the hdf5 file. jpeg and mp4 are lossy, do not use them for segmentation labels')
+    parser.add_argument('--encoder_workers', type=int, default=4,
+                        help='Worker threads encoding images')
+    parser.add_argument('--video_fps', type=int, default=30,
+                        help='Frame rate written into mp4 headers, timestamps are kept in the hdf5 file')
+    parser.add_argument('--depth_mode', default='fast', choices=['fast', 'full'],
+                        help='fast computes only the depth row of the extrinsic, full rotates the whole point cloud')
+    parser.add_argument('--image_rate', type=float, default=0,
+                        help='Record images, depth and segmentation at this rate in Hz into the images group, '
+                             'paired by nearest time stamp instead of synchronized with the poses. '
+                             '0 keeps them synchronized with every pose frame')
+    parser.add_argument('--pose_rate', type=float, default=0,
+                        help='Record synchronized pose frames at this rate in Hz, 0 records every frame')
+    parser.add_argument('--force_rate', type=float, default=0,
+                        help='Record force at this rate in Hz, 0 records every message')
     parser.add_argument('--sync', action='store_true')
     parser.add_argument('--chunk_size', type=int, default=500,
                         help='Write to disk every chunk size')
+    parser.add_argument('--flush_size', type=int, default=50,
+                        help='Append buffered data to the open file every flush size')
+    parser.add_argument('--session_file', action='store_true',
+                        help='Keep one file per session and index every chunk in metadata/segments '
+                             'instead of starting a new file every chunk size')
+    parser.add_argument('--max_file_size', type=float, default=0,
+                        help='With --session_file, roll over into a new file past this size in MB, 0 for no limit')
+    parser.add_argument('--max_file_duration', type=float, default=0,
+                        help='With --session_file, roll over into a new file after this many seconds, 0 for no limit')
+    parser.add_argument('--swmr', action='store_true',
+                        help='Write in single writer / multiple reader mode and flush every flush size, so '
+                             'feature_validation/live_reader.py can follow the file while recording. '
+                             'Best combined with --session_file, not available for png and jpeg --image_storage')
+    parser.add_argument('--stats_interval', type=float, default=10,
+                        help='Seconds between recorder health snapshots in metadata/stats and the stats file')
+    parser.add_argument('--stats_file', default='recorder_stats.jsonl', type=str,
+                        help="Json lines file in output_dir receiving every health snapshot, 'None' to disable")
+    parser.add_argument('--batch_size', type=int, default=100,
+                        help='Maximum number of queued frames drained by the consumer at once')
     parser.add_argument('--debug', action='store_true')
 
+    return parser
+
+
+def check_args(parser, args):
+    """
+    exit through parser.error on combinations of arguments the recorder cannot write
+    """
+    if args.swmr and args.image_storage in ('png', 'jpeg'):
+        # png and jpeg blobs are variable length datasets, which hdf5 cannot write in swmr mode
+        parser.error('--swmr does not support --image_storage %s, use raw or mp4' % args.image_storage)
+
+
+if __name__ == '__main__':
+    parser = build_parser()
     args = parser.parse_args()
+    check_args(parser, args)
+
+    if rospy is None:
+        print("\nrospy: cannot import ros packages. Please source ros env first.\n")
+        exit()
 
     # init cv bridge for data conversion
     bridge = CvBridge()
@@ -425,7 +926,6 @@ if __name__ == '__main__':
         exit()
 
     # init logger
-    log = logging.getLogger('logger')
     log.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(message)s')
     ch = logging.StreamHandler()
@@ -436,26 +936,5 @@ if __name__ == '__main__':
     ch.setFormatter(formatter)
     log.addHandler(ch)
 
-    # camera extrinsics, the transformation that pre-multiplies recorded poses to match opencv convention
-    extrinsic = np.array([[0, 1, 0, 0], [0, 0, -1, 0],
-                          [-1, 0, 0, 0], [0, 0, 0, 1]])  # T_cv_ambf
-
-    # check topics and see if we need to read stereo adf for baseline
-    if args.stereoL_topic is not None and args.stereoR_topic is not None:
-        stereo = True
-    else:
-        stereo = False
-    f, h, w, scale = init_hdf5(args, stereo)
-
-    # initialize queue for multi-threading
-    chunk = args.chunk_size
-    data_queue = Queue(chunk * 2)
-    num_data = 0
-    container = OrderedDict()
-    collisions = OrderedDict()
-    # Added, not sure if needed?
-    omni_force = OrderedDict()
-    burr_change = OrderedDict()
-    voxel_volume = 0
-
+    init_recorder(args)
     main(args)
@@ -0,0 +1,230 @@
+import logging
+import threading
+import time
+from queue import Queue
+
+import numpy as np
+
+log = logging.getLogger('logger')
+
+
+# target uncompressed size of a chunk for scalar and vector streams
+CHUNK_BYTES = 64 * 1024
+
+# index of the chunks written into a long-lived session file
+SEGMENT_GROUP = 'metadata/segments'
+
+
+def parse_codec(spec):
+    """
+    convert a codec description into h5py dataset keyword arguments
+    :param spec: 'none', 'lzf' or 'gzip[:level]', optionally followed by '+shuffle'
+    :return: dict of compression keyword arguments
+    """
+    name, _, flag = spec.partition('+')
+    name, _, level = name.partition(':')
+
+    if flag not in ('', 'shuffle'):
+        raise ValueError("Unknown codec filter '%s' in '%s'" % (flag, spec))
+
+    if name == 'none':
+        kwargs = {}
+    elif name == 'lzf':
+        kwargs = dict(compression='lzf')
+    elif name == 'gzip':
+        kwargs = dict(compression='gzip')
+        if level:
+            kwargs['compression_opts'] = int(level)
+    else:
+        raise ValueError("Unknown codec '%s'" % spec)
+
+    if flag:
+        kwargs['shuffle'] = True
+
+    return kwargs
+
+
+def chunk_shape(sample_shape, itemsize):
+    """
+    one frame per chunk for images and depth maps, CHUNK_BYTES worth of rows otherwise
+    :param sample_shape: shape of a single sample
+    :param itemsize: bytes per element
+    :return: chunk shape including the unlimited first axis
+    """
+    if len(sample_shape) >= 2:
+        return (1,) + tuple(sample_shape)
+
+    sample_bytes = itemsize * int(np.prod(sample_shape))
+    return (max(1, CHUNK_BYTES // sample_bytes),) + tuple(sample_shape)
+
+
+class HDF5Writer(object):
+    """
+    Appends batches of recorded samples to resizable, chunked HDF5 datasets.
+
+    Datasets are created on the first append with an unlimited leading axis
+    and grown in place afterwards, so a file can be filled incrementally
+    without keeping the whole recording in memory. Compression is chosen per
+    dataset from codecs, keyed by group/key or by the bare dataset name, falling
+    back to default_codec.
+    """
+    def __init__(self, file, codecs=None, default_codec='gzip'):
+        self._file = file
+        self._codecs = dict(codecs or {})
+        self._default_codec = default_codec
+        self.opened = time.time()
+
+    @property
+    def file(self):
+        return self._file
+
+    @property
+    def size(self):
+        """
+        current size of the file on disk in bytes
+        """
+        return self._file.id.get_filesize()
+
+    def codec(self, group, key):
+        """
+        :return: codec of group/key if given, else of the bare dataset name key, else the default codec
+        """
+        return self._codecs.get(group + '/' + key, self._codecs.get(key, self._default_codec))
+
+    def create(self, group, key, sample_shape, dtype):
+        """
+        create an empty resizable dataset, done implicitly by the first append unless
+        the file is about to switch to swmr mode, which forbids creating datasets
+        :param sample_shape: shape of a single sample
+        :param dtype: dtype of the dataset
+        :return: the dataset
+        """
+        grp = self._file.require_group(group)
+        if key in grp:
+            return grp[key]
+
+        sample_shape = tuple(sample_shape)
+        dtype = np.dtype(dtype)
+        return grp.create_dataset(key, shape=(0,) + sample_shape, maxshape=(None,) + sample_shape,
+                                  dtype=dtype, chunks=chunk_shape(sample_shape, dtype.itemsize),
+                                  **parse_codec(self.codec(group, key)))
+
+    def create_segment_index(self, groups):
+        for group in groups:
+            self.create(SEGMENT_GROUP, group, (2,), np.int64)
+        self.create(SEGMENT_GROUP, 'wall_time', (), np.float64)
+
+    def start_swmr(self):
+        """
+        switch to single writer / multiple reader mode, readers opening the file with swmr=True
+        see every append after the next flush(); datasets and groups can no longer be created
+        """
+        self._file.swmr_mode = True
+
+    def flush(self):
+        self._file.flush()
+
+    def append(self, group, key, values, dtype=None):
+        """
+        append a batch of samples along the first axis
+        :param group: name of the hdf5 group
+        :param key: name of the dataset inside the group
+        :param values: array-like, N x sample shape
+        :param dtype: dataset dtype if it differs from values.dtype, e.g. variable length blobs
+        :return: number of samples in the dataset after the append
+        """
+        values = np.asarray(values)
+        if values.shape[0] == 0:
+            # nothing is created for an empty batch, the size is that of the dataset if it exists
+            grp = self._file.get(group)
+            return grp[key].shape[0] if grp is not None and key in grp else 0
+
+        grp = self._file.require_group(group)
+        if key not in grp:
+            self.create(group, key, values.shape[1:], dtype or values.dtype)
+
+        dset = grp[key]
+        start = dset.shape[0]
+        dset.resize(start + values.shape[0], axis=0)
+        if values.dtype == object:
+            # h5py would broadcast equally sized variable length rows into a 2d array
+            for idx, value in enumerate(values):
+                dset[start + idx] = value
+        else:
+            dset[start:] = values
+
+        return dset.shape[0]
+
+    def end_segment(self, groups):
+        """
+        close the current segment, the rows appended to each group since the previous one
+        are recorded as [start, stop) in metadata/segments/<group> along with the wall time
+        :param groups: names of the recorded groups
+        :return: False if nothing was appended since the previous segment
+        """
+        index = self._file.require_group(SEGMENT_GROUP)
+        rows = []
+        for group in groups:
+            grp = self._file.get(group)
+            stop = max([len(dset) for dset in grp.values()] or [0]) if grp is not None else 0
+            start = index[group][-1, 1] if group in index and len(index[group]) else 0
+            rows.append((group, start, stop))
+
+        if all(start == stop for _, start, stop in rows):
+            return False
+
+        for group, start, stop in rows:
+            self.append(SEGMENT_GROUP, group, np.array([[start, stop]], dtype=np.int64))
+        self.append(SEGMENT_GROUP, 'wall_time', np.array([time.time()]))
+
+        return True
+
+
+class BackgroundWriter(threading.Thread):
+    """
+    Runs the disk writes on a dedicated thread.
+
+    Capture hands over whole filled buffers with submit() and immediately
+    continues into fresh ones. At most max_pending buffers wait behind the one
+    being written; submit() only blocks if the writer falls further behind.
+    The first failed write is kept in error and passed to on_error, check()
+    raises it on the recording side.
+    """
+    def __init__(self, write_fn, max_pending=1, on_error=None):
+        threading.Thread.__init__(self, name='hdf5_writer')
+        self.daemon = True
+        self._write_fn = write_fn
+        self._jobs = Queue(max_pending)
+        self._on_error = on_error
+        self.error = None
+
+    def submit(self, *job):
+        self._jobs.put(job)
+
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            try:
+                self._write_fn(*job)
+            except Exception as e:
+                log.log(logging.ERROR, "Failed to write buffer: %s" % e)
+                if self.error is None:
+                    self.error = e
+                    if self._on_error is not None:
+                        self._on_error(e)
+
+    def check(self):
+        """
+        raise RuntimeError if a write failed
+        """
+        if self.error is not None:
+            raise RuntimeError("Writing to hdf5 failed: %s" % self.error) from self.error
+
+    def stop(self):
+        """
+        write everything submitted so far and wait for the thread to exit
+        """
+        self._jobs.put(None)
+        self.join()
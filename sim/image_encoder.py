@@ -0,0 +1,87 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import h5py
+import numpy as np
+
+# streams that can be stored encoded instead of as raw bgr8 frames
+IMAGE_KEYS = ['l_img', 'r_img', 'segm']
+
+# dtype of a dataset holding one encoded frame per row
+BLOB_DTYPE = h5py.vlen_dtype(np.uint8)
+
+
+class ImageEncoder(object):
+    """
+    Encodes image streams on a worker pool before they reach the hdf5 file.
+
+    png / jpeg: every frame becomes a byte blob stored in a variable length dataset.
+    mp4: frames are appended to one video per stream next to the hdf5 file and the
+    dataset only keeps the video frame number of each recorded sample.
+    """
+    def __init__(self, storage, workers=4, jpeg_quality=95, fps=30):
+        self.storage = storage
+        self._pool = ThreadPoolExecutor(workers)
+        self._ext = '.png' if storage == 'png' else '.jpg'
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if storage == 'jpeg' else []
+        self._fps = fps
+        self._videos = {}
+        self._num_frames = {}
+
+    @property
+    def dataset_suffix(self):
+        return '_frame' if self.storage == 'mp4' else ''
+
+    @property
+    def dtype(self):
+        return np.int64 if self.storage == 'mp4' else BLOB_DTYPE
+
+    def submit(self, key, frames, video_path=None):
+        """
+        start encoding a batch of frames of one stream on the worker pool
+        :param key: name of the image stream
+        :param frames: N x H x W x 3 bgr8 frames, must stay untouched until the result is collected
+        :param video_path: video file of the stream, mp4 storage only
+        :return: function returning the values to store, blobs or video frame numbers
+        """
+        if self.storage == 'mp4':
+            return self._pool.submit(self._write_video, key, frames, video_path).result
+
+        futures = [self._pool.submit(cv2.imencode, self._ext, frame, self._params) for frame in frames]
+
+        def gather():
+            blobs = np.empty(len(futures), dtype=object)
+            for idx, future in enumerate(futures):
+                ok, buf = future.result()
+                if not ok:
+                    raise RuntimeError("Failed to encode %s frame" % key)
+                blobs[idx] = buf.ravel()
+            return blobs
+
+        return gather
+
+    def _write_video(self, key, frames, video_path):
+        video = self._videos.get(key)
+        if video is None:
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            video = cv2.VideoWriter(video_path, fourcc, self._fps, (frames.shape[2], frames.shape[1]))
+            self._videos[key] = video
+            self._num_frames[key] = 0
+
+        start = self._num_frames[key]
+        for frame in frames:
+            video.write(frame)
+        self._num_frames[key] = start + len(frames)
+
+        return np.arange(start, start + len(frames))
+
+    def close_videos(self):
+        for video in self._videos.values():
+            video.release()
+        self._videos = {}
+        self._num_frames = {}
+
+
+def video_path(hdf5_path, key):
+    return os.path.splitext(hdf5_path)[0] + '_' + key + '.mp4'
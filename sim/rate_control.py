@@ -0,0 +1,55 @@
+import threading
+from collections import deque
+
+
+class RateLimiter(object):
+    """
+    Decimates a stream to a target rate using the message time stamps.
+
+    Kept samples stay on a fixed grid of 1 / rate, so jitter in the arrival
+    times does not lower the recorded rate. A rate of 0 keeps every message.
+    """
+    def __init__(self, rate=0):
+        self.period = 1.0 / rate if rate > 0 else 0.0
+        self._next = None
+
+    def due(self, stamp):
+        """
+        :param stamp: time stamp of the message in seconds
+        :return: True if the message should be recorded
+        """
+        if self.period == 0:
+            return True
+        if self._next is not None and stamp < self._next:
+            return False
+
+        if self._next is None or stamp - self._next >= self.period:
+            self._next = stamp + self.period  # stream paused or started, restart the grid
+        else:
+            self._next += self.period
+        return True
+
+
+class MessageHistory(object):
+    """
+    The most recent messages of one stream, to pair it with other streams by nearest time stamp.
+    """
+    def __init__(self, length=10):
+        self._messages = deque(maxlen=length)
+        self._lock = threading.Lock()
+
+    def add(self, stamp, msg):
+        with self._lock:
+            self._messages.append((stamp, msg))
+
+    def __len__(self):
+        return len(self._messages)
+
+    def nearest(self, stamp):
+        """
+        :return: the message with the time stamp closest to stamp, None if nothing was received yet
+        """
+        with self._lock:
+            if not self._messages:
+                return None
+            return min(self._messages, key=lambda item: abs(item[0] - stamp))[1]
@@ -0,0 +1,316 @@
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+
+import data_record
+from hdf5_writer import BackgroundWriter
+from rate_control import MessageHistory
+
+
+def stamp(t):
+    return SimpleNamespace(stamp=SimpleNamespace(to_sec=lambda: t))
+
+
+def synthetic_frames(count, height, width, seed=0):
+    """
+    bgr8 frames with smooth structure and sensor-like noise, so codecs see realistic content
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    cols = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    frames = []
+    for idx in range(count):
+        base = (rows * (idx + 1) / count + cols * np.array([0.2, 0.5, 0.8], dtype=np.float32)) % 256
+        noise = rng.normal(0, 4, (height, width, 3))
+        frames.append(np.clip(base + noise, 0, 255).astype(np.uint8))
+    return frames
+
+
+def synthetic_cloud(height, width):
+    """
+    structured x, y, z point cloud of a tilted plane, as published by the depth camera
+    """
+    cloud = np.empty(height * width, dtype=[('x', np.float32), ('y', np.float32), ('z', np.float32)])
+    v, u = np.mgrid[0:height, 0:width]
+    cloud['x'] = (0.1 + 0.0001 * v).ravel()
+    cloud['y'] = (u / width - 0.5).ravel()
+    cloud['z'] = (v / height - 0.5).ravel()
+    return cloud
+
+
+def synthetic_metadata(height, width):
+    focal = height / (2 * np.tan(np.pi / 6))
+    intrinsic = np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]])
+    return dict(intrinsic=intrinsic, height=height, width=width, scale=1.0, baseline=0.065)
+
+
+def image_keys(args):
+    topics = [('l_img', args.stereoL_topic), ('r_img', args.stereoR_topic), ('segm', args.segm_topic)]
+    return [key for key, topic in topics if topic != 'None']
+
+
+def setup_streams(args):
+    """
+    column specs of the synthetic streams, matching setup_subscriber in data_record.py
+    """
+    h, w = data_record.h, data_record.w
+    container = data_record.container
+    container['time'] = ((), np.float64)
+    # with --image_rate the image streams are recorded into the images group instead
+    images = data_record.image_container if args.image_rate > 0 else container
+    for key in image_keys(args):
+        images[key] = ((h, w, 3), np.uint8)
+    if args.depth_topic != 'None':
+        images['depth'] = ((h, w), np.float16)
+    if args.image_rate > 0:
+        for key in list(images.keys())[1:]:
+            data_record.image_history[key] = MessageHistory()
+    for name in args.objects:
+        container['pose_' + name] = ((7,), np.float64)
+
+    data_record.collisions['time_stamp'] = ((), np.float64)
+    data_record.collisions['voxel_removed'] = ((3,), np.uint16)
+    data_record.collisions['voxel_color'] = ((4,), np.uint8)
+    data_record.burr_change['time_stamp'] = ((), np.float64)
+    data_record.burr_change['burr_size'] = ((), np.uint8)
+    data_record.omni_force['time_stamp'] = ((), np.float64)
+    data_record.omni_force['wrench'] = ((3,), np.float64)
+
+    for stream in ['voxels_removed', 'burr_change', 'force'] + list(container.keys())[1:] + list(images.keys())[1:]:
+        data_record.stats.add_stream(stream)
+
+
+def depth_fn(args):
+    return data_record.full_depth_from_points if args.depth_mode == 'full' else data_record.depth_from_points
+
+
+def frame_source(args, frames, cloud):
+    """
+    convert and enqueue one synchronized frame, the work callback does after the synchronizer
+    """
+    keys = [] if args.image_rate > 0 else image_keys(args)
+    with_depth = args.depth_topic != 'None' and args.image_rate == 0
+    to_depth = depth_fn(args)
+    state = dict(idx=0)
+
+    def emit(t):
+        idx = state['idx']
+        state['idx'] = idx + 1
+        data_record.stats.synced()
+        if not data_record.frame_limiter.due(t):
+            return
+        data = dict(time=t)
+        for key in keys:
+            data[key] = frames[idx % len(frames)]
+            data_record.stats.message(key)
+        if with_depth:
+            data['depth'] = to_depth(cloud)
+            data_record.stats.message('depth')
+        for name in args.objects:
+            position = SimpleNamespace(x=np.cos(t), y=np.sin(t), z=0.01 * idx)
+            orientation = SimpleNamespace(x=0.0, y=0.0, z=np.sin(t / 2), w=np.cos(t / 2))
+            data['pose_' + name] = data_record.pose_gen(
+                SimpleNamespace(pose=SimpleNamespace(position=position, orientation=orientation)))
+            data_record.stats.message('pose_' + name)
+        data_record.enqueue_frame(data)
+
+    return emit
+
+
+def image_source(key, payloads):
+    """
+    image messages of one decoupled stream, payloads stand in for the ros message data
+    """
+    state = dict(idx=0)
+
+    def emit(t):
+        payload = payloads[state['idx'] % len(payloads)]
+        state['idx'] += 1
+        data_record.image_callback(SimpleNamespace(header=stamp(t), data=payload), key)
+
+    return emit
+
+
+def force_source(t):
+    force = SimpleNamespace(x=np.sin(t), y=np.cos(t), z=0.5)
+    data_record.force_callback(SimpleNamespace(header=stamp(t), wrench=SimpleNamespace(force=force)))
+
+
+def voxel_source(t):
+    voxel = SimpleNamespace(x=int(t * 1000) % 512, y=int(t * 100) % 512, z=int(t * 10) % 512)
+    data_record.rm_vox_callback(SimpleNamespace(header=stamp(t), voxel_removed=voxel,
+                                                voxel_color=[0.9, 0.8, 0.7, 1.0]))
+
+
+def burr_source(t):
+    number = SimpleNamespace(data=int(t) % 4)
+    data_record.burr_change_callback(SimpleNamespace(header=stamp(t), number=number))
+
+
+def run_source(emit, rate, stop, counts, name):
+    """
+    call emit at a fixed rate until stop is set, late calls are not made up
+    """
+    if rate <= 0:
+        return
+    period = 1.0 / rate
+    next_time = time.time()
+    while not stop.is_set():
+        now = time.time()
+        if now < next_time:
+            time.sleep(next_time - now)
+            continue
+        emit(now)
+        counts[name] += 1
+        next_time = max(next_time + period, now)
+
+
+def percentiles(values, qs=(50, 95, 99, 100)):
+    if len(values) == 0:
+        return [float('nan')] * len(qs)
+    return np.percentile(values, qs).tolist()
+
+
+def recorded_frames(paths):
+    """
+    :return: number of frames in the data group of the files on disk
+    """
+    frames = 0
+    for path in paths:
+        with h5py.File(path, 'r') as f:
+            if 'time' in f['data']:
+                frames += len(f['data']['time'])
+    return frames
+
+
+def main(args):
+    """
+    :return: recorder stats snapshot with the frames found on disk and the ones lost on the way added
+    """
+    existing = set(glob.glob(os.path.join(args.output_dir, '*.hdf5')))
+    metadata = synthetic_metadata(args.height, args.width)
+    data_record.args = args
+    data_record.init_recorder(args, metadata)
+    setup_streams(args)
+
+    # time every write and the age of the frames it stores
+    latencies = []
+    flush_times = []
+    image_sets = [0]
+
+    def timed_write(filled, end_chunk=False):
+        times = [buffer.columns()['time'].copy() for group, buffer in filled if group == 'data' and len(buffer)]
+        image_sets[0] += sum(len(buffer) for group, buffer in filled if group == 'images')
+        start = time.time()
+        data_record.write_to_hdf5(filled, end_chunk)
+        done = time.time()
+        flush_times.append(done - start)
+        for t in times:
+            latencies.extend(done - t)
+
+    data_record.background_writer = BackgroundWriter(timed_write, on_error=data_record.recording_failed)
+    consumer = data_record.start_recording()
+
+    frames = synthetic_frames(8, args.height, args.width)
+    cloud = synthetic_cloud(args.height, args.width)
+    sources = [('frames', frame_source(args, frames, cloud), args.gen_frame_rate),
+               ('force', force_source, args.gen_force_rate),
+               ('voxels_removed', voxel_source, args.gen_voxel_rate),
+               ('burr_change', burr_source, args.gen_burr_rate)]
+    if args.image_rate > 0:
+        # decoupled image streams arrive on their own, conversion only happens for recorded messages
+        to_depth = depth_fn(args)
+        data_record.convert_image_msg = lambda key, msg: to_depth(msg.data) if key == 'depth' else msg.data
+        for key in data_record.image_history.keys():
+            sources.append((key, image_source(key, [cloud] if key == 'depth' else frames), args.gen_frame_rate))
+    counts = dict((name, 0) for name, _, _ in sources)
+    stop = threading.Event()
+    threads = [threading.Thread(target=run_source, args=(emit, rate, stop, counts, name), name=name)
+               for name, emit, rate in sources]
+
+    print("Generating load for %.1fs into %s" % (args.duration, args.output_dir))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    generated = time.time() - start
+    for thread in threads:
+        thread.join()
+    data_record.stop_recording(consumer)
+    elapsed = time.time() - start
+
+    stats = data_record.stats.snapshot()
+    print("\n%-16s %10s %10s %10s" % ("stream", "target/s", "actual/s", "messages"))
+    for name, _, rate in sources:
+        print("%-16s %10.1f %10.1f %10d" % (name, rate, counts[name] / generated, counts[name]))
+
+    # count what reached the files rather than what was handed to the writer
+    paths = sorted(set(glob.glob(os.path.join(args.output_dir, '*.hdf5'))) - existing)
+    stored = recorded_frames(paths)
+    stats['stored_frames'] = stored
+    stats['lost_frames'] = stats['synced_frames'] - stats['dropped_frames'] - stats['rejected_frames'] - stored
+    print("\nframes on disk %d of %d in %d files, dropped %d, rejected %d, lost %d" % (
+        stored, stats['synced_frames'], len(paths), stats['dropped_frames'], stats['rejected_frames'],
+        stats['lost_frames']))
+    print("max queue depth %d, drained %.2fs after the last frame" % (stats['max_queue_depth'], elapsed - generated))
+    if args.image_rate > 0:
+        print("image sets stored %d, %.1f/s" % (image_sets[0], image_sets[0] / generated))
+    print("sustained throughput %.1f frames/s, %.1f MB/s written" % (
+        stored / elapsed, stats['flush_bytes'] / 1e6 / elapsed))
+    print("frame latency to disk p50 %.3fs p95 %.3fs p99 %.3fs max %.3fs" % tuple(percentiles(latencies)))
+    print("flush duration p50 %.3fs p95 %.3fs p99 %.3fs max %.3fs over %d flushes" % (
+        tuple(percentiles(flush_times)) + (len(flush_times),)))
+
+    return stats
+
+
+def build_parser():
+    parser = data_record.build_parser()
+    parser.description = 'Drive the recorder pipeline with synthetic messages, no simulator or ros required'
+    parser.set_defaults(output_dir=None)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of synthetic messages to generate')
+    parser.add_argument('--gen_frame_rate', type=float, default=30,
+                        help='Generated image, depth and pose messages per second')
+    parser.add_argument('--gen_force_rate', type=float, default=1000,
+                        help='Generated force messages per second')
+    parser.add_argument('--gen_voxel_rate', type=float, default=200,
+                        help='Generated removed voxel messages per second')
+    parser.add_argument('--gen_burr_rate', type=float, default=0.5,
+                        help='Generated burr change messages per second')
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the recorded files when no --output_dir is given')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    data_record.check_args(parser, args)
+
+    log = logging.getLogger('logger')
+    log.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+    ch.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(ch)
+
+    scratch = args.output_dir is None
+    if scratch:
+        args.output_dir = tempfile.mkdtemp(prefix='recorder_load_test_')
+    try:
+        main(args)
+    finally:
+        if scratch and not args.keep:
+            shutil.rmtree(args.output_dir)
@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Histogram(object):
+    """
+    Counts samples into fixed bins, values outside the edges land in the first or last bin.
+    """
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+
+    def add(self, value):
+        idx = np.searchsorted(self.edges, value, side='right') - 1
+        self.counts[min(max(idx, 0), len(self.counts) - 1)] += 1
+
+
+class RecorderStats(object):
+    """
+    Health counters of the recording pipeline.
+
+    Message counts are kept per stream as they arrive, before synchronization,
+    next to the synchronizer output, the dropped and rejected frames, the data_queue
+    occupancy and the duration and size of every flush. Callbacks and the
+    consumer only increment counters under a lock; snapshot() turns them into
+    cumulative totals and rates since the previous snapshot.
+    """
+    def __init__(self, queue_size, interval=10.0):
+        """
+        :param queue_size: capacity of data_queue, bounds the occupancy histogram
+        :param interval: seconds between periodic snapshots, see due()
+        """
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._messages = OrderedDict()
+        self._synced = 0
+        self._dropped = 0
+        self._rejected = 0
+        self._flushes = 0
+        self._flush_bytes = 0
+        self._flush_seconds = 0.0
+        self._max_queue = 0
+        self.flush_latency = Histogram(np.concatenate([[0], np.logspace(-3, 1, 13), [np.inf]]))
+        self.queue_depth = Histogram(np.linspace(0, queue_size, 11))
+        self.start = time.time()
+        self._last_time = self.start
+        self._last_counts = {}
+
+    def add_stream(self, stream):
+        """
+        register a stream at startup so every snapshot has the same columns
+        """
+        with self._lock:
+            self._messages.setdefault(stream, 0)
+
+    def counter(self, stream):
+        """
+        :return: callback counting the messages of one stream, for message_filters subscribers
+        """
+        self.add_stream(stream)
+
+        def count(*_):
+            self.message(stream)
+
+        return count
+
+    def message(self, stream):
+        with self._lock:
+            self._messages[stream] = self._messages.get(stream, 0) + 1
+
+    def synced(self):
+        with self._lock:
+            self._synced += 1
+
+    def dropped(self):
+        with self._lock:
+            self._dropped += 1
+
+    def rejected(self):
+        with self._lock:
+            self._rejected += 1
+
+    def queue(self, depth):
+        with self._lock:
+            self._max_queue = max(self._max_queue, depth)
+            self.queue_depth.add(depth)
+
+    def flush(self, seconds, nbytes):
+        """
+        :param seconds: wall time spent writing the flush
+        :param nbytes: bytes the file grew by
+        """
+        with self._lock:
+            self._flushes += 1
+            self._flush_bytes += nbytes
+            self._flush_seconds += seconds
+            self.flush_latency.add(seconds)
+
+    def due(self):
+        return time.time() - self._last_time >= self.interval
+
+    def snapshot(self):
+        """
+        :return: ordered dict of cumulative counters and per second rates since the previous snapshot
+        """
+        now = time.time()
+        with self._lock:
+            counts = OrderedDict(('msgs_' + stream, count) for stream, count in self._messages.items())
+            counts['synced_frames'] = self._synced
+            counts['dropped_frames'] = self._dropped
+            counts['rejected_frames'] = self._rejected
+            counts['flushes'] = self._flushes
+            counts['flush_bytes'] = self._flush_bytes
+            stats = OrderedDict(wall_time=now, elapsed=now - self.start)
+            stats.update(counts)
+            stats['flush_seconds'] = self._flush_seconds
+            stats['max_queue_depth'] = self._max_queue
+            stats['flush_latency_hist'] = self.flush_latency.counts.tolist()
+            stats['queue_depth_hist'] = self.queue_depth.counts.tolist()
+
+        period = max(now - self._last_time, 1e-9)
+        for key, count in counts.items():
+            if key.startswith('msgs_') or key == 'synced_frames':
+                stats['rate_' + key.replace('msgs_', '')] = (count - self._last_counts.get(key, 0)) / period
+        self._last_time = now
+        self._last_counts = counts
+
+        return stats
+
+    def write(self, writer, stats, path=None):
+        """
+        append a snapshot to metadata/stats of the open file and as a json line to path
+        :param writer: HDF5Writer of the open file
+        :param stats: result of snapshot()
+        :param path: local stats file, skipped if None
+        """
+        group = 'metadata/stats'
+        for key, value in stats.items():
+            if key.endswith('_hist'):
+                continue
+            writer.append(group, key, np.array([value], dtype=np.float64))
+
+        # histograms are cumulative, only the latest counts are kept
+        grp = writer.file.require_group(group)
+        for key, edges in [('flush_latency', self.flush_latency.edges), ('queue_depth', self.queue_depth.edges)]:
+            for name, data in [(key + '_hist', stats[key + '_hist']), (key + '_edges', edges)]:
+                if name in grp:
+                    grp[name][...] = data  # in place, swmr files cannot create datasets
+                else:
+                    grp.create_dataset(name, data=data)
+
+        if path is not None:
+            with open(path, 'a') as f:
+                f.write(json.dumps(stats) + '\n')
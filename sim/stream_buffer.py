@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from queue import Empty, Queue
+
+import numpy as np
+
+
+def check_narrowing(name, value, dtype):
+    """
+    raise ValueError unless value is stored exactly in the integer dtype, numpy would silently
+    truncate fractions and wrap values out of range
+    """
+    value = np.asarray(value)
+    info = np.iinfo(dtype)
+    if value.dtype.kind not in 'biu' and np.any(value != np.floor(value)) \
+            or np.any(value < info.min) or np.any(value > info.max):
+        raise ValueError('%s value %s does not fit %s' % (name, value, np.dtype(dtype).name))
+
+
+class StreamBuffer(object):
+    """
+    Preallocated, column oriented buffer for one recorded stream group.
+
+    Every column is a typed array of capacity x sample shape and samples are
+    written into it by index, so recording a message costs no per-sample
+    Python objects and flushing hands out views instead of stacking lists.
+    """
+    def __init__(self, capacity, columns):
+        """
+        :param capacity: number of samples the buffer holds
+        :param columns: dict of column name -> (sample shape, dtype); a shape of None is
+                        taken from the first sample written to that column
+        """
+        self.capacity = capacity
+        self._specs = OrderedDict(columns)
+        self._columns = OrderedDict()
+        self._size = 0
+
+        for name, (shape, dtype) in self._specs.items():
+            if shape is not None:
+                self._allocate(name, shape)
+
+    def _allocate(self, name, shape):
+        self._columns[name] = np.zeros((self.capacity,) + tuple(shape), dtype=self._specs[name][1])
+        return self._columns[name]
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def full(self):
+        return self._size >= self.capacity
+
+    def append(self, **sample):
+        """
+        write one sample into the next free row of every column, a rejected sample leaves the buffer as it was
+        :return: True once the buffer is full
+        :raise ValueError: if a column is missing, None or unknown, or an integer value does not fit its column
+        """
+        problems = ['no %s' % name for name in self._specs if sample.get(name) is None]
+        problems += ['unknown column %s' % name for name in sample if name not in self._specs]
+        if problems:
+            raise ValueError('sample has ' + ', '.join(problems))
+        for name, value in sample.items():
+            dtype = self._specs[name][1]
+            if np.dtype(dtype).kind in 'iu' and getattr(value, 'dtype', None) != dtype:
+                check_narrowing(name, value, dtype)
+
+        # the row only counts once every column is written, a partly written one is overwritten by the next sample
+        idx = self._size
+        for name, value in sample.items():
+            column = self._columns.get(name)
+            if column is None:
+                column = self._allocate(name, np.shape(value))
+            column[idx] = value
+
+        self._size = idx + 1
+        return self._size >= self.capacity
+
+    def columns(self):
+        """
+        :return: dict of column name -> view on the filled rows
+        """
+        return OrderedDict((name, column[:self._size]) for name, column in self._columns.items())
+
+    def clear(self):
+        self._size = 0
+
+
+class DoubleBuffer(object):
+    """
+    StreamBuffers used in turn: capture fills the front buffer while the
+    writer drains the ones handed over by swap() and returns them with release().
+    """
+    def __init__(self, capacity, columns, count=2):
+        self._free = Queue()
+        for _ in range(count - 1):
+            self._free.put(StreamBuffer(capacity, columns))
+        self.front = StreamBuffer(capacity, columns)
+
+    def swap(self, timeout=None):
+        """
+        continue capturing into a free buffer, blocks until the writer releases one
+        :param timeout: seconds to wait for a free buffer, None waits forever
+        :return: the filled front buffer
+        """
+        try:
+            free = self._free.get(timeout=timeout)
+        except Empty:
+            raise RuntimeError("No buffer released within %ss, the writer stalled" % timeout)
+        filled = self.front
+        self.front = free
+        return filled
+
+    def release(self, buffer):
+        buffer.clear()
+        self._free.put(buffer)
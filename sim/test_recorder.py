@@ -0,0 +1,99 @@
+import glob
+import threading
+
+import numpy as np
+import pytest
+
+import data_record
+import recorder_load_test
+from hdf5_writer import HDF5Writer
+from stream_buffer import StreamBuffer
+
+
+def load_args(tmp_path, *extra):
+    """
+    arguments of a short load test with small frames writing into tmp_path
+    """
+    return recorder_load_test.build_parser().parse_args(
+        ['--output_dir', str(tmp_path), '--duration', '1', '--height', '24', '--width', '32',
+         '--stats_file', 'None'] + list(extra))
+
+
+def run_load(args, timeout=60):
+    """
+    run the load test on a thread, fails instead of hanging if the recorder does not stop
+    :return: result of recorder_load_test.main, the exception it raised instead
+    """
+    result = {}
+
+    def run():
+        try:
+            result['value'] = recorder_load_test.main(args)
+        except Exception as e:
+            result['value'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'recorder did not stop within %ds' % timeout
+    return result['value']
+
+
+def test_failed_write_stops_recording(tmp_path, monkeypatch):
+    append = HDF5Writer.append
+
+    def failing_append(self, group, key, values, dtype=None):
+        if group == 'data':
+            raise OSError('disk full')
+        return append(self, group, key, values, dtype)
+
+    monkeypatch.setattr(HDF5Writer, 'append', failing_append)
+    result = run_load(load_args(tmp_path, '--flush_size', '5'))
+
+    assert isinstance(result, RuntimeError)
+    assert 'disk full' in str(result)
+    assert data_record.background_writer.error is not None
+
+
+def test_stream_buffer_rejects_incomplete_samples():
+    buffer = StreamBuffer(4, dict(time=((), np.float64), voxel=((3,), np.uint16)))
+    buffer.append(time=1.0, voxel=(1, 2, 3))
+
+    for sample in [dict(time=2.0), dict(time=2.0, voxel=None), dict(time=2.0, voxel=(1, 2, -3)),
+                   dict(time=2.0, voxel=(1, 2, 3), color=0)]:
+        with pytest.raises(ValueError):
+            buffer.append(**sample)
+
+    buffer.append(time=3.0, voxel=(4, 5, 6))
+    columns = buffer.columns()
+    np.testing.assert_array_equal(columns['time'], [1.0, 3.0])
+    np.testing.assert_array_equal(columns['voxel'], [[1, 2, 3], [4, 5, 6]])
+
+
+def test_consumer_skips_rejected_frames(tmp_path, monkeypatch):
+    enqueue = data_record.enqueue_frame
+    frames = []
+
+    def enqueue_every_third_without_pose(data):
+        frames.append(data)
+        if len(frames) % 3 == 0:
+            data['pose_' + data_record.args.objects[0]] = None
+        enqueue(data)
+
+    monkeypatch.setattr(data_record, 'enqueue_frame', enqueue_every_third_without_pose)
+    stats = run_load(load_args(tmp_path))
+
+    assert stats['dropped_frames'] == 0
+    assert stats['rejected_frames'] == len(frames) // 3 > 0
+    assert stats['lost_frames'] == 0
+
+
+def test_quick_rollovers_keep_every_file(tmp_path):
+    # a file per 30 frames at 60 frames/s rolls over several times within one second
+    args = load_args(tmp_path, '--chunk_size', '30', '--flush_size', '10', '--gen_frame_rate', '60',
+                     '--duration', '2')
+    stats = run_load(args)
+
+    assert len(glob.glob(str(tmp_path / '*.hdf5'))) >= 4
+    assert stats['stored_frames'] > 0
+    assert stats['lost_frames'] == 0